@@ -0,0 +1,382 @@
+"""
+bench.py
+قياس أداء main.py: يشغل تطبيق Flask مقابل خادم Telegram وهمي (fake_telegram.py)
+ويرسل تدفقات تحديثات مصطنعة بأحجام مختلفة من المستخدمين والطلبات.
+
+مثال:
+    python bench/bench.py --sizes 1000,10000 --updates 5000 --latency 0.02 --rate-limit 0.01 --out bench.json
+
+كل حجم يعمل في عملية منفصلة (main.py يحمّل بياناته عند الاستيراد) وتُجمع النتائج في JSON واحد
+لمقارنتها بين النسخ: زمن الرد على webhook (p50/p99)، زمن المعالجة، الإنتاجية، زمن الحفظ، الذاكرة.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BOT_TOKEN = "123456:BENCH"
+ADMIN_ID = 999
+SERVICES = [("pubg", "شحن شدات PUBG"), ("ff", "شحن FreeFire"), ("google", "Google Play"), ("itunes", "iTunes")]
+SCENARIOS = ("start", "nav", "order", "admin")
+
+
+# ----------------------------
+#  --- أدوات القياس -----
+# ----------------------------
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+def summarize(seconds):
+    """يحوّل قائمة أزمنة (ثواني) إلى ملخص بالميلي ثانية"""
+    if not seconds:
+        return {"count": 0}
+    return {
+        "count": len(seconds),
+        "mean_ms": round(sum(seconds) / len(seconds) * 1000, 3),
+        "p50_ms": round(percentile(seconds, 50) * 1000, 3),
+        "p90_ms": round(percentile(seconds, 90) * 1000, 3),
+        "p99_ms": round(percentile(seconds, 99) * 1000, 3),
+        "max_ms": round(max(seconds) * 1000, 3),
+    }
+
+def rss_mb():
+    # current RSS from /proc when available, peak RSS otherwise
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    fn(*args)
+    return round((time.perf_counter() - started) * 1000, 3)
+
+
+# ----------------------------
+#  --- بيانات مصطنعة -----
+# ----------------------------
+def make_dataset(users, orders, seed):
+    rnd = random.Random(seed)
+    now = datetime.now()
+    user_data = {}
+    for uid in range(1, users + 1):
+        first_seen = now - timedelta(days=rnd.randint(0, 365))
+        user_data[str(uid)] = {"id": uid, "name": f"user{uid}", "first_seen": first_seen.isoformat(),
+                               "awaiting": None, "lang": "ar" if rnd.random() < 0.8 else "en"}
+    order_data = []
+    for n in range(orders):
+        uid = rnd.randint(1, max(1, users))
+        button_id, button_text = rnd.choice(SERVICES)
+        created = now - timedelta(minutes=rnd.randint(0, 60 * 24 * 90))
+        status = rnd.choice(("pending", "pending", "approved", "rejected", "needs_more"))
+        order = {"order_id": f"bench-{n}", "user_id": uid, "user_name": f"user{uid}", "button_id": button_id,
+                 "button_text": button_text, "info": "12345 660UC", "status": status,
+                 "created_at": created.isoformat(), "notes": ""}
+        if status in ("approved", "rejected"):
+            order["handled_at"] = (created + timedelta(minutes=rnd.randint(1, 600))).isoformat()
+        order_data.append(order)
+    return user_data, order_data
+
+class UpdateStream:
+    """يولّد تحديثات Telegram بصيغة JSON حسب خليط السيناريوهات"""
+
+    def __init__(self, users, order_ids, mix, seed):
+        self.rnd = random.Random(seed)
+        self.users = max(1, users)
+        self.pending_orders = list(order_ids)
+        self.rnd.shuffle(self.pending_orders)
+        self.mix = mix
+        self.update_id = 0
+        self.callback_id = 0
+
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self, chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+
+    def message(self, chat_id, text):
+        msg = {"message_id": self.update_id, "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private"}, "from": self._user(chat_id), "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self._next_id(), "message": msg}
+
+    def callback(self, chat_id, data):
+        self.callback_id += 1
+        return {"update_id": self._next_id(), "callback_query": {
+            "id": str(self.callback_id), "from": self._user(chat_id), "chat_instance": "bench", "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": "menu"}}}
+
+    def random_user(self):
+        # mostly existing users, some brand new ones
+        if self.rnd.random() < 0.9:
+            return self.rnd.randint(1, self.users)
+        return self.users + self.rnd.randint(1, self.users)
+
+    def scenario(self, name):
+        """يعيد قائمة تحديثات متتالية لنفس المحادثة"""
+        chat_id = self.random_user()
+        if name == "start":
+            return [self.message(chat_id, "/start")]
+        if name == "nav":
+            menu = self.rnd.choice(("services", "cards"))
+            return [self.callback(chat_id, f"BTN|{menu}"), self.callback(chat_id, "NAV|back")]
+        if name == "order":
+            button_id = self.rnd.choice(SERVICES)[0]
+            return [self.callback(chat_id, f"BTN|{button_id}"), self.message(chat_id, f"ID {self.rnd.randint(10000, 99999)} 660UC")]
+        if name == "admin":
+            if not self.pending_orders:
+                return [self.callback(ADMIN_ID, "ADMIN|stats")]
+            order_id = self.pending_orders.pop()
+            return [self.callback(ADMIN_ID, f"ORDER|{order_id}|{self.rnd.choice(('approve', 'reject'))}")]
+        raise ValueError(name)
+
+    def generate(self, count):
+        names = [n for n, _ in self.mix]
+        weights = [w for _, w in self.mix]
+        out = []
+        while len(out) < count:
+            out.extend(self.scenario(self.rnd.choices(names, weights)[0]))
+        return out[:count]
+
+
+# ----------------------------
+#  --- تشغيل حجم واحد (عملية منفصلة) -----
+# ----------------------------
+def prepare_workdir(opts):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    users, orders = make_dataset(opts["users"], opts["orders"], opts["seed"])
+    config = {"BOT_TOKEN": BOT_TOKEN, "WEBHOOK_URL": "http://bench.invalid", "ADMIN_IDS": [ADMIN_ID],
+              "BROADCAST_RATE": opts["broadcast_rate"], "STORAGE_BACKEND": "json"}
+    config.update(opts.get("config") or {})
+    for name, data in (("users.json", users), ("orders.json", orders), ("config.json", config)):
+        with open(os.path.join(workdir, name), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+    if opts["backend"] == "sqlite":
+        # load the generated JSON into SQLite with the bot's own migrator
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "main.py"), "migrate-sqlite", "bot.db"],
+                       cwd=workdir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        config.update({"STORAGE_BACKEND": "sqlite", "SQLITE_PATH": "bot.db"})
+        with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+            json.dump(config, f)
+    return workdir, [o["order_id"] for o in orders if o["status"] == "pending"]
+
+def post_updates(client, updates, concurrency, latencies, statuses):
+    lock = threading.Lock()
+    index = iter(range(len(updates)))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(index, None)
+            if i is None:
+                return
+            body = json.dumps(updates[i])
+            started = time.perf_counter()
+            resp = client.post(f"/webhook/{BOT_TOKEN}", data=body, content_type="application/json")
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def wait_idle(main, timeout):
+    deadline = time.monotonic() + timeout
+    for q in main.UPDATE_QUEUES:
+        while q.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+    return all(q.unfinished_tasks == 0 for q in main.UPDATE_QUEUES)
+
+def run_size(opts):
+    from fake_telegram import FakeTelegram
+
+    workdir, pending = prepare_workdir(opts)
+    fake = FakeTelegram(latency=opts["latency"], jitter=opts["jitter"], rate_limit_prob=opts["rate_limit"],
+                        retry_after=opts["retry_after"], seed=opts["seed"]).start()
+    import logging
+    import telebot
+    telebot.apihelper.API_URL = fake.api_url
+    logging.disable(logging.WARNING if opts["verbose"] else logging.CRITICAL)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    import main
+    result = {"users": opts["users"], "orders": opts["orders"], "backend": opts["backend"],
+              "startup_ms": round((time.perf_counter() - started) * 1000, 3),
+              "rss_mb": {"before_import": rss_before, "after_import": rss_mb()}}
+
+    # time spent in the worker for each update (queue wait excluded)
+    process_times = []
+    original_process = main.process_update
+
+    def timed_process(data):
+        t0 = time.perf_counter()
+        try:
+            original_process(data)
+        finally:
+            process_times.append(time.perf_counter() - t0)
+
+    main.process_update = timed_process
+
+    mix = [(name, opts["mix"].get(name, 0)) for name in SCENARIOS if opts["mix"].get(name, 0) > 0]
+    updates = UpdateStream(opts["users"], pending, mix, opts["seed"]).generate(opts["updates"])
+    client = main.app.test_client()
+    webhook_latency, statuses = [], {}
+    t0 = time.perf_counter()
+    post_updates(client, updates, opts["concurrency"], webhook_latency, statuses)
+    posted = time.perf_counter() - t0
+    drained = wait_idle(main, opts["timeout"])
+    total = time.perf_counter() - t0
+    result["updates"] = {
+        "sent": len(updates),
+        "status_codes": {str(k): v for k, v in statuses.items()},
+        "drained": drained,
+        "post_seconds": round(posted, 3),
+        "total_seconds": round(total, 3),
+        "throughput_per_s": round(len(updates) / total, 1) if total else None,
+        "webhook_latency": summarize(webhook_latency),
+        "processing_latency": summarize(process_times),
+        "errors": main.UPDATE_STATS.get("errors"),
+    }
+
+    if opts["broadcast"]:
+        fake_before = fake.stats()["total_calls"]
+        t0 = time.perf_counter()
+        job = main.start_broadcast("bench broadcast", None)
+        while main.BROADCASTS.get(job["id"], {}).get("status") == "running" and time.perf_counter() - t0 < opts["timeout"]:
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - t0
+        job = dict(main.BROADCASTS.get(job["id"], job))
+        result["broadcast"] = {
+            "recipients": job.get("total"),
+            "status": job.get("status"),
+            "sent": job.get("sent"), "failed": job.get("failed"), "blocked": job.get("blocked"),
+            "seconds": round(elapsed, 3),
+            "messages_per_s": round((job.get("offset") or 0) / elapsed, 1) if elapsed else None,
+            "api_calls": fake.stats()["total_calls"] - fake_before,
+        }
+
+    # persistence cost of the hot data files
+    users_snapshot = dict(main.STORAGE.iter_users())
+    orders_snapshot = list(main.ORDERS)
+    result["save"] = {
+        "save_json_users_ms": timed(main.save_json, "bench_users.json", users_snapshot),
+        "save_json_orders_ms": timed(main.save_json, "bench_orders.json", orders_snapshot),
+        "save_all_ms": timed(main.save_all),
+        "users_file_bytes": os.path.getsize("bench_users.json"),
+        "orders_file_bytes": os.path.getsize("bench_orders.json"),
+        "writers": {w.name: dict(w.stats) for w in getattr(main, "WRITERS", [])},
+    }
+    result["rss_mb"]["after_run"] = rss_mb()
+    result["rss_mb"]["peak"] = peak_rss_mb()
+    result["telegram"] = fake.stats()
+    fake.stop()
+    # removed by the parent once this process has exited and flushed its writers
+    result["workdir"] = workdir
+    return result
+
+
+# ----------------------------
+#  --- نقطة الدخول -----
+# ----------------------------
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r} (choose from {', '.join(SCENARIOS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark main.py against a local fake Telegram Bot API")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated user counts")
+    parser.add_argument("--orders-per-user", type=float, default=1.0, help="orders generated per user")
+    parser.add_argument("--updates", type=int, default=5000, help="updates replayed per size")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("start=3,nav=3,order=2,admin=1"))
+    parser.add_argument("--concurrency", type=int, default=8, help="threads posting to the webhook")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake API call")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="probability of a 429 reply")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--no-broadcast", dest="broadcast", action="store_false")
+    parser.add_argument("--broadcast-rate", type=float, default=1000.0, help="BROADCAST_RATE used during the run")
+    parser.add_argument("--config", type=json.loads, default={}, help="extra config.json keys as JSON")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary data directory")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--out", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_size(json.loads(args.worker))))
+        return
+
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("worker", "out")},
+        "runs": [],
+    }
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        opts = {"users": size, "orders": int(size * args.orders_per_user), "updates": args.updates, "mix": args.mix,
+                "concurrency": args.concurrency, "backend": args.backend, "latency": args.latency,
+                "jitter": args.jitter, "rate_limit": args.rate_limit, "retry_after": args.retry_after,
+                "broadcast": args.broadcast, "broadcast_rate": args.broadcast_rate, "config": args.config,
+                "timeout": args.timeout, "seed": args.seed, "keep": args.keep, "verbose": args.verbose}
+        print(f"[bench] {size} users / {opts['orders']} orders ...", file=sys.stderr)
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(opts)],
+                              cwd=BENCH_DIR, stdout=subprocess.PIPE, text=True)
+        if proc.returncode != 0 or not proc.stdout.strip():
+            report["runs"].append({"users": size, "error": f"worker exited with {proc.returncode}"})
+            continue
+        run = json.loads(proc.stdout.strip().splitlines()[-1])
+        if not args.keep:
+            shutil.rmtree(run.pop("workdir"), ignore_errors=True)
+        report["runs"].append(run)
+    out = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(out)
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+fake_telegram.py
+خادم محلي يحاكي Telegram Bot API لقياس أداء main.py دون الاتصال بتيليجرام.
+
+- كل طلب يتأخر LATENCY ثانية (مع تذبذب عشوائي بسيط)
+- بنسبة RATE_LIMIT_PROB يرد بـ 429 و retry_after مثل تيليجرام
+- يحفظ عدد الطلبات لكل method لتقرير المقارنة
+"""
+
+import json
+import random
+import threading
+import time
+import itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FakeTelegram:
+    """يشغل الخادم في خيط خلفي ويعيد API_URL المناسب لـ telebot.apihelper"""
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit_prob=0.0, retry_after=1, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}          # method -> count
+        self.rate_limited = 0
+        self.message_ids = itertools.count(1)
+        self.server = None
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, like api.telegram.org
+            disable_nagle_algorithm = True   # headers and body are separate writes
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                fake.handle(self)
+
+            do_GET = do_POST
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:%d/bot{0}/{1}" % self.server.server_address[1]
+
+    def handle(self, req):
+        method = req.path.rsplit("/", 1)[-1].split("?", 1)[0]
+        length = int(req.headers.get("Content-Length") or 0)
+        body = req.rfile.read(length) if length else b""
+        params = {}
+        if "urlencoded" in req.headers.get("Content-Type", ""):
+            params = {k: v[0] for k, v in parse_qs(body.decode("utf-8", "replace")).items()}
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            limited = self.rate_limit_prob and self.random.random() < self.rate_limit_prob
+            if limited:
+                self.rate_limited += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        if delay:
+            time.sleep(delay)
+        if limited:
+            status, payload = 429, {"ok": False, "error_code": 429,
+                                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                                    "parameters": {"retry_after": self.retry_after}}
+        else:
+            status, payload = 200, {"ok": True, "result": self.result(method, params)}
+        data = json.dumps(payload).encode("utf-8")
+        req.send_response(status)
+        req.send_header("Content-Type", "application/json")
+        req.send_header("Content-Length", str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    def result(self, method, params):
+        if not method.startswith(("send", "edit")):
+            return True
+        try:
+            chat_id = int(params.get("chat_id") or 1)
+        except ValueError:
+            chat_id = 1
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        if method == "sendPhoto":
+            msg["photo"] = [{"file_id": "BENCH_PHOTO", "file_unique_id": "bench", "width": 1, "height": 1}]
+        if method == "sendDocument":
+            msg["document"] = {"file_id": "BENCH_DOC", "file_unique_id": "bench"}
+        return msg
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "total_calls": sum(self.calls.values()), "rate_limited": self.rate_limited}
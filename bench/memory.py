@@ -0,0 +1,166 @@
+"""
+memory.py
+قياس ذاكرة USERS و ORDERS في main.py: قواميس JSON العادية مقابل السجلات المضغوطة
+(UserRecord / OrderRecord) على بيانات مصطنعة، مع التحقق من أن التحويل لا يفقد شيئاً.
+
+مثال:
+    python bench/memory.py --users 500000 --orders 1000000 --out memory.json
+
+القياس بـ tracemalloc: البيانات تُقرأ بـ json.loads كما يفعل load_json، ثم تُحوّل
+سجلاً سجلاً كما في JsonStorage، ويُقاس الفرق بعد تحرير القواميس.
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SERVICES = [("pubg", "شحن شدات PUBG"), ("ff", "شحن FreeFire"), ("google", "Google Play"), ("itunes", "iTunes")]
+NAMES = ["محمد", "أحمد", "علي", "سارة", "فاطمة", "Omar", "Ali", "John", "Layla", "Yousef"]
+
+
+def make_dataset(users, orders, seed):
+    """مثل bench.py لكن بمعرفات uuid4 وأسماء حقيقية الشكل وحقول last_seen/services"""
+    rnd = random.Random(seed)
+    now = datetime.now()
+    user_data = {}
+    for uid in range(1, users + 1):
+        first_seen = now - timedelta(days=rnd.randint(0, 365), seconds=rnd.randint(0, 86400), microseconds=rnd.randint(0, 999999))
+        user_data[str(uid)] = {"id": uid, "name": f"{rnd.choice(NAMES)} {rnd.choice(NAMES)} {uid}",
+                               "first_seen": first_seen.isoformat(), "awaiting": None,
+                               "lang": "ar" if rnd.random() < 0.8 else "en",
+                               "last_seen": (first_seen + timedelta(days=rnd.randint(0, 30))).isoformat(),
+                               "order_count": 0, "services": []}
+    order_data = []
+    for _ in range(orders):
+        uid = rnd.randint(1, max(1, users))
+        user = user_data[str(uid)]
+        button_id, button_text = rnd.choice(SERVICES)
+        created = now - timedelta(minutes=rnd.randint(0, 60 * 24 * 90), microseconds=rnd.randint(0, 999999))
+        status = rnd.choice(("pending", "pending", "approved", "rejected", "needs_more"))
+        order = {"order_id": str(uuid.UUID(int=rnd.getrandbits(128), version=4)), "user_id": uid,
+                 "user_name": user["name"], "button_id": button_id, "button_text": button_text,
+                 "info": f"ID: {rnd.randint(10 ** 8, 10 ** 10)} {rnd.choice(('660UC', '325UC', '1800UC'))}",
+                 "status": status, "created_at": created.isoformat(), "notes": ""}
+        if status in ("approved", "rejected"):
+            order["handled_at"] = (created + timedelta(minutes=rnd.randint(1, 600))).isoformat()
+        order_data.append(order)
+        user["order_count"] += 1
+        if button_id not in user["services"]:
+            user["services"].append(button_id)
+    return user_data, order_data
+
+def import_main(workdir):
+    # main.py reads config.json from the working directory at import time
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({"BOT_TOKEN": "123456:MEMORY", "WEBHOOK_URL": "http://127.0.0.1", "ADMIN_IDS": [999]}, f)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import main
+    main.ORDERS_READY.wait()
+    return main
+
+def traced(fn):
+    """ينفذ fn ويعيد (النتيجة، الذاكرة المتبقية بعده بالميجابايت، الزمن)"""
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    return result, (tracemalloc.get_traced_memory()[0] - before) / 2 ** 20, elapsed
+
+def measure(main, users_raw, orders_raw):
+    tracemalloc.start()
+    users, users_dict_mb, _ = traced(lambda: json.loads(users_raw))
+    orders, orders_dict_mb, _ = traced(lambda: json.loads(orders_raw))
+
+    def convert_users():
+        for uid in list(users):
+            users[uid] = main.UserRecord(users[uid])
+
+    def convert_orders():
+        for i, o in enumerate(orders):
+            orders[i] = main.OrderRecord(o)
+
+    # the conversion frees each dict as its record is built, so the delta is the saving
+    _, users_delta_mb, users_seconds = traced(convert_users)
+    _, orders_delta_mb, orders_seconds = traced(convert_orders)
+    tracemalloc.stop()
+    return users, orders, {
+        "users_dict_mb": round(users_dict_mb, 1),
+        "users_compact_mb": round(users_dict_mb + users_delta_mb, 1),
+        "orders_dict_mb": round(orders_dict_mb, 1),
+        "orders_compact_mb": round(orders_dict_mb + orders_delta_mb, 1),
+        "convert_users_seconds": round(users_seconds, 2),
+        "convert_orders_seconds": round(orders_seconds, 2),
+    }
+
+def check_lossless(users, orders, users_raw, orders_raw):
+    # json.dumps(record, default=dict) is what the journal, archive and export write
+    back_users = json.loads(json.dumps(users, ensure_ascii=False, default=dict))
+    back_orders = json.loads(json.dumps(orders, ensure_ascii=False, default=dict))
+    return back_users == json.loads(users_raw) and back_orders == json.loads(orders_raw)
+
+ACCESS_FIELDS = {
+    "plain": ("order_id", "user_id", "status", "button_text"),   # stored as is, interned or as a status number
+    "timestamp": ("created_at", "handled_at"),                   # decoded from integer microseconds on every read
+}
+
+def access_cost(main, sample):
+    """زمن قراءة الحقول الأكثر استخداماً (ميكروثانية لكل طلب) للقاموس والسجل، الحقول العادية والتواريخ كلٌّ على حدة"""
+    records = [main.OrderRecord(o) for o in sample]
+    result = {}
+    for group, fields in ACCESS_FIELDS.items():
+        for name, rows in (("dict_us", sample), ("compact_us", records)):
+            started = time.perf_counter()
+            for o in rows:
+                for f in fields:
+                    o.get(f)
+            result[f"{group}_{name}"] = round((time.perf_counter() - started) / len(rows) * 1e6, 2)
+    return result
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Memory of USERS/ORDERS: plain dicts vs compact records")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    users_data, orders_data = make_dataset(args.users, args.orders, args.seed)
+    users_raw = json.dumps(users_data, ensure_ascii=False)
+    orders_raw = json.dumps(orders_data, ensure_ascii=False)
+    del users_data, orders_data
+
+    workdir = tempfile.mkdtemp(prefix="bot-memory-")
+    try:
+        main = import_main(workdir)
+        users, orders, result = measure(main, users_raw, orders_raw)
+        result.update({"users": args.users, "orders": args.orders,
+                       "lossless": check_lossless(users, orders, users_raw, orders_raw),
+                       "order_field_access": access_cost(main, json.loads(orders_raw)[:20000])})
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    # main.py's worker threads are daemons; skip its atexit flushes of the temp dir
+    os._exit(0 if result["lossless"] else 1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -17,22 +17,54 @@ main.py
 """
 
 import os
+import re
+import sys
 import json
+import time
+import atexit
+import signal
 import logging
+import io
+import csv
+import gzip
+import zlib
+import hmac
+import tempfile
 import uuid
+import random
+import cProfile
+import pstats
+import functools
+import queue
+import bisect
+import heapq
+import itertools
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
 from datetime import datetime, timedelta
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+
+import requests
+from requests.adapters import HTTPAdapter
 
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
 
 # ----------------------------
 #  --- إعداد اللوجينج ----
 # ----------------------------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+STARTED_AT = time.monotonic()
 
 # ----------------------------
 #  --- ملفات الإعدادات -----
@@ -43,8 +75,131 @@ USERS_FILE = "users.json"
 ORDERS_FILE = "orders.json"
 ADMINS_FILE = "admins.json"
 SCHEDULES_FILE = "schedules.json"
+ORDERS_JOURNAL_FILE = "orders.journal.jsonl"   # سجل أحداث الطلبات (إضافة فقط)
+SQLITE_FILE = "bot.db"                          # يستخدم عند STORAGE_BACKEND = "sqlite"
+BROADCASTS_FILE = "broadcasts.json"             # حالة مهام البث (للاستكمال بعد إعادة التشغيل)
+SEEN_UPDATES_FILE = "seen_updates.json"         # آخر update_id تمت معالجتها (اختياري)
+LEADER_LOCK_FILE = "leader.lock"                # العملية التي تملك القفل تشغل الجدولة والبث المستأنف
+ARCHIVE_DIR = "archive"                         # أرشيف الطلبات المنتهية: orders-YYYY-MM.jsonl.gz
+
+# ----------------------------
+#  --- المقاييس (Prometheus /metrics) -----
+# ----------------------------
+# Hand-rolled instead of prometheus_client to avoid a dependency. Recording is a
+# bisect plus two additions under a lock, so it can sit on the hot path.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS = []   # every Counter / Histogram, in the order they are rendered
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.series = {}
+        self.lock = Lock()
+        METRICS.append(self)
+
+    def inc(self, labels=(), n=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + n
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in items]
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}   # labels -> [count per bucket..., count above last bucket, sum]
+        self.lock = Lock()
+        METRICS.append(self)
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            row = self.series.get(labels)
+            if row is None:
+                row = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    def render(self):
+        with self.lock:
+            items = sorted((labels, list(row)) for labels, row in self.series.items())
+        names = self.labelnames + ("le",)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, row in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {row[-1]:.6f}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Time to process one Telegram update", ("type",))
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time spent in a bot handler", ("handler",))
+FILE_IO_SECONDS = Histogram("bot_file_io_seconds", "save_json/load_json duration", ("op", "file"))
+FILE_IO_BYTES = Counter("bot_file_io_bytes_total", "Bytes read/written by save_json/load_json", ("op", "file"))
+LOCK_WAIT_SECONDS = Histogram("bot_lock_wait_seconds", "Time spent waiting to acquire a lock", ("lock",),
+                              buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+TELEGRAM_API_SECONDS = Histogram("bot_telegram_api_seconds", "Outbound Telegram Bot API call latency", ("method",))
+TELEGRAM_API_RESULTS = Counter("bot_telegram_api_results_total", "Outbound Telegram Bot API calls by result", ("method", "result"))
+SCHEDULER_JOB_SECONDS = Histogram("bot_scheduler_job_seconds", "Scheduled job runtime", ("job",))
+SCHEDULER_EVENTS = Counter("bot_scheduler_events_total", "Scheduler job executions, errors and misses", ("event",))
+FLOOD_DROPPED = Counter("bot_flood_dropped_total", "Updates dropped by per-chat flood control", ("type",))
+
+def timed_handler(label=None):
+    """يقيس زمن المعالج في HANDLER_SECONDS؛ label(*args) يضيف تفصيلاً مثل بادئة callback أو خطوة الجلسة"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            name = fn.__name__ if label is None else f"{fn.__name__}:{label(*args)}"
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                HANDLER_SECONDS.observe((name,), time.perf_counter() - started)
+        return inner
+    return wrap
+
+class TimedLock:
+    """Lock عادي يسجل زمن الانتظار قبل الحصول عليه"""
 
-file_lock = Lock()  # لحماية القراءة/الكتابة البسيطة
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        LOCK_WAIT_SECONDS.observe((self.name,), time.perf_counter() - started)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+FILE_LOCKS = {}           # path -> TimedLock
+FILE_LOCKS_GUARD = Lock()
+
+def file_lock(path):
+    """قفل خاص بكل ملف: كتابة orders.json الكبيرة لا توقف كتابة users.json"""
+    lock = FILE_LOCKS.get(path)
+    if lock is None:
+        with FILE_LOCKS_GUARD:
+            lock = FILE_LOCKS.setdefault(path, TimedLock(f"file:{os.path.basename(path)}"))
+    return lock
 
 # ----------------------------
 #  --- وظائف مساعدة للـ JSON -
@@ -55,23 +210,61 @@ def ensure_file(path, default):
             json.dump(default, f, ensure_ascii=False, indent=2)
 
 def load_json(path, default=None):
-    with file_lock:
+    with file_lock(path):
         if not os.path.exists(path):
             if default is None:
                 return None
             ensure_file(path, default)
             return default
+        started = time.perf_counter()
         with open(path, "r", encoding="utf-8") as f:
             try:
                 return json.load(f)
             except Exception as e:
                 logger.exception("Failed to load JSON %s: %s", path, e)
                 return default if default is not None else {}
+            finally:
+                name = os.path.basename(path)
+                FILE_IO_SECONDS.observe(("load", name), time.perf_counter() - started)
+                FILE_IO_BYTES.inc(("load", name), f.tell())
+
+def json_snapshot(data):
+    """نسخة من بنية JSON يمكن كتابتها بينما تستمر المعالجات في تعديل الأصل
+
+    each dict/list level is copied in one C call (atomic under the GIL), so the
+    pure-Python encoder json.dump(indent=2) uses never iterates a container that
+    another thread is changing ("dictionary changed size during iteration").
+    """
+    kind = type(data)
+    if kind is dict:
+        return {k: json_snapshot(v) if type(v) in SNAPSHOT_TYPES else v for k, v in list(data.items())}
+    if kind is list:
+        return [json_snapshot(v) if type(v) in SNAPSHOT_TYPES else v for v in list(data)]
+    if isinstance(data, CompactRecord):
+        out = data.to_dict()   # already a fresh dict: only nested values need copying
+        for k, v in out.items():
+            if type(v) in SNAPSHOT_TYPES:
+                out[k] = json_snapshot(v)
+        return out
+    return data
 
 def save_json(path, data):
-    with file_lock:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    # copy under the file's own lock: a later save always writes a later copy
+    with file_lock(path):
+        atomic_write_json(path, json_snapshot(data))
+
+def atomic_write_json(path, data):
+    # write to a temp file then rename, so a crash never leaves a truncated file
+    started = time.perf_counter()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+        name = os.path.basename(path)
+        FILE_IO_BYTES.inc(("save", name), f.tell())
+    os.replace(tmp, path)
+    FILE_IO_SECONDS.observe(("save", name), time.perf_counter() - started)
 
 # ----------------------------
 #  --- إعداد الملفات الافتراضية -
@@ -122,26 +315,2143 @@ DEFAULT_SCHEDULES = []
 # إنشاء الملفات إذا كانت مفقودة
 ensure_file(CONFIG_FILE, DEFAULT_CONFIG)
 ensure_file(BUTTONS_FILE, DEFAULT_BUTTONS)
-ensure_file(USERS_FILE, DEFAULT_USERS)
-ensure_file(ORDERS_FILE, DEFAULT_ORDERS)
-ensure_file(ADMINS_FILE, DEFAULT_ADMINS)
-ensure_file(SCHEDULES_FILE, DEFAULT_SCHEDULES)
 
 # ----------------------------
 #  --- تحميل الإعدادات -----
 # ----------------------------
 CONFIG = load_json(CONFIG_FILE, DEFAULT_CONFIG)
 BUTTONS = load_json(BUTTONS_FILE, DEFAULT_BUTTONS)
-USERS = load_json(USERS_FILE, DEFAULT_USERS)
-ORDERS = load_json(ORDERS_FILE, DEFAULT_ORDERS)
-ADMINS = load_json(ADMINS_FILE, DEFAULT_ADMINS)
-SCHEDULES = load_json(SCHEDULES_FILE, DEFAULT_SCHEDULES)
 
 BOT_TOKEN = CONFIG.get("BOT_TOKEN")
 WEBHOOK_URL = CONFIG.get("WEBHOOK_URL").rstrip("/")
 ADMIN_IDS = set(CONFIG.get("ADMIN_IDS", []))
 BOT_STATUS = CONFIG.get("BOT_STATUS", "on")
 ALLOW_LINKS = CONFIG.get("ALLOW_LINKS", False)
+ORDERS_COMPACT_EVERY = int(CONFIG.get("ORDERS_COMPACT_EVERY", 1000))  # عدد الأحداث قبل دمج السجل في orders.json
+JOURNAL_FSYNC = CONFIG.get("JOURNAL_FSYNC", True)
+STORAGE_BACKEND = CONFIG.get("STORAGE_BACKEND", "json")   # "json" أو "sqlite"
+SQLITE_PATH = CONFIG.get("SQLITE_PATH", SQLITE_FILE)
+USERS_FLUSH_INTERVAL = float(CONFIG.get("USERS_FLUSH_INTERVAL", 2.0))  # ثواني بين كل كتابة مجمعة لـ users.json
+USERS_FLUSH_MAX_DIRTY = int(CONFIG.get("USERS_FLUSH_MAX_DIRTY", 200))   # كتابة فورية عند هذا العدد من التعديلات
+BROADCAST_RATE = float(CONFIG.get("BROADCAST_RATE", 25))        # رسائل/ثانية (حد تيليجرام العام ~30)
+BROADCAST_WORKERS = int(CONFIG.get("BROADCAST_WORKERS", 4))
+BROADCAST_CHUNK = int(CONFIG.get("BROADCAST_CHUNK", 100))       # نقطة حفظ (checkpoint) بعد كل دفعة
+BROADCAST_MAX_RETRIES = int(CONFIG.get("BROADCAST_MAX_RETRIES", 5))
+BROADCAST_MAX_RATE_WAIT = float(CONFIG.get("BROADCAST_MAX_RATE_WAIT", 300))  # أقصى مجموع ثواني انتظار 429 لكل مستلم
+BROADCAST_KEEP_FINISHED = int(CONFIG.get("BROADCAST_KEEP_FINISHED", 20))    # عدد مهام البث المنتهية/الملغاة المحفوظة في السجل
+UPDATE_WORKERS = int(CONFIG.get("UPDATE_WORKERS", 8))           # عدد العمال لمعالجة التحديثات
+UPDATE_QUEUE_SIZE = int(CONFIG.get("UPDATE_QUEUE_SIZE", 1000))  # أقصى عدد تحديثات بالانتظار لكل عامل
+DEDUP_WINDOW_SECONDS = float(CONFIG.get("DEDUP_WINDOW_SECONDS", 3600))  # مدة تذكر update_id
+DEDUP_MAX_IDS = int(CONFIG.get("DEDUP_MAX_IDS", 100000))
+DEDUP_PERSIST = CONFIG.get("DEDUP_PERSIST", False)              # حفظ المعرفات في SEEN_UPDATES_FILE
+HTTP_POOL_SIZE = int(CONFIG.get("HTTP_POOL_SIZE", 32))           # اتصالات keep-alive مع api.telegram.org
+ADMIN_FANOUT_WORKERS = int(CONFIG.get("ADMIN_FANOUT_WORKERS", 8))
+ADMIN_SEND_TIMEOUT = float(CONFIG.get("ADMIN_SEND_TIMEOUT", 10))  # ثواني لكل أدمن
+SHARED_STATE = CONFIG.get("SHARED_STATE", False)               # True عند التشغيل بعدة عمليات (gunicorn -w N)
+SHARED_STATE_PATH = CONFIG.get("SHARED_STATE_PATH", SQLITE_PATH)
+CHAT_TURN_TIMEOUT = float(CONFIG.get("CHAT_TURN_TIMEOUT", 10))   # أقصى انتظار لتحديث سابق من نفس المحادثة في عملية أخرى
+PROFILE_SAMPLE_RATE = float(os.environ.get("BOT_PROFILE") or CONFIG.get("PROFILE_SAMPLE_RATE", 0.1))  # نسبة التحديثات المقاسة
+PROFILE_WINDOW = float(CONFIG.get("PROFILE_WINDOW", 300))     # ثواني قبل إصدار التقرير
+PROFILE_TOP = int(CONFIG.get("PROFILE_TOP", 30))              # عدد الدوال في التقرير
+SCHEDULE_MISFIRE = CONFIG.get("SCHEDULE_MISFIRE", "send")        # موعد فات أثناء التوقف: "send" يرسل متأخراً، "drop" يتجاهله
+LAST_SEEN_RESOLUTION = float(CONFIG.get("LAST_SEEN_RESOLUTION", 3600))  # ثواني؛ لا يُعاد حفظ last_seen أكثر من مرة خلالها
+SCHEDULE_MISFIRE_GRACE = float(CONFIG.get("SCHEDULE_MISFIRE_GRACE", 24 * 3600))  # ثواني؛ ما تأخر أكثر من ذلك يُتجاهل دائماً
+FLOOD_RATE = float(CONFIG.get("FLOOD_RATE", 1))                 # رسائل/ضغطات في الثانية لكل محادثة (0 = تعطيل)
+FLOOD_BURST = float(CONFIG.get("FLOOD_BURST", 5))               # عدد المسموح دفعة واحدة قبل تطبيق الحد
+FLOOD_NOTICE_COOLDOWN = float(CONFIG.get("FLOOD_NOTICE_COOLDOWN", 30))  # ثواني بين تنبيهين "تمهل" لنفس المحادثة
+FLOOD_MAX_CHATS = int(CONFIG.get("FLOOD_MAX_CHATS", 50000))     # أقصى عدد محادثات متتبعة في الذاكرة
+IMAGE_FETCH_TIMEOUT = float(CONFIG.get("IMAGE_FETCH_TIMEOUT", 15))  # ثواني لتحميل صورة زر بأنفسنا إذا فشل تيليجرام في جلبها
+EXPORT_TOKEN = CONFIG.get("EXPORT_TOKEN")   # مفتاح مسار /export/orders (بدونه المسار معطل)
+METRICS_TOKEN = CONFIG.get("METRICS_TOKEN")   # مفتاح مسار /metrics (Authorization: Bearer ...؛ بدونه المسار معطل)
+EXPORT_CHUNK_ROWS = int(CONFIG.get("EXPORT_CHUNK_ROWS", 500))   # عدد الصفوف في كل جزء من الاستجابة
+COMPACT_RECORDS = CONFIG.get("COMPACT_RECORDS", True)   # المستخدمون والطلبات في الذاكرة كسجلات مضغوطة (تخزين JSON)
+ARCHIVE_AFTER_DAYS = float(CONFIG.get("ARCHIVE_AFTER_DAYS", 30))   # الطلبات المقبولة/المرفوضة الأقدم من ذلك تنقل للأرشيف (0 = تعطيل)
+ARCHIVE_INTERVAL_HOURS = float(CONFIG.get("ARCHIVE_INTERVAL_HOURS", 24))  # كل كم ساعة تعمل الأرشفة
+ARCHIVE_DIR = CONFIG.get("ARCHIVE_DIR", ARCHIVE_DIR)
+
+# ----------------------------
+#  --- السجلات المضغوطة في الذاكرة (users / orders) -----
+# ----------------------------
+# With the JSON backend every user and order lives in memory. A plain dict per record
+# repeats its keys, keeps ISO timestamps as strings and a copy of user_name /
+# button_text per order. The records below behave like those dicts (get, [], update,
+# setdefault, dict(r), json.dumps(r, default=dict)) but store the known fields in
+# __slots__: timestamps as integer microseconds, statuses as small ints and repeated
+# names interned. order_id stays the same str object OrderIndex.by_id uses as key.
+# A value a codec cannot reproduce exactly is kept untouched in `extra`, so
+# conversion back to JSON is lossless.
+RAW = object()   # codec answer: keep the original value in extra
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+ORDER_STATUSES = ("pending", "approved", "rejected", "needs_more")
+
+def encode_ts(value):
+    if value is None:
+        return None
+    if type(value) is str:
+        try:
+            dt = datetime.fromisoformat(value)
+        except ValueError:
+            return RAW
+        # only strings isoformat() gives back unchanged
+        if dt.tzinfo is None and dt.isoformat() == value:
+            # same as (dt - EPOCH) // timedelta(microseconds=1), without two temporaries
+            return (((dt.toordinal() - EPOCH_ORDINAL) * 86400 + dt.hour * 3600 + dt.minute * 60
+                     + dt.second) * 1000000 + dt.microsecond)
+    return RAW
+
+def decode_ts(value):
+    return None if value is None else (EPOCH + timedelta(microseconds=value)).isoformat()
+
+def encode_status(value):
+    return ORDER_STATUSES.index(value) if value in ORDER_STATUSES else RAW
+
+def intern_str(value):
+    return sys.intern(value) if type(value) is str else value
+
+def intern_list(value):
+    # in place: callers append to the list they got from setdefault()
+    if type(value) is list:
+        value[:] = [intern_str(v) for v in value]
+    return value
+
+PLAIN = (None, None)
+INTERNED = (intern_str, None)
+TIMESTAMP = (encode_ts, decode_ts)
+
+class CompactRecord(MutableMapping):
+    """سجل بشكل dict: الحقول المعروفة في __slots__ مرمّزة، وما عداها في extra"""
+
+    __slots__ = ("extra",)
+    CODECS = {}   # field -> (encode, decode); None means the value is stored as is
+
+    def __init__(self, data=()):
+        self.extra = None
+        codecs = self.CODECS
+        for key, value in (data.items() if isinstance(data, Mapping) else data):
+            codec = codecs.get(key)
+            if codec is not None:
+                encoded = codec[0](value) if codec[0] else value
+                if encoded is not RAW:
+                    setattr(self, key, encoded)
+                    continue
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __getitem__(self, key):
+        codec = self.CODECS.get(key)
+        if codec is not None:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                pass
+            else:
+                return codec[1](value) if codec[1] else value
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        # hot path (every handler reads orders/users through get): no exceptions
+        codec = self.CODECS.get(key)
+        if codec is not None:
+            value = getattr(self, key, RAW)
+            if value is not RAW:
+                return codec[1](value) if codec[1] else value
+        extra = self.extra
+        return default if extra is None else extra.get(key, default)
+
+    def __setitem__(self, key, value):
+        codec = self.CODECS.get(key)
+        if codec is not None:
+            encoded = codec[0](value) if codec[0] else value
+            if encoded is not RAW:
+                setattr(self, key, encoded)
+                if self.extra and key in self.extra:
+                    del self.extra[key]
+                return
+            if hasattr(self, key):
+                delattr(self, key)
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        found = False
+        if key in self.CODECS and hasattr(self, key):
+            delattr(self, key)
+            found = True
+        if self.extra and key in self.extra:
+            del self.extra[key]
+            found = True
+        if not found:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return (key in self.CODECS and hasattr(self, key)) or bool(self.extra and key in self.extra)
+
+    def __iter__(self):
+        for key in self.CODECS:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return sum(1 for key in self.CODECS if hasattr(self, key)) + len(self.extra or ())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+    def to_dict(self):
+        # unlike dict(self), never fails when another thread drops a key from extra mid-copy
+        out = {}
+        for key, codec in self.CODECS.items():
+            value = getattr(self, key, RAW)
+            if value is not RAW:
+                out[key] = codec[1](value) if codec[1] else value
+        extra = self.extra
+        if extra:
+            out.update(extra)
+        return out
+
+class OrderRecord(CompactRecord):
+    CODECS = {"order_id": PLAIN, "user_id": PLAIN, "user_name": INTERNED,
+              "button_id": INTERNED, "button_text": INTERNED, "info": PLAIN,
+              "status": (encode_status, ORDER_STATUSES.__getitem__),
+              "created_at": TIMESTAMP, "handled_at": TIMESTAMP, "notes": INTERNED}
+    __slots__ = tuple(CODECS)
+
+class UserRecord(CompactRecord):
+    CODECS = {"id": PLAIN, "name": PLAIN, "first_seen": TIMESTAMP, "last_seen": TIMESTAMP,
+              "awaiting": PLAIN, "lang": INTERNED, "order_count": PLAIN, "services": (intern_list, None)}
+    __slots__ = tuple(CODECS)
+
+def compact_order(order):
+    return OrderRecord(order) if COMPACT_RECORDS and not isinstance(order, CompactRecord) else order
+
+def compact_user(user):
+    return UserRecord(user) if COMPACT_RECORDS and not isinstance(user, CompactRecord) else user
+
+SNAPSHOT_TYPES = {dict, list, OrderRecord, UserRecord}   # what json_snapshot() copies
+
+# ----------------------------
+#  --- سجل الطلبات (append-only journal) -----
+# ----------------------------
+# orders.json is only a snapshot; every order creation / status change is appended
+# as one JSON line to ORDERS_JOURNAL_FILE. On startup the journal is replayed on top
+# of the snapshot, and every ORDERS_COMPACT_EVERY events it is folded back into
+# orders.json in a background thread.
+journal_lock = TimedLock("journal")
+journal_events = 0      # events appended since the last compaction
+journal_compacting = False
+ORDERS_READY = threading.Event()   # set once the order history, stats and user index are loaded
+
+def _journal_paths():
+    # the ".1" file holds events that are being folded into the snapshot right now
+    return [ORDERS_JOURNAL_FILE + ".1", ORDERS_JOURNAL_FILE]
+
+def apply_order_event(orders, by_id, event):
+    op = event.get("op")
+    if op == "create":
+        order = event.get("order") or {}
+        # replay must be idempotent: the snapshot may already contain this order
+        if order.get("order_id") in by_id:
+            return
+        orders.append(order)
+        by_id[order.get("order_id")] = order
+    elif op == "update":
+        order = by_id.get(event.get("order_id"))
+        if order is not None:
+            order.update(event.get("fields", {}))
+    elif op == "archive":
+        # the orders were written to ARCHIVE_DIR before this event was appended
+        archived = set(event.get("order_ids") or ())
+        orders[:] = [o for o in orders if o.get("order_id") not in archived]
+        for order_id in archived:
+            by_id.pop(order_id, None)
+
+def replay_orders_journal(orders):
+    """يعيد تطبيق أحداث السجل فوق آخر نسخة من orders.json ويعيد عدد الأحداث المطبقة"""
+    by_id = {o.get("order_id"): o for o in orders}
+    applied = 0
+    for path in _journal_paths():
+        if not os.path.exists(path):
+            continue
+        good_offset = 0
+        with open(path, "rb") as f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    # torn write from a crash: keep everything before it
+                    logger.warning("Ignoring incomplete journal line in %s", path)
+                    break
+                try:
+                    event = json.loads(raw.decode("utf-8"))
+                except Exception:
+                    logger.warning("Ignoring corrupt journal line in %s", path)
+                    break
+                apply_order_event(orders, by_id, event)
+                good_offset += len(raw)
+                applied += 1
+        if good_offset < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_offset)
+    return applied
+
+def append_order_event(event):
+    global journal_events
+    line = json.dumps(event, ensure_ascii=False, default=dict) + "\n"
+    with journal_lock:
+        with open(ORDERS_JOURNAL_FILE, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(f.fileno())
+        journal_events += 1
+        due = journal_events >= ORDERS_COMPACT_EVERY and not journal_compacting
+    if due:
+        threading.Thread(target=compact_orders_journal, name="orders-compact", daemon=True).start()
+
+def compact_orders_journal():
+    """يدمج السجل في orders.json (نسخة كاملة) ثم يحذف الأحداث المدمجة"""
+    global journal_events, journal_compacting
+    if not ORDERS_READY.is_set():
+        return   # never snapshot a partially loaded history over orders.json
+    rotated = ORDERS_JOURNAL_FILE + ".1"
+    with journal_lock:
+        if journal_compacting:
+            return
+        journal_compacting = True
+        # new events go to a fresh journal while the snapshot is being written
+        if os.path.exists(ORDERS_JOURNAL_FILE) and not os.path.exists(rotated):
+            os.replace(ORDERS_JOURNAL_FILE, rotated)
+        # only the list is copied here; add_order/update_order keep appending events
+        # while the records are copied and written. Changes that land after the
+        # rotation are in the new journal too, and replaying them is idempotent.
+        orders = list(ORDERS)
+        journal_events = 0
+    try:
+        with file_lock(ORDERS_FILE):
+            atomic_write_json(ORDERS_FILE, json_snapshot(orders))
+        if os.path.exists(rotated):
+            os.remove(rotated)
+    except Exception as e:
+        logger.exception("Failed to compact orders journal: %s", e)
+    finally:
+        with journal_lock:
+            journal_compacting = False
+
+# ----------------------------
+#  --- الكتابة المؤجلة (write-behind) -----
+# ----------------------------
+class WriteBehind:
+    """يجمع مفاتيح السجلات المعدلة ويكتبها دفعة واحدة كل interval ثانية أو عند max_dirty تعديل"""
+
+    def __init__(self, name, flush_fn, interval, max_dirty):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.dirty = set()
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.wake = threading.Event()
+        self.stats = {"flushes": 0, "records": 0, "last_batch": 0, "last_seconds": 0.0,
+                      "max_seconds": 0.0, "total_seconds": 0.0, "errors": 0}
+        threading.Thread(target=self._run, name=f"flush-{name}", daemon=True).start()
+
+    def mark(self, key):
+        with self.lock:
+            self.dirty.add(key)
+            full = len(self.dirty) >= self.max_dirty
+        if full:
+            self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.dirty = self.dirty, set()
+            if not batch:
+                return
+            start = time.monotonic()
+            try:
+                self.flush_fn(batch)
+            except Exception as e:
+                logger.exception("Write-behind flush of %s failed: %s", self.name, e)
+                self.stats["errors"] += 1
+                with self.lock:
+                    self.dirty |= batch
+                return
+            elapsed = time.monotonic() - start
+            st = self.stats
+            st["flushes"] += 1
+            st["records"] += len(batch)
+            st["last_batch"] = len(batch)
+            st["last_seconds"] = elapsed
+            st["max_seconds"] = max(st["max_seconds"], elapsed)
+            st["total_seconds"] += elapsed
+            logger.debug("Flushed %d dirty %s in %.3fs", len(batch), self.name, elapsed)
+
+WRITERS = []   # كل WriteBehind يتم تفريغه عند الإيقاف
+
+def flush_all_writers():
+    for w in WRITERS:
+        w.flush()
+
+atexit.register(flush_all_writers)
+
+# ----------------------------
+#  --- فهارس الطلبات في الذاكرة -----
+# ----------------------------
+class OrderIndex:
+    """فهرس order_id -> طلب مع فهارس ثانوية حسب user_id و status و الخدمة
+
+    every order gets an increasing sequence number (its position in creation order);
+    the secondary indexes keep sorted lists of those numbers so "latest N" is a slice.
+    """
+
+    def __init__(self, orders=()):
+        self.lock = threading.RLock()
+        self.rebuild(orders)
+
+    def rebuild(self, orders):
+        with self.lock:
+            self.by_id = {}        # order_id -> seq
+            self.by_seq = {}       # seq -> order
+            self.live = []         # seqs of the orders still indexed (sorted)
+            self.by_user = {}      # user_id -> [seq, ...]
+            self.by_status = {}    # status -> [seq, ...] (sorted)
+            self.by_service = {}   # button_id -> [seq, ...]
+            self.next_seq = 0
+            for o in orders:
+                self.add(o)
+
+    def add(self, order):
+        with self.lock:
+            if order.get("order_id") in self.by_id:
+                return
+            seq = self.next_seq
+            self.next_seq += 1
+            self.by_id[order.get("order_id")] = seq
+            self.by_seq[seq] = order
+            self.live.append(seq)
+            self.by_user.setdefault(order.get("user_id"), []).append(seq)
+            self.by_status.setdefault(order.get("status"), []).append(seq)
+            self.by_service.setdefault(order.get("button_id"), []).append(seq)
+
+    def status_changed(self, order, old_status):
+        with self.lock:
+            seq = self.by_id.get(order.get("order_id"))
+            if seq is None or old_status == order.get("status"):
+                return
+            old = self.by_status.get(old_status, [])
+            i = bisect.bisect_left(old, seq)
+            if i < len(old) and old[i] == seq:
+                old.pop(i)
+            bisect.insort(self.by_status.setdefault(order.get("status"), []), seq)
+
+    def remove_many(self, orders):
+        # archived orders keep no seq; the remaining seqs stay as they are so open
+        # order browser cursors still point at the right place
+        with self.lock:
+            dead = {}
+            for order in orders:
+                seq = self.by_id.pop(order.get("order_id"), None)
+                if seq is not None:
+                    self.by_seq.pop(seq, None)
+                    dead[seq] = order
+            if dead:
+                self.live = [s for s in self.live if s not in dead]
+            for index, field in ((self.by_user, "user_id"), (self.by_status, "status"), (self.by_service, "button_id")):
+                for key in {o.get(field) for o in dead.values()}:
+                    seqs = [s for s in index.get(key, []) if s not in dead]
+                    if seqs:
+                        index[key] = seqs
+                    else:
+                        index.pop(key, None)
+
+    def get(self, order_id):
+        seq = self.by_id.get(order_id)
+        return self.by_seq.get(seq) if seq is not None else None
+
+    def latest(self, seqs, limit):
+        with self.lock:
+            return [self.by_seq[s] for s in seqs[-limit:][::-1]]
+
+    def for_user(self, user_id, limit):
+        return self.latest(self.by_user.get(user_id, []), limit)
+
+    def page(self, status=None, button_id=None, user_id=None, before=None, after=None, limit=10):
+        """صفحة من الطلبات (الأحدث أولاً) بمؤشر seq بدل نسخ القائمة كاملة
+
+        returns ([(seq, order), ...], has_older, has_newer); walks the smallest matching
+        index from the cursor and checks the other filters on the orders it visits.
+        """
+        filters = (("status", status), ("button_id", button_id), ("user_id", user_id))
+        with self.lock:
+            candidates = None
+            for index, key in ((self.by_status, status), (self.by_service, button_id), (self.by_user, user_id)):
+                if key is not None:
+                    seqs = index.get(key, [])
+                    if candidates is None or len(seqs) < len(candidates):
+                        candidates = seqs
+            if candidates is None:
+                candidates = self.live
+
+            def matches(seq):
+                order = self.by_seq.get(seq)
+                return order is not None and all(v is None or order.get(k) == v for k, v in filters)
+
+            rows = []
+            if after is not None:
+                i = bisect.bisect_right(candidates, after)
+                while i < len(candidates) and len(rows) <= limit:
+                    if matches(candidates[i]):
+                        rows.append(candidates[i])
+                    i += 1
+                has_newer, has_older = len(rows) > limit, True
+                rows = rows[:limit][::-1]
+            else:
+                i = bisect.bisect_left(candidates, before) if before is not None else len(candidates)
+                while i > 0 and len(rows) <= limit:
+                    i -= 1
+                    if matches(candidates[i]):
+                        rows.append(candidates[i])
+                has_older, has_newer = len(rows) > limit, before is not None
+                rows = rows[:limit]
+            return [(seq, self.by_seq[seq]) for seq in rows], has_older, has_newer
+
+def load_orders_with_journal():
+    orders = load_json(ORDERS_FILE, DEFAULT_ORDERS)
+    replay_orders_journal(orders)
+    return orders
+
+# ----------------------------
+#  --- طبقة التخزين (JSON أو SQLite) -----
+# ----------------------------
+# Both backends expose the same attributes (users, orders, admins, schedules) and the
+# same methods; handlers only go through the module-level helpers further below.
+class JsonStorage:
+    """التخزين الافتراضي: ملفات JSON كما هي + سجل الطلبات"""
+
+    name = "json"
+
+    def __init__(self):
+        self.users = load_json(USERS_FILE, DEFAULT_USERS)
+        if COMPACT_RECORDS:
+            for uid in list(self.users):
+                self.users[uid] = UserRecord(self.users[uid])
+        self.orders = []   # filled by load_orders() in the background at startup
+        self.order_index = OrderIndex(self.orders)
+        self.orders_lock = TimedLock("orders")   # add_order vs. archival rewriting the list
+        self.admins = self.load_admins()
+        self.schedules = self.load_schedules()
+        self.users_writer = WriteBehind("users", self._flush_users, USERS_FLUSH_INTERVAL, USERS_FLUSH_MAX_DIRTY)
+        WRITERS.append(self.users_writer)
+
+    def save_user(self, uid, user):
+        self.users[uid] = compact_user(user)
+        self.users_writer.mark(uid)
+
+    def iter_user_ids(self, after=None):
+        """المعرفات مرتبة؛ after: تبدأ بعد هذا المعرف (استئناف البث)"""
+        # list() of the keys is atomic, iterating the live dict is not
+        ids = sorted(list(self.users))
+        return iter(ids[bisect.bisect_right(ids, after):] if after is not None else ids)
+
+    def iter_users(self):
+        return iter(list(self.users.items()))
+
+    def _flush_users(self, dirty):
+        # users.json is a single document, so one batch means one rewrite of it;
+        # handlers keep mutating USERS while the snapshot is written
+        with file_lock(USERS_FILE):
+            atomic_write_json(USERS_FILE, json_snapshot(self.users))
+
+    def add_order(self, order):
+        order = compact_order(order)
+        with self.orders_lock:
+            self.orders.append(order)
+        self.order_index.add(order)
+        append_order_event({"op": "create", "order": order})
+
+    def update_order(self, order, fields):
+        old_status = order.get("status")
+        order.update(fields)
+        self.order_index.status_changed(order, old_status)
+        append_order_event({"op": "update", "order_id": order.get("order_id"), "fields": fields})
+
+    def _load_orders(self):
+        orders = load_orders_with_journal()
+        if COMPACT_RECORDS:
+            # one at a time, so the dicts are freed while the records are built
+            for i, o in enumerate(orders):
+                orders[i] = OrderRecord(o)
+        return orders
+
+    def load_orders(self):
+        orders = self._load_orders()
+        self.order_index.rebuild(orders)
+        self.orders[:] = orders   # in place: ORDERS refers to this list
+
+    def archivable_orders(self, cutoff):
+        return [o for o in list(self.orders) if is_archivable(o, cutoff)]
+
+    def snapshot_orders(self):
+        # list() is atomic; archival replaces the contents of self.orders in place
+        return list(self.orders)
+
+    def order_ids(self, orders=None):
+        """order_ids of a snapshot_orders() list (the live list by default)"""
+        return {o.get("order_id") for o in (self.snapshot_orders() if orders is None else orders)}
+
+    def iter_orders(self, status=None, button_id=None, since=None, until=None, orders=None):
+        """orders: a snapshot_orders() list to read instead of the live one"""
+        for o in self.snapshot_orders() if orders is None else orders:
+            if order_matches(o, status, button_id, since, until):
+                yield o
+
+    def drop_orders(self, orders):
+        archived = {o.get("order_id") for o in orders}
+        # list first, event second: a compaction running in between must not
+        # snapshot the archived orders after swallowing the event
+        with self.orders_lock:
+            self.orders[:] = [o for o in self.orders if o.get("order_id") not in archived]
+        self.order_index.remove_many(orders)
+        append_order_event({"op": "archive", "order_ids": sorted(archived)})
+        # fold the shrunken list into orders.json right away instead of waiting for the
+        # next compaction; in the background, so orders_snapshot() is not held up by it
+        threading.Thread(target=compact_orders_journal, name="orders-compact", daemon=True).start()
+
+    def get_order(self, order_id):
+        return self.order_index.get(order_id)
+
+    def user_orders(self, user_id, limit):
+        return self.order_index.for_user(user_id, limit)
+
+    def order_page(self, status=None, button_id=None, user_id=None, before=None, after=None, limit=10):
+        return self.order_index.page(status, button_id, user_id, before, after, limit)
+
+    def count_orders(self):
+        return len(self.orders)
+
+    def load_admins(self):
+        return load_json(ADMINS_FILE, DEFAULT_ADMINS)
+
+    def load_schedules(self):
+        return load_json(SCHEDULES_FILE, DEFAULT_SCHEDULES)
+
+    def save_admins(self):
+        save_json(ADMINS_FILE, self.admins)
+
+    def save_schedules(self):
+        save_json(SCHEDULES_FILE, self.schedules)
+
+    def save_all(self):
+        self.users_writer.flush()
+        compact_orders_journal()
+        self.save_admins()
+        self.save_schedules()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT NOT NULL UNIQUE,
+    user_id INTEGER,
+    button_id TEXT,
+    button_text TEXT,
+    status TEXT,
+    created_at TEXT,
+    handled_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
+CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at);
+CREATE TABLE IF NOT EXISTS admins (
+    id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS schedules (
+    id TEXT PRIMARY KEY,
+    time TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_schedules_time ON schedules(time);
+"""
+
+class SqliteUsers(MutableMapping):
+    """عرض لجدول users على شكل dict (بدون تحميل كل المستخدمين في الذاكرة)"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getitem__(self, uid):
+        row = self.storage.conn().execute("SELECT data FROM users WHERE id = ?", (str(uid),)).fetchone()
+        if row is None:
+            raise KeyError(uid)
+        return json.loads(row[0])
+
+    def __setitem__(self, uid, user):
+        with self.storage.conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)",
+                         (str(uid), json.dumps(user, ensure_ascii=False)))
+
+    def __delitem__(self, uid):
+        with self.storage.conn() as conn:
+            if conn.execute("DELETE FROM users WHERE id = ?", (str(uid),)).rowcount == 0:
+                raise KeyError(uid)
+
+    def __contains__(self, uid):
+        return self.storage.conn().execute("SELECT 1 FROM users WHERE id = ?", (str(uid),)).fetchone() is not None
+
+    def __iter__(self):
+        # keyset pagination keeps memory flat while streaming every id
+        last = ""
+        while True:
+            rows = self.storage.conn().execute(
+                "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT 1000", (last,)).fetchall()
+            if not rows:
+                return
+            for (uid,) in rows:
+                yield uid
+            last = rows[-1][0]
+
+    def __len__(self):
+        return self.storage.conn().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+
+class SqliteOrders:
+    """عرض لجدول orders يدعم len و التكرار و append فقط"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __len__(self):
+        return self.storage.count_orders()
+
+    def __iter__(self):
+        last = 0
+        while True:
+            rows = self.storage.conn().execute(
+                "SELECT seq, data FROM orders WHERE seq > ? ORDER BY seq LIMIT 500", (last,)).fetchall()
+            if not rows:
+                return
+            for _, data in rows:
+                yield json.loads(data)
+            last = rows[-1][0]
+
+    def append(self, order):
+        self.storage.add_order(order)
+
+
+class SqliteStorage:
+    """تخزين SQLite (WAL) مع فهارس على order_id و user_id و status و created_at"""
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self.conn()
+        conn.executescript(SQLITE_SCHEMA)
+        # databases created before button_id became a column
+        if "button_id" not in {r[1] for r in conn.execute("PRAGMA table_info(orders)")}:
+            conn.execute("ALTER TABLE orders ADD COLUMN button_id TEXT")
+            conn.execute("UPDATE orders SET button_id = json_extract(data, '$.button_id')")
+            conn.commit()
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_button ON orders(button_id)")
+        self.users = SqliteUsers(self)
+        self.orders = SqliteOrders(self)
+        # admins and schedules are tiny, so they stay in memory like the JSON backend
+        self.admins = self.load_admins()
+        self.schedules = self.load_schedules()
+
+    def load_orders(self):
+        pass   # orders are queried from the table on demand
+
+    def load_admins(self):
+        rows = self.conn().execute("SELECT data FROM admins ORDER BY rowid").fetchall()
+        return {"admins": [json.loads(r[0]) for r in rows]}
+
+    def load_schedules(self):
+        rows = self.conn().execute("SELECT data FROM schedules ORDER BY time").fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def conn(self):
+        # sqlite3 connections are not shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def save_user(self, uid, user):
+        self.users[uid] = user
+
+    def iter_user_ids(self, after=None):
+        # keyset pagination in id order, like SqliteUsers.__iter__
+        last = "" if after is None else str(after)
+        while True:
+            rows = self.conn().execute("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT 1000", (last,)).fetchall()
+            if not rows:
+                return
+            for (uid,) in rows:
+                yield uid
+            last = rows[-1][0]
+
+    def iter_users(self):
+        last = ""
+        while True:
+            rows = self.conn().execute(
+                "SELECT id, data FROM users WHERE id > ? ORDER BY id LIMIT 1000", (last,)).fetchall()
+            if not rows:
+                return
+            for uid, data in rows:
+                yield uid, json.loads(data)
+            last = rows[-1][0]
+
+    def _order_row(self, order):
+        return (order.get("user_id"), order.get("button_id"), order.get("button_text"), order.get("status"),
+                order.get("created_at"), order.get("handled_at"),
+                json.dumps(order, ensure_ascii=False), order.get("order_id"))
+
+    def add_order(self, order):
+        with self.conn() as conn:
+            conn.execute("INSERT OR IGNORE INTO orders (user_id, button_id, button_text, status, created_at, handled_at, data, order_id) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._order_row(order))
+
+    def update_order(self, order, fields):
+        order.update(fields)
+        with self.conn() as conn:
+            conn.execute("UPDATE orders SET user_id = ?, button_id = ?, button_text = ?, status = ?, created_at = ?, handled_at = ?, data = ? "
+                         "WHERE order_id = ?", self._order_row(order))
+
+    def get_order(self, order_id):
+        row = self.conn().execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def user_orders(self, user_id, limit):
+        rows = self.conn().execute("SELECT data FROM orders WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+                                   (user_id, limit)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def order_page(self, status=None, button_id=None, user_id=None, before=None, after=None, limit=10):
+        # seq is the rowid, so the status/user_id/button_id indexes already order by it
+        where, args = [], []
+        for column, value in (("status", status), ("button_id", button_id), ("user_id", user_id)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                args.append(value)
+        if after is not None:
+            where.append("seq > ?")
+            args.append(after)
+        elif before is not None:
+            where.append("seq < ?")
+            args.append(before)
+        sql = "SELECT seq, data FROM orders"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY seq " + ("ASC" if after is not None else "DESC") + " LIMIT ?"
+        rows = self.conn().execute(sql, args + [limit + 1]).fetchall()
+        more = len(rows) > limit
+        rows = [(seq, json.loads(data)) for seq, data in rows[:limit]]
+        if after is not None:
+            return rows[::-1], True, more
+        return rows, more, before is not None
+
+    def count_orders(self):
+        return self.conn().execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def snapshot_orders(self):
+        # rows are paged straight from the table; there is no list to copy
+        return self.orders
+
+    def order_ids(self, orders=None):
+        return {row[0] for row in self.conn().execute("SELECT order_id FROM orders")}
+
+    def iter_orders(self, status=None, button_id=None, since=None, until=None, orders=None):
+        # `orders` (a JSON backend snapshot) is not needed: the filters run in SQL.
+        # created_at is an ISO string, so a date prefix range is a plain string range
+        where, args = ["seq > ?"], []
+        for column, op, value in (("status", "=", status), ("button_id", "=", button_id),
+                                  ("created_at", ">=", since), ("created_at", "<", until and until + "\uffff")):
+            if value is not None:
+                where.append(f"{column} {op} ?")
+                args.append(value)
+        sql = "SELECT seq, data FROM orders WHERE " + " AND ".join(where) + " ORDER BY seq LIMIT 500"
+        last = 0
+        while True:
+            rows = self.conn().execute(sql, [last] + args).fetchall()
+            if not rows:
+                return
+            for _, data in rows:
+                yield json.loads(data)
+            last = rows[-1][0]
+
+    def orders_after(self, seq):
+        while True:
+            rows = self.conn().execute("SELECT seq, data FROM orders WHERE seq > ? ORDER BY seq LIMIT 1000", (seq,)).fetchall()
+            if not rows:
+                return
+            for seq, data in rows:
+                yield seq, json.loads(data)
+
+    def users_after(self, rowid):
+        # INSERT OR REPLACE moves a rewritten user to a new rowid, so updates show up here as well
+        while True:
+            rows = self.conn().execute("SELECT rowid, id, data FROM users WHERE rowid > ? ORDER BY rowid LIMIT 1000", (rowid,)).fetchall()
+            if not rows:
+                return
+            for rowid, uid, data in rows:
+                yield rowid, uid, json.loads(data)
+
+    def archivable_orders(self, cutoff):
+        rows = self.conn().execute(
+            "SELECT data FROM orders WHERE status IN (%s) AND COALESCE(handled_at, created_at) < ? ORDER BY seq"
+            % ", ".join("?" * len(ARCHIVE_STATUSES)), ARCHIVE_STATUSES + (cutoff,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def drop_orders(self, orders):
+        with self.conn() as conn:
+            conn.executemany("DELETE FROM orders WHERE order_id = ?", [(o.get("order_id"),) for o in orders])
+
+    def save_admins(self):
+        with self.conn() as conn:
+            conn.execute("DELETE FROM admins")
+            conn.executemany("INSERT OR REPLACE INTO admins (id, data) VALUES (?, ?)",
+                             [(a.get("id"), json.dumps(a, ensure_ascii=False)) for a in self.admins.get("admins", [])])
+
+    def save_schedules(self):
+        with self.conn() as conn:
+            conn.execute("DELETE FROM schedules")
+            conn.executemany("INSERT OR REPLACE INTO schedules (id, time, data) VALUES (?, ?, ?)",
+                             [(e.get("id"), e.get("time"), json.dumps(e, ensure_ascii=False)) for e in self.schedules])
+
+    def save_all(self):
+        self.save_admins()
+        self.save_schedules()
+
+
+def open_storage(backend):
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_PATH)
+    if backend != "json":
+        logger.warning("Unknown STORAGE_BACKEND %r, falling back to json", backend)
+    return JsonStorage()
+
+def migrate_json_to_sqlite(db_path=SQLITE_PATH):
+    """ينقل users.json و orders.json (مع السجل) و admins.json و schedules.json إلى SQLite مرة واحدة"""
+    target = SqliteStorage(db_path)
+    users = load_json(USERS_FILE, DEFAULT_USERS)
+    with target.conn() as conn:
+        conn.executemany("INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)",
+                         [(str(uid), json.dumps(u, ensure_ascii=False)) for uid, u in users.items()])
+    orders = load_orders_with_journal()
+    with target.conn() as conn:
+        conn.executemany("INSERT OR IGNORE INTO orders (user_id, button_id, button_text, status, created_at, handled_at, data, order_id) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [target._order_row(o) for o in orders])
+    target.admins = load_json(ADMINS_FILE, DEFAULT_ADMINS)
+    target.schedules = load_json(SCHEDULES_FILE, DEFAULT_SCHEDULES)
+    target.save_admins()
+    target.save_schedules()
+    logger.info("Migrated %d users and %d orders to %s", len(users), len(orders), db_path)
+    return len(users), len(orders)
+
+if __name__ == "__main__" and sys.argv[1:2] == ["migrate-sqlite"]:
+    # python main.py migrate-sqlite [bot.db] ثم ضع "STORAGE_BACKEND": "sqlite" في config.json
+    # runs before the storage, scheduler, workers and leader duties start, so nothing else touches the JSON files
+    migrate_json_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else SQLITE_PATH)
+    raise SystemExit(0)
+
+STORAGE = open_storage(STORAGE_BACKEND)
+USERS = STORAGE.users
+ORDERS = STORAGE.orders
+ADMINS = STORAGE.admins
+SCHEDULES = STORAGE.schedules
+
+def save_user(uid, user):
+    STORAGE.save_user(uid, user)
+    USER_INDEX.update(uid, user)
+    SEARCH.update_user(uid, user)
+
+def add_order(order, user=None):
+    """user: the caller's copy of the ordering user, if it has one. With SQLite every
+    USERS.get() is a fresh copy, so the counters must go onto the record that gets saved."""
+    ORDERS_READY.wait()
+    STORAGE.add_order(order)
+    STATS.order_created(order)
+    SEARCH.add_order(order)
+    uid = str(order.get("user_id"))
+    if user is None:
+        user = USERS.get(uid)
+    if user is not None:
+        user["order_count"] = user.get("order_count", 0) + 1
+        services = user.setdefault("services", [])
+        if order.get("button_id") and order["button_id"] not in services:
+            services.append(order["button_id"])
+        save_user(uid, user)
+
+def update_order(order, **fields):
+    ORDERS_READY.wait()
+    old = {k: order.get(k) for k in ("status", "created_at", "handled_at")}
+    STORAGE.update_order(order, fields)
+    STATS.order_updated(order, old)
+    if not SEARCH_ORDER_FIELDS.isdisjoint(fields):
+        SEARCH.update_order(order)
+
+def get_order(order_id):
+    ORDERS_READY.wait()
+    return STORAGE.get_order(order_id)
+
+def user_orders(user_id, limit=10):
+    ORDERS_READY.wait()
+    return STORAGE.user_orders(user_id, limit)
+
+def save_admins():
+    STORAGE.save_admins()
+    publish_change("admins")
+
+def save_schedules():
+    STORAGE.save_schedules()
+    publish_change("schedules")
+
+# ----------------------------
+#  --- أرشيف الطلبات (ملفات شهرية مضغوطة) -----
+# ----------------------------
+# Approved/rejected orders older than ARCHIVE_AFTER_DAYS leave the hot set (ORDERS,
+# its index, orders.json or the orders table) and are appended to
+# ARCHIVE_DIR/orders-YYYY-MM.jsonl.gz, partitioned by the month they were created in.
+# Each run appends a new gzip member, so old segments are never rewritten. The
+# segment is fsynced before the orders are dropped: a crash in between leaves the
+# orders both in the segment and in the hot set. Readers of the whole history skip
+# archived copies of orders that are still hot, and the next run only drops them
+# instead of writing them again.
+# Lookups go through a small index next to the segments: index-NN.json files map
+# order_id -> month (sharded by a hash of the id) and index-users.json maps
+# user_id -> months, so a search opens only the segments that hold its orders.
+# The index is updated after the segment is fsynced and before the orders are
+# dropped; index-users.json is written last and marks the index as built.
+ARCHIVE_STATUSES = ("approved", "rejected")
+ARCHIVE_INDEX_SHARDS = 16
+archive_lock = TimedLock("archive")   # archival runs vs. orders_snapshot()
+archive_clean = False   # set once a run has finished in this process (no leftovers from a crash)
+
+def is_archivable(order, cutoff):
+    return order.get("status") in ARCHIVE_STATUSES and (order.get("handled_at") or order.get("created_at") or "") < cutoff
+
+def archive_segment_path(month):
+    return os.path.join(ARCHIVE_DIR, f"orders-{month}.jsonl.gz")
+
+def archive_segments():
+    """قائمة (الشهر، المسار، الحجم) لملفات الأرشيف من الأقدم للأحدث"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    segments = []
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        if name.startswith("orders-") and name.endswith(".jsonl.gz"):
+            path = os.path.join(ARCHIVE_DIR, name)
+            segments.append((name[len("orders-"):-len(".jsonl.gz")], path, os.path.getsize(path)))
+    return segments
+
+def archive_index_path(name):
+    return os.path.join(ARCHIVE_DIR, f"index-{name}.json")
+
+def archive_index_shard(order_id):
+    return f"{zlib.crc32(str(order_id).encode('utf-8')) % ARCHIVE_INDEX_SHARDS:02d}"
+
+def update_archive_index(rows):
+    """يضيف (الشهر، الطلب) إلى فهرس الأرشيف: order_id -> الشهر و user_id -> الأشهر"""
+    shards, users = {}, load_json(archive_index_path("users")) or {}
+    for month, o in rows:
+        shards.setdefault(archive_index_shard(o.get("order_id")), {})[str(o.get("order_id"))] = month
+        months = users.setdefault(str(o.get("user_id")), [])
+        if month not in months:
+            bisect.insort(months, month)
+    for shard, entries in shards.items():
+        index = load_json(archive_index_path(shard)) or {}
+        index.update(entries)
+        save_json(archive_index_path(shard), index)
+    save_json(archive_index_path("users"), users)
+
+def build_archive_index():
+    # segments written before the index existed are indexed once; call with archive_lock held
+    if os.path.exists(archive_index_path("users")):
+        return
+    started = time.monotonic()
+    update_archive_index((month, o) for month, path, _ in archive_segments() for o in read_archive_segment(path))
+    logger.info("Archive index built in %.2fs", time.monotonic() - started)
+
+def ensure_archive_index():
+    if os.path.isdir(ARCHIVE_DIR) and not os.path.exists(archive_index_path("users")):
+        with archive_lock:
+            build_archive_index()
+
+def write_archive_segment(month, orders):
+    data = "".join(json.dumps(o, ensure_ascii=False, default=dict) + "\n" for o in orders).encode("utf-8")
+    path = archive_segment_path(month)
+    started = time.perf_counter()
+    with open(path, "ab") as raw:
+        before = raw.tell()
+        with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+            gz.write(data)
+        raw.flush()
+        os.fsync(raw.fileno())
+        FILE_IO_BYTES.inc(("archive", os.path.basename(path)), raw.tell() - before)
+    FILE_IO_SECONDS.observe(("archive", os.path.basename(path)), time.perf_counter() - started)
+
+class SegmentSlice(io.RawIOBase):
+    """أول size بايت من ملف أرشيف، أي ما كان فيه لحظة أخذ اللقطة"""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(memoryview(b)[:self.left]) if self.left > 0 else 0
+        self.left -= n
+        return n
+
+def read_archive_segment(path, size=None):
+    """size: stop at that many bytes (the gzip members written before a snapshot)"""
+    try:
+        with open(path, "rb") as raw, gzip.open(
+                raw if size is None else io.BufferedReader(SegmentSlice(raw, size)), "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    except (EOFError, OSError, ValueError) as e:
+        # a member cut short by a crash: everything before it is still readable
+        logger.warning("Stopped reading damaged archive segment %s: %s", path, e)
+
+def iter_archived_orders(since=None, until=None, segments=None, hot_ids=None):
+    """يقرأ الطلبات المؤرشفة من الأقدم للأحدث؛ since/until (YYYY-MM) تتخطى الملفات خارج المدى
+
+    segments: the list from an orders_snapshot(); each file is read only up to the
+    size it had then. hot_ids: order_ids still in the hot set, whose archived copies
+    (left by a crash mid-archival) are skipped.
+    """
+    for month, path, size in archive_segments() if segments is None else segments:
+        if (since and month < since[:7]) or (until and month > until[:7]):
+            continue
+        for o in read_archive_segment(path, None if segments is None else size):
+            if not hot_ids or o.get("order_id") not in hot_ids:
+                yield o
+
+def orders_snapshot():
+    """لقطة لحظية: (ملفات الأرشيف بأحجامها، الطلبات الحالية)
+
+    taken under archive_lock, so an archival run is either entirely before the
+    snapshot (its orders are in the segments) or entirely after it (they are still
+    in the hot list): no order is counted twice or missed.
+    """
+    with archive_lock:
+        return archive_segments(), STORAGE.snapshot_orders()
+
+def iter_all_orders():
+    """الأرشيف ثم الطلبات الحالية (لقطة واحدة)؛ لإعادة بناء الإحصائيات والفهارس"""
+    segments, hot = orders_snapshot()
+    return itertools.chain(iter_archived_orders(segments=segments, hot_ids=STORAGE.order_ids(hot)), hot)
+
+def search_archive(order_id=None, user_id=None, limit=10):
+    """يبحث في الأرشيف (الأحدث أولاً) برقم الطلب أو معرف المستخدم؛ يفتح فقط الملفات التي يشير إليها الفهرس"""
+    ensure_archive_index()
+    if order_id is not None:
+        month = (load_json(archive_index_path(archive_index_shard(order_id))) or {}).get(str(order_id))
+        months = [month] if month else []
+    elif user_id is not None:
+        months = (load_json(archive_index_path("users")) or {}).get(str(user_id), [])
+    else:
+        months = [month for month, _, _ in archive_segments()]
+    found, seen = [], set()
+    for month in reversed(months):
+        path = archive_segment_path(month)
+        if not os.path.exists(path):
+            continue
+        matches = [o for o in read_archive_segment(path)
+                   if (order_id is None or o.get("order_id") == order_id)
+                   and (user_id is None or str(o.get("user_id")) == str(user_id))]
+        for o in reversed(matches):
+            if o.get("order_id") not in seen:
+                seen.add(o.get("order_id"))
+                found.append(o)
+        if len(found) >= limit:
+            break
+    return found[:limit]
+
+def find_archived_order(order_id):
+    found = search_archive(order_id=order_id, limit=1)
+    return found[0] if found else None
+
+def order_matches(order, status=None, button_id=None, since=None, until=None):
+    """since/until تواريخ YYYY-MM-DD شاملة، تقارن بتاريخ إنشاء الطلب"""
+    day = (order.get("created_at") or "")[:10]
+    return ((status is None or order.get("status") == status)
+            and (button_id is None or order.get("button_id") == button_id)
+            and (since is None or day >= since) and (until is None or day <= until))
+
+def archive_old_orders(days=None):
+    """ينقل الطلبات المنتهية الأقدم من days يوماً إلى الأرشيف ويعيد عددها"""
+    global archive_clean
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    if days <= 0:
+        return 0
+    ORDERS_READY.wait()
+    with archive_lock:
+        started = time.monotonic()
+        cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+        orders = STORAGE.archivable_orders(cutoff)
+        if not orders:
+            return 0
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        by_month = {}
+        for o in orders:
+            by_month.setdefault((o.get("created_at") or cutoff)[:7], []).append(o)
+        was_clean, archive_clean = archive_clean, False
+        build_archive_index()
+        for month, rows in sorted(by_month.items()):
+            if not was_clean and os.path.exists(archive_segment_path(month)):
+                # first run since startup: a crash may have left some of these archived already
+                done = {o.get("order_id") for o in read_archive_segment(archive_segment_path(month))}
+                rows = [o for o in rows if o.get("order_id") not in done]
+            if rows:
+                write_archive_segment(month, rows)
+        # all of them, including ones a crash left in a segment before they were indexed
+        update_archive_index((month, o) for month, rows in by_month.items() for o in rows)
+        STORAGE.drop_orders(orders)
+        SEARCH.remove_orders(orders)
+        archive_clean = True
+        logger.info("Archived %d orders into %d segments in %.2fs", len(orders), len(by_month), time.monotonic() - started)
+        return len(orders)
+
+def archive_job():
+    try:
+        archive_old_orders()
+    except Exception as e:
+        logger.exception("Order archival failed: %s", e)
+
+# ----------------------------
+#  --- تصدير الطلبات (CSV / JSONL) -----
+# ----------------------------
+# Exports walk the archive segments and then the hot orders one order at a time and
+# yield text in chunks of EXPORT_CHUNK_ROWS rows, so memory does not grow with the
+# history. /export/orders streams the chunks as the HTTP response; the /admin action
+# gzips them into a temp file on EXPORT_POOL and sends it as a document.
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_COLUMNS = ("order_id", "created_at", "handled_at", "status", "user_id", "user_name", "button_id", "button_text", "info")
+EXPORT_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+
+def iter_export_orders(status=None, button_id=None, since=None, until=None):
+    ORDERS_READY.wait()
+    segments, hot = orders_snapshot()
+    for o in iter_archived_orders(since, until, segments, STORAGE.order_ids(hot)):
+        if order_matches(o, status, button_id, since, until):
+            yield o
+    yield from STORAGE.iter_orders(status, button_id, since, until, orders=hot)
+
+def export_chunks(fmt, orders):
+    """يحول الطلبات إلى نص CSV أو JSONL على دفعات"""
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    rows = 0
+    for o in orders:
+        if writer:
+            writer.writerow([o.get(c, "") if o.get(c) is not None else "" for c in EXPORT_COLUMNS])
+        else:
+            buf.write(json.dumps(o, ensure_ascii=False, default=dict) + "\n")
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+def parse_export_filters(words):
+    """csv|jsonl و YYYY-MM-DD (من ثم إلى) و status=... و service=... بأي ترتيب"""
+    filters = {"fmt": "csv", "status": None, "button_id": None, "since": None, "until": None}
+    dates = []
+    for word in words:
+        key, sep, value = word.partition("=")
+        if word.lower() in EXPORT_FORMATS:
+            filters["fmt"] = word.lower()
+        elif sep and key in ("status", "service") and value:
+            filters["status" if key == "status" else "button_id"] = value
+        else:
+            try:
+                dates.append(datetime.strptime(word, "%Y-%m-%d").strftime("%Y-%m-%d"))
+            except ValueError:
+                raise ValueError(word)
+    if dates:
+        filters["since"] = dates[0]
+    if len(dates) > 1:
+        filters["until"] = dates[1]
+    return filters
+
+def export_filters_label(f):
+    return (f"{f['fmt'].upper()} | من: {f['since'] or 'البداية'} | إلى: {f['until'] or 'الآن'}"
+            f" | الحالة: {f['status'] or 'الكل'} | الخدمة: {f['button_id'] or 'الكل'}")
+
+def send_export(admin_id, filters):
+    """يكتب التصدير مضغوطاً في ملف مؤقت ثم يرسله للأدمن كمستند"""
+    started = time.monotonic()
+    fmt = filters["fmt"]
+    count = [0]
+
+    def counted(orders):
+        for o in orders:
+            count[0] += 1
+            yield o
+
+    orders = iter_export_orders(filters["status"], filters["button_id"], filters["since"], filters["until"])
+    with tempfile.TemporaryFile() as tmp:
+        with gzip.GzipFile(fileobj=tmp, mode="wb") as gz:
+            for chunk in export_chunks(fmt, counted(orders)):
+                gz.write(chunk.encode("utf-8"))
+        size = tmp.tell()
+        tmp.seek(0)
+        bot.send_document(admin_id, tmp, visible_file_name=f"orders-{datetime.now():%Y%m%d-%H%M}.{fmt}.gz",
+                          caption=f"📤 تصدير {count[0]} طلب\n{export_filters_label(filters)}")
+    logger.info("Exported %d orders (%d bytes gzipped) for %s in %.2fs", count[0], size, admin_id, time.monotonic() - started)
+
+def start_export(admin_id, filters):
+    def run():
+        try:
+            send_export(admin_id, filters)
+        except Exception as e:
+            logger.exception("Order export failed: %s", e)
+            try:
+                bot.send_message(admin_id, f"❌ فشل التصدير: {e}")
+            except Exception:
+                pass
+    EXPORT_POOL.submit(run)
+
+# ----------------------------
+#  --- الحالة المشتركة بين العمليات (عدة عمال gunicorn) -----
+# ----------------------------
+# With SHARED_STATE every process keeps conversation state (admin sessions, pending
+# next steps, broadcast jobs, seen update ids, statistics counters) in SQLite instead
+# of module dicts. Users and orders must then use the sqlite storage backend too.
+# Small cached documents (config, buttons, admins, schedules) carry a version number
+# that is bumped on every save; each update first reloads whatever changed elsewhere.
+SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_state (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (ns, key)
+);
+CREATE TABLE IF NOT EXISTS seen_updates (
+    update_id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats_counters (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_turns (
+    chat_id INTEGER PRIMARY KEY,
+    issued INTEGER NOT NULL,
+    done INTEGER NOT NULL
+);
+"""
+_shared_local = threading.local()
+
+def shared_conn():
+    conn = getattr(_shared_local, "conn", None)
+    if conn is None:
+        # autocommit; multi-statement changes use explicit BEGIN IMMEDIATE
+        conn = sqlite3.connect(SHARED_STATE_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _shared_local.conn = conn
+    return conn
+
+class LocalState(dict):
+    """حالة داخل العملية فقط (الوضع الافتراضي)"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lock = Lock()
+
+    def merge(self, key, fields):
+        with self.lock:
+            value = self.setdefault(key, {})
+            value.update(fields)
+            return value
+
+class SqliteState(MutableMapping):
+    """قاموس JSON مشترك بين العمليات داخل جدول shared_state"""
+
+    def __init__(self, namespace):
+        self.ns = namespace
+
+    def __getitem__(self, key):
+        row = shared_conn().execute("SELECT value FROM shared_state WHERE ns = ? AND key = ?", (self.ns, str(key))).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        shared_conn().execute("INSERT OR REPLACE INTO shared_state (ns, key, value) VALUES (?, ?, ?)",
+                              (self.ns, str(key), json.dumps(value, ensure_ascii=False)))
+
+    def __delitem__(self, key):
+        if shared_conn().execute("DELETE FROM shared_state WHERE ns = ? AND key = ?", (self.ns, str(key))).rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return shared_conn().execute("SELECT 1 FROM shared_state WHERE ns = ? AND key = ?", (self.ns, str(key))).fetchone() is not None
+
+    def __iter__(self):
+        return iter([r[0] for r in shared_conn().execute("SELECT key FROM shared_state WHERE ns = ?", (self.ns,))])
+
+    def __len__(self):
+        return shared_conn().execute("SELECT COUNT(*) FROM shared_state WHERE ns = ?", (self.ns,)).fetchone()[0]
+
+    def merge(self, key, fields):
+        """تحديث بعض الحقول داخل معاملة واحدة حتى لا تمسح عملية تعديلات أخرى"""
+        conn = shared_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM shared_state WHERE ns = ? AND key = ?", (self.ns, str(key))).fetchone()
+            value = json.loads(row[0]) if row else {}
+            value.update(fields)
+            conn.execute("INSERT OR REPLACE INTO shared_state (ns, key, value) VALUES (?, ?, ?)",
+                         (self.ns, str(key), json.dumps(value, ensure_ascii=False)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def incr(self, key):
+        conn = shared_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM shared_state WHERE ns = ? AND key = ?", (self.ns, str(key))).fetchone()
+            value = (json.loads(row[0]) if row else 0) + 1
+            conn.execute("INSERT OR REPLACE INTO shared_state (ns, key, value) VALUES (?, ?, ?)", (self.ns, str(key), json.dumps(value)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+def open_shared_state(namespace, initial=None):
+    if SHARED_STATE:
+        return SqliteState(namespace)
+    return LocalState(initial or {})
+
+if SHARED_STATE:
+    shared_conn().executescript(SHARED_SCHEMA)
+    if STORAGE.name != "sqlite":
+        logger.warning("SHARED_STATE is on but STORAGE_BACKEND is %r: users and orders are NOT shared between processes", STORAGE.name)
+
+SHARED_VERSIONS = open_shared_state("versions")   # document name -> version
+LOCAL_VERSIONS = dict(SHARED_VERSIONS)
+RELOADERS = {}   # document name -> function reloading it in this process
+
+def publish_change(name):
+    if SHARED_STATE:
+        LOCAL_VERSIONS[name] = SHARED_VERSIONS.incr(name)
+
+def refresh_shared_state():
+    if not SHARED_STATE:
+        return
+    for name, version in list(SHARED_VERSIONS.items()):
+        if LOCAL_VERSIONS.get(name) != version:
+            LOCAL_VERSIONS[name] = version
+            reload = RELOADERS.get(name)
+            if reload:
+                logger.info("Reloading %s changed by another process", name)
+                reload()
+
+def reload_in_place(target, fresh):
+    # keep the same object so every module-level reference sees the new content
+    if isinstance(target, dict):
+        target.clear()
+        target.update(fresh)
+    else:
+        target[:] = fresh
+
+RELOADERS["admins"] = lambda: reload_in_place(ADMINS, STORAGE.load_admins())
+RELOADERS["config"] = lambda: reload_in_place(CONFIG, load_json(CONFIG_FILE, DEFAULT_CONFIG))
+
+LEADER_LOCK = None
+
+def is_leader():
+    return not SHARED_STATE or LEADER_LOCK is not None
+
+def try_become_leader():
+    """قفل ملف غير حاجز: عملية واحدة فقط تشغل استرجاع الجدولة واستئناف البث"""
+    global LEADER_LOCK
+    if not SHARED_STATE or LEADER_LOCK is not None:
+        return True
+    import fcntl
+    f = open(LEADER_LOCK_FILE, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    LEADER_LOCK = f
+    return True
+
+# ----------------------------
+#  --- عدادات الإحصائيات (تحدث مع كل طلب) -----
+# ----------------------------
+class OrderStats:
+    """عدادات تُحدّث عند إنشاء الطلب وتغيير حالته، فلوحة الإحصائيات لا تمر على كل الطلبات"""
+
+    HOUR_BUCKETS_KEPT = 24 * 8
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.total_orders = 0
+        self.by_service = {}        # button_text -> count
+        self.by_status = {}         # status -> count
+        self.by_day = {}            # "YYYY-MM-DD" -> orders created
+        self.by_hour = {}           # "YYYY-MM-DDTHH" -> orders created (last few days only)
+        self.new_users_by_day = {}  # "YYYY-MM-DD" -> users first seen
+        self.handling_minutes = {}  # whole minutes from created_at to handled_at -> count (approved/rejected)
+
+    @staticmethod
+    def _bump(counter, key, n=1):
+        value = counter.get(key, 0) + n
+        if value > 0:
+            counter[key] = value
+        else:
+            counter.pop(key, None)
+
+    @staticmethod
+    def _handling_bucket(order):
+        if order.get("status") not in ("approved", "rejected"):
+            return None
+        try:
+            delta = datetime.fromisoformat(order["handled_at"]) - datetime.fromisoformat(order["created_at"])
+        except Exception:
+            return None
+        return max(0, int(delta.total_seconds() // 60))
+
+    def _add(self, order, n):
+        self.total_orders += n
+        self._bump(self.by_service, order.get("button_text", "unknown"), n)
+        self._bump(self.by_status, order.get("status"), n)
+        created = order.get("created_at") or ""
+        if created:
+            self._bump(self.by_day, created[:10], n)
+            self._bump(self.by_hour, created[:13], n)
+        bucket = self._handling_bucket(order)
+        if bucket is not None:
+            self._bump(self.handling_minutes, bucket, n)
+
+    def _prune_hours(self):
+        if len(self.by_hour) > self.HOUR_BUCKETS_KEPT:
+            for key in sorted(self.by_hour)[:len(self.by_hour) - self.HOUR_BUCKETS_KEPT]:
+                del self.by_hour[key]
+
+    def order_created(self, order):
+        with self.lock:
+            self._add(order, 1)
+            self._prune_hours()
+
+    def order_updated(self, order, old):
+        with self.lock:
+            self._bump(self.by_status, old.get("status"), -1)
+            self._bump(self.by_status, order.get("status"), 1)
+            before = self._handling_bucket(old)
+            if before is not None:
+                self._bump(self.handling_minutes, before, -1)
+            after = self._handling_bucket(order)
+            if after is not None:
+                self._bump(self.handling_minutes, after, 1)
+
+    def user_created(self, user):
+        with self.lock:
+            self._bump(self.new_users_by_day, (user.get("first_seen") or "")[:10] or "unknown")
+
+    def rebuild(self, orders, users):
+        """يعيد حساب كل العدادات من التخزين"""
+        with self.lock:
+            self.reset()
+            for o in orders:
+                self._add(o, 1)
+            for _, u in users:
+                self._bump(self.new_users_by_day, (u.get("first_seen") or "")[:10] or "unknown")
+            self._prune_hours()
+
+    def approval_rate(self):
+        approved = self.by_status.get("approved", 0)
+        handled = approved + self.by_status.get("rejected", 0)
+        return approved / handled if handled else None
+
+    def median_handling_minutes(self):
+        with self.lock:
+            buckets = sorted(self.handling_minutes.items())
+        total = sum(c for _, c in buckets)
+        if not total:
+            return None
+        seen = 0
+        for minutes, count in buckets:
+            seen += count
+            if seen * 2 >= total:
+                return minutes
+        return buckets[-1][0]
+
+    def top_services(self, n=3):
+        with self.lock:
+            return sorted(self.by_service.items(), key=lambda x: x[1], reverse=True)[:n]
+
+    def orders_last_hours(self, hours):
+        now = datetime.now()
+        keys = [(now - timedelta(hours=h)).strftime("%Y-%m-%dT%H") for h in range(hours)]
+        return sum(self.by_hour.get(k, 0) for k in keys)
+
+    def days_total(self, counter, days):
+        today = datetime.now().date()
+        return sum(counter.get((today - timedelta(days=d)).isoformat(), 0) for d in range(days))
+
+class SharedOrderStats(OrderStats):
+    """مع SHARED_STATE: كل تغيير يُكتب كفرق في جدول stats_counters فترى كل العمليات نفس الأرقام"""
+
+    COUNTERS = ("by_service", "by_status", "by_day", "by_hour", "new_users_by_day", "handling_minutes")
+
+    def reset(self):
+        super().reset()
+        self.pending = {}   # "counter\tkey" -> delta not yet written
+
+    def _bump(self, counter, key, n=1):
+        OrderStats._bump(counter, key, n)
+        for name in self.COUNTERS:
+            if getattr(self, name) is counter:
+                field = f"{name}\t{key}"
+                self.pending[field] = self.pending.get(field, 0) + n
+                break
+
+    def _add(self, order, n):
+        super()._add(order, n)
+        self.pending["total"] = self.pending.get("total", 0) + n
+
+    def _flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            shared_conn().executemany(
+                "INSERT INTO stats_counters (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                list(pending.items()))
+
+    def order_created(self, order):
+        super().order_created(order)
+        self._flush()
+
+    def order_updated(self, order, old):
+        super().order_updated(order, old)
+        self._flush()
+
+    def user_created(self, user):
+        super().user_created(user)
+        self._flush()
+
+    def rebuild(self, orders, users):
+        super().rebuild(orders, users)
+        with self.lock:
+            self.pending = {}
+            rows = [("total", self.total_orders)] + [
+                (f"{name}\t{key}", value) for name in self.COUNTERS for key, value in getattr(self, name).items()]
+        conn = shared_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM stats_counters")
+            conn.executemany("INSERT INTO stats_counters (key, value) VALUES (?, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def refresh(self):
+        """يحمّل العدادات من الجدول، يعيد False إن كان فارغاً"""
+        rows = shared_conn().execute("SELECT key, value FROM stats_counters").fetchall()
+        if not rows:
+            return False
+        with self.lock:
+            pending = self.pending
+            self.reset()
+            self.pending = pending
+            for field, value in rows:
+                if field == "total":
+                    self.total_orders = value
+                    continue
+                name, _, key = field.partition("\t")
+                if name == "handling_minutes":
+                    key = int(key)
+                if value > 0 and name in self.COUNTERS:
+                    getattr(self, name)[key] = value
+            self._prune_hours()
+        return True
+
+STATS = SharedOrderStats() if SHARED_STATE else OrderStats()
+
+def rebuild_stats(orders=None):
+    started = time.monotonic()
+    STATS.rebuild(iter_all_orders() if orders is None else orders, STORAGE.iter_users())
+    logger.info("Statistics rebuilt from storage in %.2fs", time.monotonic() - started)
+
+def refresh_stats():
+    if SHARED_STATE:
+        STATS.refresh()
+
+
+def format_minutes(minutes):
+    if minutes is None:
+        return "—"
+    if minutes < 60:
+        return f"{minutes} دقيقة"
+    return f"{minutes // 60} ساعة و {minutes % 60} دقيقة"
+
+def stats_text():
+    ORDERS_READY.wait()
+    refresh_stats()
+    rate = STATS.approval_rate()
+    top = STATS.top_services()
+    lines = [
+        "📊 إحصائيات:\n",
+        f"👥 عدد المستخدمين: {len(USERS)}",
+        f"🆕 مستخدمون جدد اليوم: {STATS.days_total(STATS.new_users_by_day, 1)} | آخر 7 أيام: {STATS.days_total(STATS.new_users_by_day, 7)}",
+        f"📦 عدد الطلبات: {STATS.total_orders}",
+        f"🕐 طلبات آخر 24 ساعة: {STATS.orders_last_hours(24)} | اليوم: {STATS.days_total(STATS.by_day, 1)} | آخر 7 أيام: {STATS.days_total(STATS.by_day, 7)}",
+        "",
+    ]
+    for status, label in ORDER_STATUS_LABELS.items():
+        lines.append(f"{label}: {STATS.by_status.get(status, 0)}")
+    lines += [
+        "",
+        f"✅ نسبة الموافقة: {rate * 100:.1f}%" if rate is not None else "✅ نسبة الموافقة: —",
+        f"⏱ الزمن الوسيط للمعالجة: {format_minutes(STATS.median_handling_minutes())}",
+        f"⭐ أكثر خدمة استخدامًا: {top[0][0] if top else 'لا يوجد'}",
+    ]
+    for name, count in top:
+        lines.append(f"   • {name}: {count}")
+    return "\n".join(lines)
+
+# ----------------------------
+#  --- فهارس المستخدمين (شرائح البث) -----
+# ----------------------------
+# An audience is a short spec stored with the broadcast job so it can be resumed:
+#   "all", "active:<days>", "service:<button_id>", "lang:<code>"
+class UserIndex:
+    """قوائم مرتبة من معرفات المستخدمين حسب الخدمة واللغة ويوم آخر نشاط، لاستخراج الشريحة دون المرور على كل المستخدمين"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.by_service = {}   # button_id -> sorted uids
+            self.by_lang = {}      # lang -> sorted uids
+            self.by_day = {}       # "YYYY-MM-DD" of last_seen -> sorted uids
+            self.state = {}        # uid -> (lang, last_seen, services) as currently indexed
+            self.user_rowid = 0    # SHARED_STATE catch-up cursor (sqlite users rowid)
+
+    @staticmethod
+    def _insert(index, key, uid):
+        lst = index.setdefault(key, [])
+        i = bisect.bisect_left(lst, uid)
+        if i == len(lst) or lst[i] != uid:
+            lst.insert(i, uid)
+
+    @staticmethod
+    def _remove(index, key, uid):
+        lst = index.get(key)
+        if lst:
+            i = bisect.bisect_left(lst, uid)
+            if i < len(lst) and lst[i] == uid:
+                del lst[i]
+
+    def update(self, uid, user):
+        uid = str(uid)
+        lang = user.get("lang") or "unknown"
+        last_seen = user.get("last_seen") or user.get("first_seen") or ""
+        services = tuple(sorted(s for s in user.get("services") or [] if s))
+        with self.lock:
+            old = self.state.get(uid)
+            if old == (lang, last_seen, services):
+                return
+            old_lang, old_seen, old_services = old or (None, None, ())
+            if old_lang != lang:
+                self._remove(self.by_lang, old_lang, uid)
+                self._insert(self.by_lang, lang, uid)
+            if (old_seen or "")[:10] != last_seen[:10] or old is None:
+                self._remove(self.by_day, (old_seen or "")[:10], uid)
+                self._insert(self.by_day, last_seen[:10], uid)
+            for s in set(old_services) - set(services):
+                self._remove(self.by_service, s, uid)
+            for s in set(services) - set(old_services):
+                self._insert(self.by_service, s, uid)
+            self.state[uid] = (lang, last_seen, services)
+
+    def last_seen(self, uid):
+        entry = self.state.get(str(uid))
+        return entry[1] if entry else None
+
+    def rebuild(self, users):
+        self.reset()
+        for uid, user in users:
+            self.update(uid, user)
+
+    def _lists(self, audience):
+        # reads must not add buckets: by_day would gain a key per day per query
+        kind, _, value = audience.partition(":")
+        with self.lock:
+            if kind == "service":
+                return [self.by_service.get(value, [])]
+            if kind == "lang":
+                return [self.by_lang.get(value, [])]
+            if kind == "active" and value.isdecimal() and int(value) > 0:
+                today = datetime.now().date()
+                first = (today - timedelta(days=min(int(value), 36500) - 1)).isoformat()
+                return [lst for day, lst in self.by_day.items() if first <= day <= today.isoformat()]
+        raise ValueError(f"unknown audience {audience!r}")
+
+    def _walk(self, lst, last=None):
+        # lazy walk over a sorted list that may change while we iterate
+        while True:
+            with self.lock:
+                i = 0 if last is None else bisect.bisect_right(lst, last)
+                if i >= len(lst):
+                    return
+                last = lst[i]
+            yield last
+
+    def stream(self, audience, after=None):
+        """معرفات الشريحة مرتبة وبدون تكرار، تُقرأ عند الحاجة؛ after: تبدأ بعد هذا المعرف"""
+        prev = None
+        for uid in heapq.merge(*[self._walk(lst, after) for lst in self._lists(audience)]):
+            # a user moving between day buckets mid-walk can show up twice, always adjacently
+            if uid != prev:
+                yield uid
+            prev = uid
+
+    def count(self, audience):
+        with self.lock:
+            return sum(len(lst) for lst in self._lists(audience))
+
+USER_INDEX = UserIndex()
+
+def tally_user_orders(orders, counts, services):
+    """يمرر الطلبات كما هي ويعدّها لكل مستخدم، ليكفي مرور واحد على الأرشيف للإحصائيات والفهرس"""
+    for o in orders:
+        uid = str(o.get("user_id"))
+        counts[uid] = counts.get(uid, 0) + 1
+        if o.get("button_id"):
+            services.setdefault(uid, set()).add(o["button_id"])
+        yield o
+
+def rebuild_user_index(tally=None):
+    """tally: (counts, services) already collected by tally_user_orders()"""
+    started = time.monotonic()
+    if tally is None:
+        tally = {}, {}
+        for _ in tally_user_orders(iter_all_orders(), *tally):
+            pass
+    counts, services = tally
+    USER_INDEX.reset()
+    backfill = []
+    # with SHARED_STATE, walk by rowid so refresh_user_index() can continue from there
+    for uid, user in shared_index_users() if SHARED_STATE and STORAGE.name == "sqlite" else STORAGE.iter_users():
+        if "order_count" not in user:
+            # records written before order_count/services existed
+            user["order_count"] = counts.get(uid, 0)
+            user["services"] = sorted(services.get(uid, ()))
+            backfill.append((uid, user))
+        USER_INDEX.update(uid, user)
+    for uid, user in backfill:
+        save_user(uid, user)
+    logger.info("User index built in %.2fs (%d records backfilled)", time.monotonic() - started, len(backfill))
+
+def shared_index_users():
+    for rowid, uid, user in STORAGE.users_after(USER_INDEX.user_rowid):
+        USER_INDEX.user_rowid = rowid
+        yield uid, user
+
+def refresh_user_index():
+    # other workers save users too: index the rows written since the last call
+    if not SHARED_STATE or STORAGE.name != "sqlite":
+        return
+    for uid, user in shared_index_users():
+        USER_INDEX.update(uid, user)
+
+def touch_user(uid):
+    """يحدّث last_seen للمستخدم المسجل، مرة كل LAST_SEEN_RESOLUTION ثانية على الأكثر"""
+    uid = str(uid)
+    seen = USER_INDEX.last_seen(uid)
+    if seen is None:
+        return   # not registered yet (/start or a request creates the record)
+    now = datetime.now()
+    try:
+        if (now - datetime.fromisoformat(seen)).total_seconds() < LAST_SEEN_RESOLUTION:
+            return
+    except ValueError:
+        pass
+    user = USERS.get(uid)
+    if user is not None:
+        user["last_seen"] = now.isoformat()
+        save_user(uid, user)
+
+def audience_label(audience):
+    kind, _, value = audience.partition(":")
+    if kind == "active":
+        return f"النشطون آخر {value} يوم"
+    if kind == "service":
+        btn = MENU.find(value)
+        return f"من طلب: {btn.get('text') if btn else value}"
+    if kind == "lang":
+        return f"اللغة: {value}"
+    return "كل المستخدمين"
+
+def audience_count(audience):
+    ORDERS_READY.wait()
+    return len(USERS) if audience == "all" else USER_INDEX.count(audience)
+
+def valid_audience(audience):
+    if audience == "all":
+        return True
+    try:
+        USER_INDEX.count(audience)
+    except ValueError:
+        return False
+    return True
+
+# ----------------------------
+#  --- البحث النصي للأدمن (/find) -----
+# ----------------------------
+# Inverted index over the hot orders (order_id, info, user_name, button_text) and the
+# users (name, id). Each token maps to an array of postings doc * 8 + field, and a
+# sorted vocabulary answers prefix queries with bisect, so a query touches only the
+# postings of its own terms. Orders are indexed by add_order, users by save_user, and
+# archived orders are dropped as tombstones that are compacted away in bulk.
+SEARCH_LETTERS = (("أ", "ا"), ("إ", "ا"), ("آ", "ا"), ("ى", "ي"), ("ة", "ه"))
+SEARCH_MARKS = re.compile("[\u0610-\u061a\u064b-\u065f\u0640]")   # Arabic diacritics and tatweel
+SEARCH_TOKEN = re.compile(r"\w{2,}|\d")   # single letters are noise, single digits are not
+
+def search_tokens(text):
+    if not text:
+        return []
+    text = str(text).casefold()
+    if not text.isascii():
+        text = SEARCH_MARKS.sub("", text)
+        for variant, plain in SEARCH_LETTERS:
+            text = text.replace(variant, plain)
+    return SEARCH_TOKEN.findall(text)
+
+class SearchIndex:
+    """فهرس مقلوب token -> postings مع بحث بالبادئة وترتيب حسب الحقل والأحدث"""
+
+    FIELDS = ("order_id", "info", "user_name", "button_text", "name", "id")
+    WEIGHTS = (8, 4, 2, 1, 3, 8)   # per field; an exact token counts double a prefix match
+    PREFIX_TOKENS = 200            # vocabulary entries one prefix term may expand to
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.postings = {}     # token -> array("q") of doc * 8 + field
+            self.vocab = []        # sorted tokens
+            self.docs = []         # doc -> ("o", order_id) / ("u", uid); None once removed
+            self.doc_ids = {}      # key -> doc
+            self.user_names = {}   # uid -> name as indexed, so unchanged saves are free
+            self.removed = 0
+            self.order_seq = 0     # SHARED_STATE catch-up cursors (sqlite orders.seq / users rowid)
+            self.user_rowid = 0
+            self.bulk = False      # while loading, new tokens are appended and sorted once at the end
+
+    def load(self, orders, users):
+        """بناء كامل: إضافة كل المستندات ثم ترتيب المفردات مرة واحدة"""
+        # the lock is taken per document, so add_order/save_user in the update
+        # workers are never held up for the whole build
+        self.bulk = True
+        try:
+            for o in orders:
+                self.add_order(o)
+            for uid, user in users:
+                self.update_user(uid, user)
+        finally:
+            with self.lock:
+                self.bulk = False
+                self.vocab.sort()
+
+    def _add(self, key, fields):
+        doc = len(self.docs)
+        self.docs.append(key)
+        self.doc_ids[key] = doc
+        for field, text in fields:
+            for token in set(search_tokens(text)):
+                postings = self.postings.get(token)
+                if postings is None:
+                    postings = self.postings[token] = array("q")
+                    if self.bulk:
+                        self.vocab.append(token)
+                    else:
+                        bisect.insort(self.vocab, token)
+                postings.append(doc * 8 + field)
+
+    @staticmethod
+    def _order_fields(order):
+        info = order.get("info")
+        if isinstance(info, str) and info.startswith("[PHOTO]"):
+            info = None   # a file_id, not searchable text
+        return (0, order.get("order_id")), (1, info), (2, order.get("user_name")), (3, order.get("button_text"))
+
+    def add_order(self, order):
+        key = ("o", order.get("order_id"))
+        with self.lock:
+            if key not in self.doc_ids:
+                self._add(key, self._order_fields(order))
+
+    def update_order(self, order):
+        # the old postings become a tombstone like an archived order
+        key = ("o", order.get("order_id"))
+        with self.lock:
+            self._drop([key])
+            self._add(key, self._order_fields(order))
+
+    def update_user(self, uid, user):
+        uid, name = str(uid), user.get("name") or ""
+        with self.lock:
+            if self.user_names.get(uid) == name:
+                return
+            self._drop([("u", uid)])
+            self.user_names[uid] = name
+            self._add(("u", uid), ((4, name), (5, uid)))
+
+    def remove_orders(self, orders):
+        self._drop([("o", o.get("order_id")) for o in orders])
+
+    def _drop(self, keys):
+        with self.lock:
+            for key in keys:
+                doc = self.doc_ids.pop(key, None)
+                if doc is not None:
+                    self.docs[doc] = None
+                    self.removed += 1
+            if self.removed > 1000 and self.removed * 4 > len(self.docs):
+                self._compact()
+
+    def _compact(self):
+        # renumber the live documents in their old order (newer still means higher)
+        renumber, docs = {}, []
+        for doc, key in enumerate(self.docs):
+            if key is not None:
+                renumber[doc] = len(docs)
+                docs.append(key)
+        for token, postings in list(self.postings.items()):
+            alive = array("q", (renumber[p >> 3] * 8 + (p & 7) for p in postings if (p >> 3) in renumber))
+            if alive:
+                self.postings[token] = alive
+            else:
+                del self.postings[token]
+        self.docs = docs
+        self.doc_ids = {key: doc for doc, key in enumerate(docs)}
+        self.vocab = sorted(self.postings)
+        self.removed = 0
+
+    def _term_scores(self, term):
+        tokens = [term] if term in self.postings else []
+        if len(term) > 1:
+            i = bisect.bisect_right(self.vocab, term)
+            while i < len(self.vocab) and self.vocab[i].startswith(term) and len(tokens) < self.PREFIX_TOKENS:
+                tokens.append(self.vocab[i])
+                i += 1
+        scores = {}
+        for token in tokens:
+            boost = 2 if token == term else 1
+            for p in self.postings[token]:
+                doc = p >> 3
+                scores[doc] = scores.get(doc, 0) + self.WEIGHTS[p & 7] * boost
+        return scores
+
+    def search(self, query, offset=0, limit=10):
+        """يعيد ([key, ...], عدد النتائج)؛ كل كلمات البحث يجب أن تطابق (كاملة أو كبداية كلمة)"""
+        terms = list(dict.fromkeys(search_tokens(query)))
+        if not terms:
+            return [], 0
+        with self.lock:
+            # rarest term first so the intersection shrinks as early as possible
+            terms.sort(key=lambda t: len(self.postings.get(t, ())))
+            total = None
+            for term in terms:
+                scores = self._term_scores(term)
+                total = scores if total is None else {d: s + scores[d] for d, s in total.items() if d in scores}
+                if not total:
+                    return [], 0
+            hits = [(score, doc) for doc, score in total.items() if self.docs[doc] is not None]
+            # same score: the newer document (higher doc number) first
+            top = heapq.nlargest(offset + limit, hits)
+            return [self.docs[doc] for _, doc in top[offset:]], len(hits)
+
+SEARCH = SearchIndex()
+SEARCH_ORDER_FIELDS = frozenset(SearchIndex.FIELDS[:4])   # update_order() re-indexes only when one of these changes
+SEARCH_READY = threading.Event()   # set once the first full build is done
+
+def build_search_index():
+    started = time.monotonic()
+    SEARCH_READY.clear()
+    SEARCH.reset()
+    try:
+        if SHARED_STATE and STORAGE.name == "sqlite":
+            SEARCH.load(shared_orders_after(), shared_users_after())
+        else:
+            SEARCH.load(STORAGE.snapshot_orders(), STORAGE.iter_users())
+    except Exception as e:
+        logger.exception("Failed to build the search index: %s", e)
+    finally:
+        SEARCH_READY.set()
+    logger.info("Search index built in %.2fs (%d documents, %d tokens)", time.monotonic() - started, len(SEARCH.doc_ids), len(SEARCH.postings))
+
+def shared_orders_after():
+    for seq, order in STORAGE.orders_after(SEARCH.order_seq):
+        SEARCH.order_seq = seq
+        yield order
+
+def shared_users_after():
+    for rowid, uid, user in STORAGE.users_after(SEARCH.user_rowid):
+        SEARCH.user_rowid = rowid
+        yield uid, user
+
+def refresh_search_index():
+    # other workers add orders and users too: pick up rows written since the last call
+    if not SHARED_STATE or STORAGE.name != "sqlite":
+        return
+    for order in shared_orders_after():
+        SEARCH.add_order(order)
+    for uid, user in shared_users_after():
+        SEARCH.update_user(uid, user)
 
 # ----------------------------
 #  --- تهيئة البوت و Flask ---
@@ -150,15 +2460,54 @@ if not BOT_TOKEN or BOT_TOKEN == "PUT_YOUR_BOT_TOKEN_HERE":
     logger.error("لم يتم وضع BOT_TOKEN في config.json. ضع التوكن ثم أعد التشغيل.")
     raise SystemExit("BOT_TOKEN missing in config.json")
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# threaded=False: updates are dispatched by our own per-chat worker pool (see the webhook section)
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
+
+# one pooled keep-alive session shared by every thread instead of a session per thread
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+HTTP_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+telebot.apihelper.session = HTTP_SESSION
+telebot.apihelper.SESSION_TIME_TO_LIVE = None   # otherwise telebot replaces it with per-thread sessions
+_make_request = telebot.apihelper._make_request
+
+def _timed_make_request(token, method_name, *args, **kwargs):
+    # every outbound Bot API call (handlers, broadcasts, fan-out) goes through here
+    started = time.perf_counter()
+    result = "ok"
+    try:
+        return _make_request(token, method_name, *args, **kwargs)
+    except telebot.apihelper.ApiTelegramException as e:
+        result = str(e.error_code)
+        raise
+    except Exception:
+        result = "network"
+        raise
+    finally:
+        TELEGRAM_API_SECONDS.observe((method_name,), time.perf_counter() - started)
+        TELEGRAM_API_RESULTS.inc((method_name, result))
+
+telebot.apihelper._make_request = _timed_make_request
 app = Flask(__name__)
 scheduler = BackgroundScheduler()
+
+def on_scheduler_event(event):
+    SCHEDULER_EVENTS.inc(({EVENT_JOB_EXECUTED: "executed", EVENT_JOB_ERROR: "error", EVENT_JOB_MISSED: "missed"}[event.code],))
+
+scheduler.add_listener(on_scheduler_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
 scheduler.start()
 
 # ----------------------------
 #  --- حالات جلسات الأدمن --- (لحفظ الحالة المؤقتة أثناء إدخال الخطوات)
 # ----------------------------
-admin_sessions = {}   # key: admin_id -> value: dict {action:, temp:...}
+admin_sessions = open_shared_state("sessions")   # key: admin_id -> value: dict {action:, temp:...}
+pending_steps = open_shared_state("steps")       # key: chat_id -> name in NEXT_STEP_HANDLERS (بديل register_next_step_handler)
+
+def save_session(aid, session):
+    # shared sessions hand out copies: write the mutated copy back unless the flow ended
+    if aid in admin_sessions and admin_sessions.get(aid) != session:
+        admin_sessions[aid] = session
+
 # حالات انتظار المستخدم لإدخال معلومات الطلب محفوظة داخل USERS[user_id]["awaiting"] = {button_id, prompt}
 
 # ----------------------------
@@ -167,10 +2516,7 @@ admin_sessions = {}   # key: admin_id -> value: dict {action:, temp:...}
 def save_all():
     save_json(CONFIG_FILE, CONFIG)
     save_json(BUTTONS_FILE, BUTTONS)
-    save_json(USERS_FILE, USERS)
-    save_json(ORDERS_FILE, ORDERS)
-    save_json(ADMINS_FILE, ADMINS)
-    save_json(SCHEDULES_FILE, SCHEDULES)
+    STORAGE.save_all()
 
 def is_admin(user_id):
     # يستخدم كل من ADMIN_IDS و ملف ADMINS للأذونات المفصلة
@@ -183,7 +2529,7 @@ def is_admin(user_id):
 
 def find_button_by_id(btn_id, btn_list=None):
     if btn_list is None:
-        btn_list = BUTTONS.get("main_menu", [])
+        return MENU.find(btn_id)
     for b in btn_list:
         if b.get("id") == btn_id or b.get("text") == btn_id:
             return b
@@ -193,33 +2539,187 @@ def find_button_by_id(btn_id, btn_list=None):
                 return found
     return None
 
+def button_key(b):
+    # buttons created by hand in buttons.json may have no id; fall back to their text
+    return b.get("id") or b.get("text")
+
 def build_keyboard_from_buttons(btn_list):
     kb = InlineKeyboardMarkup()
     for b in btn_list:
-        kb.add(InlineKeyboardButton(b["text"], callback_data=f"BTN|{b['id']}"))
+        kb.add(InlineKeyboardButton(b["text"], callback_data=f"BTN|{button_key(b)}"))
+    kb.add(InlineKeyboardButton("📋 طلباتي", callback_data="NAV|myorders"))
     # always add a Home button
     kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data="NAV|home"))
     return kb
 
-def build_submenu_keyboard(submenu):
+def build_submenu_keyboard(submenu, back_data="NAV|back"):
     kb = InlineKeyboardMarkup()
     for b in submenu:
-        kb.add(InlineKeyboardButton(b["text"], callback_data=f"BTN|{b['id']}"))
-    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data="NAV|back"))
+        kb.add(InlineKeyboardButton(b["text"], callback_data=f"BTN|{button_key(b)}"))
+    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data=back_data))
     kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data="NAV|home"))
     return kb
 
-def send_to_admins(text, parse_mode="HTML"):
-    admin_ids = [a["id"] for a in ADMINS.get("admins", [])] + list(ADMIN_IDS)
-    sent = 0
-    for aid in set(admin_ids):
+# ----------------------------
+#  --- القائمة المجمعة (فهرس الأزرار + لوحات جاهزة) -----
+# ----------------------------
+class MenuIndex:
+    """نسخة مجمعة من BUTTONS: فهرس id -> زر ولوحات مفاتيح مسلسلة مسبقاً
+
+    keyboards are stored as the JSON string telebot would send, so navigation never
+    rebuilds InlineKeyboardMarkup objects; the whole index is replaced on every change.
+    """
+
+    def __init__(self, buttons):
+        self.nodes = {}       # id or text -> button (first match in menu order, like the old recursive search)
+        self.keyboards = {}   # submenu key -> serialized keyboard
+        main_menu = buttons.get("main_menu", [])
+        self.main_keyboard = build_keyboard_from_buttons(main_menu).to_json()
+        self._walk(main_menu, None)
+
+    def _walk(self, btn_list, parent_key):
+        for b in btn_list:
+            key = button_key(b)
+            for k in (b.get("id"), b.get("text")):
+                if k is not None:
+                    self.nodes.setdefault(k, b)
+            if b.get("type") == "submenu":
+                back = f"BTN|{parent_key}" if parent_key else "NAV|back"
+                self.keyboards.setdefault(key, build_submenu_keyboard(b.get("submenu", []), back).to_json())
+                self._walk(b.get("submenu", []), key)
+
+    def find(self, key):
+        return self.nodes.get(key)
+
+    def submenu_keyboard(self, btn):
+        return self.keyboards.get(button_key(btn)) or build_submenu_keyboard(btn.get("submenu", []))
+
+MENU = MenuIndex(BUTTONS)
+HOME_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 الرئيسية", callback_data="NAV|home")]]).to_json()
+
+def rebuild_menu():
+    global MENU
+    MENU = MenuIndex(BUTTONS)   # single reference swap, readers never see a half-built index
+
+def save_buttons():
+    save_json(BUTTONS_FILE, BUTTONS)
+    rebuild_menu()
+    publish_change("buttons")
+
+def reload_buttons():
+    reload_in_place(BUTTONS, load_json(BUTTONS_FILE, DEFAULT_BUTTONS))
+    rebuild_menu()
+
+RELOADERS["buttons"] = reload_buttons
+
+# ----------------------------
+#  --- صور أزرار المحتوى (file_id) -----
+# ----------------------------
+# A content button stores its image source in "image" (a URL) and, after the first
+# successful send, the file_id Telegram assigned in "image_file_id". Later presses
+# send the file_id, so Telegram no longer fetches the URL every time. Images uploaded
+# by an admin only have "image_file_id". If Telegram rejects a cached file_id the
+# image is uploaded again from "image" and the new file_id replaces the old one.
+def read_image_input(message):
+    """صورة مرفوعة -> (file_id, "")، رابط -> ("", url)، و 'no' -> ("", "")"""
+    if message.photo:
+        return message.photo[-1].file_id, ""
+    txt = (message.text or "").strip()
+    if txt.lower() == "no":
+        return "", ""
+    return "", txt
+
+def remember_image_file_id(btn, msg):
+    file_id = msg.photo[-1].file_id if msg is not None and msg.photo else None
+    if file_id and btn.get("image_file_id") != file_id:
+        btn["image_file_id"] = file_id
+        save_buttons()
+
+def send_button_image(chat_id, btn, caption):
+    file_id = btn.get("image_file_id")
+    if file_id:
         try:
-            bot.send_message(aid, text, parse_mode=parse_mode)
-            sent += 1
+            return bot.send_photo(chat_id, file_id, caption=caption, parse_mode="HTML", reply_markup=HOME_KEYBOARD)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 400 or not btn.get("image"):
+                raise
+            logger.warning("Cached image of button %s was rejected (%s), uploading it again", btn.get("id"), e.description)
+    url = btn.get("image")
+    try:
+        msg = bot.send_photo(chat_id, url, caption=caption, parse_mode="HTML", reply_markup=HOME_KEYBOARD)
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code != 400:
+            raise
+        # Telegram could not fetch the URL itself (slow or picky origin): upload the bytes
+        resp = HTTP_SESSION.get(url, timeout=IMAGE_FETCH_TIMEOUT)
+        resp.raise_for_status()
+        msg = bot.send_photo(chat_id, resp.content, caption=caption, parse_mode="HTML", reply_markup=HOME_KEYBOARD)
+    remember_image_file_id(btn, msg)
+    return msg
+
+def send_content_button(chat_id, btn):
+    text = btn.get("content", "")
+    # send image+text if exists
+    if btn.get("image_file_id") or btn.get("image"):
+        try:
+            send_button_image(chat_id, btn, text)
+            return
         except Exception as e:
-            logger.exception("Failed to send admin notification to %s: %s", aid, e)
+            logger.warning("Image of button %s could not be sent: %s", btn.get("id"), e)
+    bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=HOME_KEYBOARD)
+
+ADMIN_POOL = ThreadPoolExecutor(max_workers=ADMIN_FANOUT_WORKERS, thread_name_prefix="admin-fanout")
+ADMIN_FANOUT_STATS = {"sent": 0, "failed": 0, "timeouts": 0, "by_admin": {}}   # by_admin: id -> failures
+admin_fanout_lock = Lock()   # fan_out_to_admins runs in every update worker
+
+def admin_recipients():
+    return set([a["id"] for a in ADMINS.get("admins", [])] + list(ADMIN_IDS))
+
+def fan_out_to_admins(send):
+    """ينفذ send(admin_id) لكل الأدمن بالتوازي ويعيد عدد الإرسالات الناجحة"""
+    started = {}   # admin id -> when a pool worker picked up its send
+
+    def timed_send(aid):
+        started[aid] = time.monotonic()
+        return send(aid)
+
+    futures = {ADMIN_POOL.submit(timed_send, aid): aid for aid in admin_recipients()}
+    # each send gets ADMIN_SEND_TIMEOUT + 1 from when it starts, not from when it was queued:
+    # with more admins than pool workers the later ones only start once earlier ones finish
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        deadlines = {fut: started[futures[fut]] + ADMIN_SEND_TIMEOUT + 1 for fut in pending if futures[fut] in started}
+        live = [fut for fut in pending if deadlines.get(fut, now + 1) > now]
+        if not live:
+            break   # everything left has run past its deadline
+        # sends still in the queue have no deadline yet: look again shortly
+        queued = len(deadlines) < len(pending)
+        wake = min([deadlines[fut] for fut in live if fut in deadlines] + ([now + 0.1] if queued else []))
+        wait_futures(live, timeout=wake - now, return_when=FIRST_COMPLETED)
+        pending = {fut for fut in pending if not fut.done()}
+    sent, timeouts, failed = 0, 0, []
+    for fut, aid in futures.items():
+        if fut in pending:
+            timeouts += 1
+        elif fut.exception() is None:
+            sent += 1
+            continue
+        else:
+            logger.error("Failed to send admin notification to %s: %s", aid, fut.exception())
+        failed.append(aid)
+    # += on shared ints is not atomic across threads: apply the tallies under the lock
+    with admin_fanout_lock:
+        ADMIN_FANOUT_STATS["sent"] += sent
+        ADMIN_FANOUT_STATS["timeouts"] += timeouts
+        ADMIN_FANOUT_STATS["failed"] += len(failed)
+        for aid in failed:
+            ADMIN_FANOUT_STATS["by_admin"][aid] = ADMIN_FANOUT_STATS["by_admin"].get(aid, 0) + 1
     return sent
 
+def send_to_admins(text, parse_mode="HTML"):
+    return fan_out_to_admins(lambda aid: bot.send_message(aid, text, parse_mode=parse_mode, timeout=ADMIN_SEND_TIMEOUT))
+
 # ----------------------------
 #  --- رسالة البداية -----
 # ----------------------------
@@ -234,28 +2734,59 @@ WELCOME_HTML = CONFIG.get("WELCOME_HTML") or (
 #  --- الدوال الأساسية للتعامل مع المستخدمين -----
 # ----------------------------
 @bot.message_handler(commands=["start", "help"])
+@timed_handler()
 def cmd_start(message):
-    global USERS
     uid = str(message.chat.id)
     if uid not in USERS:
-        USERS[uid] = {
+        user = {
             "id": message.chat.id,
             "name": message.from_user.full_name or message.from_user.first_name,
             "first_seen": datetime.now().isoformat(),
             "awaiting": None,   # info structure when awaiting user input: {"button_id":..., "prompt":...}
             "lang": "ar"
         }
-        save_json(USERS_FILE, USERS)
+        save_user(uid, user)
+        STATS.user_created(user)
     # bot status check
     if CONFIG.get("BOT_STATUS", "on") == "off" and not is_admin(message.chat.id):
         bot.send_message(message.chat.id, "🚫 البوت متوقف حالياً. تواصل مع الأدمن إذا كنت في حاجة.")
         return
     # send welcome and main menu
-    bot.send_message(message.chat.id, WELCOME_HTML, reply_markup=build_keyboard_from_buttons(BUTTONS.get("main_menu", [])))
+    bot.send_message(message.chat.id, WELCOME_HTML, reply_markup=MENU.main_keyboard)
+
+ORDER_STATUS_LABELS = {
+    "pending": "⏳ قيد المراجعة",
+    "needs_more": "✏️ بانتظار معلومات إضافية",
+    "approved": "✅ تمت الموافقة",
+    "rejected": "❌ مرفوض",
+}
+
+def my_orders_text(user_id):
+    orders = user_orders(user_id, 10)
+    if not orders:
+        return "لا توجد لديك طلبات حتى الآن."
+    lines = ["📋 آخر طلباتك:"]
+    for o in orders:
+        lines.append(f"\n📦 {o.get('button_text')}\n🆔 {o.get('order_id')}\n{ORDER_STATUS_LABELS.get(o.get('status'), o.get('status'))} — {(o.get('created_at') or '')[:16].replace('T', ' ')}")
+    return "\n".join(lines)
+
+@bot.message_handler(commands=["myorders"])
+@timed_handler()
+def cmd_my_orders(message):
+    bot.send_message(message.chat.id, my_orders_text(message.chat.id), reply_markup=HOME_KEYBOARD)
+
+# commands that have their own handlers; catch_all must not swallow them
+BOT_COMMANDS = {"start", "help", "admin", "myorders", "find"}
+
+def is_bot_command(message):
+    return message.content_type == "text" and telebot.util.extract_command(message.text) in BOT_COMMANDS
 
 # منع الروابط أو رسائل حرة عندما لا ننتظر input من المستخدم
-@bot.message_handler(func=lambda m: True, content_types=['text', 'photo'])
+@bot.message_handler(func=lambda m: not is_bot_command(m), content_types=['text', 'photo'])
+@timed_handler()
 def catch_all(message):
+    if flood_limited(message.chat.id, "message", lambda text: bot.send_message(message.chat.id, text)):
+        return
     uid = str(message.chat.id)
     # admins can send free messages to bot (for admin flows)
     if is_admin(message.chat.id):
@@ -263,8 +2794,14 @@ def catch_all(message):
         session = admin_sessions.get(message.chat.id)
         if session:
             handle_admin_session_input(message, session)
+            save_session(message.chat.id, session)
             return
         # otherwise allow admin commands through standard handlers (/admin)
+    # a pending next step (e.g. CONTACT|send) consumes this message
+    step = pending_steps.pop(message.chat.id, None)
+    if step in NEXT_STEP_HANDLERS:
+        NEXT_STEP_HANDLERS[step](message)
+        return
     # If user is awaiting info for a previous request, process it
     user = USERS.get(uid)
     if user and user.get("awaiting"):
@@ -275,7 +2812,7 @@ def catch_all(message):
             txt = message.text or ""
             if (txt.startswith("http://") or txt.startswith("https://")):
                 bot.send_message(message.chat.id, "🚫 إرسال الروابط غير مسموح. استخدم النص أو الصورة أو الأرقام فقط.")
-                bot.send_message(message.chat.id, "🔁 الرجاء إعادة إرسال المعلومات المطلوبة أو اضغط على 🏠 للعودة.", reply_markup=build_keyboard_from_buttons(BUTTONS.get("main_menu")))
+                bot.send_message(message.chat.id, "🔁 الرجاء إعادة إرسال المعلومات المطلوبة أو اضغط على 🏠 للعودة.", reply_markup=MENU.main_keyboard)
                 return
         # Accept photo optionally
         content = None
@@ -297,11 +2834,9 @@ def catch_all(message):
             "created_at": datetime.now().isoformat(),
             "notes": ""
         }
-        ORDERS.append(order)
-        save_json(ORDERS_FILE, ORDERS)
-        # clear awaiting
-        USERS[uid]["awaiting"] = None
-        save_json(USERS_FILE, USERS)
+        # clear awaiting; add_order saves the user together with its order counters
+        user["awaiting"] = None
+        add_order(order, user)
         # notify user and admins
         bot.send_message(message.chat.id, "✅ طلبك قيد المراجعة سيتم إعلامك بالنتيجة بأسرع وقت ممكن ✅")
         send_to_admins(f"📥 طلب جديد\n\n👤 {order['user_name']} (ID: {order['user_id']})\n📦 خدمة: {order['button_text']}\n🆔 OrderID: {order['order_id']}\n📝 المحتوى: {'صورة' if isinstance(order['info'], str) and order['info'].startswith('[PHOTO]') else order['info']}")
@@ -311,27 +2846,41 @@ def catch_all(message):
     if not (user and user.get("awaiting")):
         if not is_admin(message.chat.id):
             bot.send_message(message.chat.id, "⚠️ لا يمكنك إرسال رسائل مباشرة. استخدم الأزرار المتاحة. للتواصل مع الأدمن اضغط زر 'تواصل مع الأدمن'.")
-            bot.send_message(message.chat.id, WELCOME_HTML, reply_markup=build_keyboard_from_buttons(BUTTONS.get("main_menu", [])))
+            bot.send_message(message.chat.id, WELCOME_HTML, reply_markup=MENU.main_keyboard)
             return
     # If admin and not in session, ignore here (admin commands handled elsewhere)
 
 # ----------------------------
 #  --- التعامل مع ضغط الأزرار (Callback Query) -----
 # ----------------------------
+CALLBACK_PREFIXES = {"NAV", "BTN", "CONTACT", "OL", "OLS", "OLU", "ADMIN", "BCAST", "BSEG", "SCHED", "ORDER", "FIND"}
+
+def callback_prefix(call):
+    # bounded label set: callback data is client-controlled
+    prefix = (call.data or "").split("|", 1)[0]
+    return prefix if prefix in CALLBACK_PREFIXES else "other"
+
 @bot.callback_query_handler(func=lambda call: True)
+@timed_handler(callback_prefix)
 def handle_callback(call):
+    if flood_limited(call.from_user.id, "callback_query", lambda text: bot.answer_callback_query(call.id, text)):
+        return
     data = call.data
     uid = call.from_user.id
     # navigation keys
     if data.startswith("NAV|"):
         nav = data.split("|", 1)[1]
         if nav == "home":
-            bot.edit_message_text(WELCOME_HTML, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=build_keyboard_from_buttons(BUTTONS.get("main_menu", [])))
+            bot.edit_message_text(WELCOME_HTML, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=MENU.main_keyboard)
+            bot.answer_callback_query(call.id)
+            return
+        if nav == "myorders":
+            bot.send_message(call.message.chat.id, my_orders_text(uid), reply_markup=HOME_KEYBOARD)
             bot.answer_callback_query(call.id)
             return
         if nav == "back":
             # simple approach: go to main menu
-            bot.edit_message_text(WELCOME_HTML, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=build_keyboard_from_buttons(BUTTONS.get("main_menu", [])))
+            bot.edit_message_text(WELCOME_HTML, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=MENU.main_keyboard)
             bot.answer_callback_query(call.id)
             return
 
@@ -347,18 +2896,17 @@ def handle_callback(call):
     # normal button id
     if data.startswith("BTN|"):
         btn_id = data.split("|",1)[1]
-        btn = find_button_by_id(btn_id, BUTTONS.get("main_menu", []))
+        btn = find_button_by_id(btn_id)
         if not btn:
             bot.answer_callback_query(call.id, "هذا الزر غير موجود الآن.")
             return
         # if submenu -> show submenu keyboard
         if btn.get("type") == "submenu":
-            submenu = btn.get("submenu", [])
             # show as new message or edit message depending on permission
             try:
-                bot.edit_message_text(f"<b>{btn.get('text')}</b>\nاختر من القائمة:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=build_submenu_keyboard(submenu))
+                bot.edit_message_text(f"<b>{btn.get('text')}</b>\nاختر من القائمة:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=MENU.submenu_keyboard(btn))
             except Exception:
-                bot.send_message(call.message.chat.id, f"<b>{btn.get('text')}</b>\nاختر من القائمة:", parse_mode="HTML", reply_markup=build_submenu_keyboard(submenu))
+                bot.send_message(call.message.chat.id, f"<b>{btn.get('text')}</b>\nاختر من القائمة:", parse_mode="HTML", reply_markup=MENU.submenu_keyboard(btn))
             bot.answer_callback_query(call.id)
             return
         # contact admin
@@ -372,42 +2920,86 @@ def handle_callback(call):
             return
         # content
         if btn.get("type") == "content":
-            text = btn.get("content", "")
-            image = btn.get("image", "")
-            # send image+text if exists
-            if image:
-                try:
-                    bot.send_photo(call.message.chat.id, image, caption=text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 الرئيسية", callback_data="NAV|home")]]))
-                except Exception as e:
-                    bot.send_message(call.message.chat.id, text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 الرئيسية", callback_data="NAV|home")]]))
-            else:
-                bot.send_message(call.message.chat.id, text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 الرئيسية", callback_data="NAV|home")]]))
+            send_content_button(call.message.chat.id, btn)
             bot.answer_callback_query(call.id)
             return
         # request_info
         if btn.get("type") == "request_info":
             # set user's awaiting
-            USERS[str(call.from_user.id)] = USERS.get(str(call.from_user.id), {
-                "id": call.from_user.id,
-                "name": call.from_user.full_name or call.from_user.first_name,
-                "first_seen": datetime.now().isoformat(),
-                "awaiting": None
-            })
-            USERS[str(call.from_user.id)]["awaiting"] = {"button_id": btn.get("id"), "button_text": btn.get("text"), "prompt": btn.get("info_request", "أرسل المعلومات المطلوبة:")}
-            save_json(USERS_FILE, USERS)
-            bot.send_message(call.message.chat.id, USERS[str(call.from_user.id)]["awaiting"]["prompt"], reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 الرئيسية", callback_data="NAV|home")]]))
+            user = USERS.get(str(call.from_user.id))
+            if user is None:
+                user = {
+                    "id": call.from_user.id,
+                    "name": call.from_user.full_name or call.from_user.first_name,
+                    "first_seen": datetime.now().isoformat(),
+                    "awaiting": None
+                }
+                STATS.user_created(user)
+            user["awaiting"] = {"button_id": btn.get("id"), "button_text": btn.get("text"), "prompt": btn.get("info_request", "أرسل المعلومات المطلوبة:")}
+            save_user(str(call.from_user.id), user)
+            bot.send_message(call.message.chat.id, user["awaiting"]["prompt"], reply_markup=HOME_KEYBOARD)
             bot.answer_callback_query(call.id)
             return
 
-    # handle contact sub action: CONTACT|send
-    if data.startswith("CONTACT|"):
-        sub = data.split("|",1)[1]
-        if sub == "send":
-            # ask user to send message to admin
-            bot.send_message(call.message.chat.id, "✉️ أرسل رسالتك للأدمن الآن (يمكنك كتابة نص أو صورة):")
-            # register next step
-            bot.register_next_step_handler(call.message, user_send_message_to_admin)
-            bot.answer_callback_query(call.id)
+    # handle contact sub action: CONTACT|send
+    if data.startswith("CONTACT|"):
+        sub = data.split("|",1)[1]
+        if sub == "send":
+            # ask user to send message to admin
+            bot.send_message(call.message.chat.id, "✉️ أرسل رسالتك للأدمن الآن (يمكنك كتابة نص أو صورة):")
+            # register next step
+            pending_steps[call.message.chat.id] = "contact_admin"
+            bot.answer_callback_query(call.id)
+            return
+
+    # admin order browser: OL| (page), OLS| (service picker), OLU| (user filter)
+    if data.startswith(("OL|", "OLS|", "OLU|")):
+        if not is_admin(uid):
+            bot.answer_callback_query(call.id, "ممنوع - للأدمن فقط")
+            return
+        handle_order_browser(call, data)
+        return
+
+    # broadcast controls: BCAST|<job_id>|pause/resume/cancel/refresh
+    if data.startswith("BCAST|"):
+        if not is_admin(uid):
+            bot.answer_callback_query(call.id, "ممنوع - للأدمن فقط")
+            return
+        parts = data.split("|")
+        if len(parts) >= 3:
+            handle_broadcast_control(call, parts[1], parts[2])
+            return
+
+    if data.startswith("BSEG|"):
+        if not is_admin(uid):
+            bot.answer_callback_query(call.id, "ممنوع - للأدمن فقط")
+            return
+        handle_audience_choice(call, data.split("|", 1)[1])
+        return
+
+    if data.startswith("FIND|"):
+        if not is_admin(uid):
+            bot.answer_callback_query(call.id, "ممنوع - للأدمن فقط")
+            return
+        query = FIND_QUERIES.get(str(uid))
+        if not query:
+            bot.answer_callback_query(call.id, "انتهت صلاحية هذا البحث، أعد إرسال /find")
+            return
+        text, kb = find_results_page(query, int(data.split("|", 1)[1] or 0))
+        try:
+            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=kb)
+        except Exception:
+            bot.send_message(call.message.chat.id, text, reply_markup=kb)
+        bot.answer_callback_query(call.id)
+        return
+
+    if data.startswith("SCHED|"):
+        if not is_admin(uid):
+            bot.answer_callback_query(call.id, "ممنوع - للأدمن فقط")
+            return
+        parts = data.split("|")
+        if len(parts) >= 3:
+            handle_schedule_control(call, parts[1], parts[2])
             return
 
     # admin order actions: ORDER|<order_id>|action
@@ -436,34 +3028,31 @@ def user_send_message_to_admin(message):
             file_id = message.photo[-1].file_id
             text = f"[صورة مرفقة]"
             # send photo to admins with caption
-            for a in set(list(ADMIN_IDS) + [adm["id"] for adm in ADMINS.get("admins", [])]):
-                try:
-                    bot.send_photo(a, file_id, caption=f"📩 رسالة من {message.from_user.full_name} (ID:{message.from_user.id})\n\n{text}")
-                except Exception:
-                    pass
+            caption = f"📩 رسالة من {message.from_user.full_name} (ID:{message.from_user.id})\n\n{text}"
+            fan_out_to_admins(lambda a: bot.send_photo(a, file_id, caption=caption, timeout=ADMIN_SEND_TIMEOUT))
             bot.send_message(message.chat.id, "✅ تم إرسال رسالتك إلى الأدمن.")
             return
         # else text
-        for a in set(list(ADMIN_IDS) + [adm["id"] for adm in ADMINS.get("admins", [])]):
-            try:
-                bot.send_message(a, f"📩 رسالة من {message.from_user.full_name} (ID:{message.from_user.id}):\n\n{message.text}")
-            except Exception:
-                pass
+        text = f"📩 رسالة من {message.from_user.full_name} (ID:{message.from_user.id}):\n\n{message.text}"
+        fan_out_to_admins(lambda a: bot.send_message(a, text, timeout=ADMIN_SEND_TIMEOUT))
         bot.send_message(message.chat.id, "✅ تم إرسال رسالتك إلى الأدمن.")
     except Exception as e:
         logger.exception("user_send_message_to_admin failed: %s", e)
         bot.send_message(message.chat.id, "حدث خطأ أثناء إرسال الرسالة.")
 
+NEXT_STEP_HANDLERS = {"contact_admin": user_send_message_to_admin}
+
 # ----------------------------
 #  --- إدارة الطلبات من الأدمن (عرض / قبول /رفض /طلب تعديل) ---
 # ----------------------------
 def handle_admin_order_action(call, order_id, action):
-    # find order
-    order = None
-    for o in ORDERS:
-        if o.get("order_id") == order_id:
-            order = o
-            break
+    order = get_order(order_id)
+    if not order and action == "view":
+        # handled orders move to the archive after ARCHIVE_AFTER_DAYS; they can be viewed, not changed
+        order = find_archived_order(order_id)
+        if order:
+            bot.send_message(call.message.chat.id, f"🗄 طلب مؤرشف\n📦 OrderID: {order_id}\n👤 المستخدم: {order.get('user_name')} ({order.get('user_id')})\n📌 الخدمة: {order.get('button_text')}\n📝 المحتوى: {order.get('info')}\n\nالحالة: {order.get('status')}")
+            return
     if not order:
         bot.send_message(call.message.chat.id, "❌ لم أجد الطلب.")
         return
@@ -476,9 +3065,7 @@ def handle_admin_order_action(call, order_id, action):
         bot.send_message(call.message.chat.id, f"📦 OrderID: {order_id}\n👤 المستخدم: {order.get('user_name')} ({order.get('user_id')})\n📌 الخدمة: {order.get('button_text')}\n📝 المحتوى: {order.get('info')}\n\nالحالة: {order.get('status')}", reply_markup=kb)
         return
     if action == "approve":
-        order["status"] = "approved"
-        order["handled_at"] = datetime.now().isoformat()
-        save_json(ORDERS_FILE, ORDERS)
+        update_order(order, status="approved", handled_at=datetime.now().isoformat())
         # notify user
         try:
             bot.send_message(order["user_id"], f"✅ تمت الموافقة على طلبك (OrderID: {order_id}). سيتم إتمام الخدمة قريباً. شكراً لتعاملكم.")
@@ -487,9 +3074,7 @@ def handle_admin_order_action(call, order_id, action):
         bot.send_message(call.message.chat.id, "تمت الموافقة وإشعار المستخدم.")
         return
     if action == "reject":
-        order["status"] = "rejected"
-        order["handled_at"] = datetime.now().isoformat()
-        save_json(ORDERS_FILE, ORDERS)
+        update_order(order, status="rejected", handled_at=datetime.now().isoformat())
         try:
             bot.send_message(order["user_id"], f"❌ تم رفض طلبك (OrderID: {order_id}). إذا رغبت بالمساعدة تواصل مع الأدمن.")
         except Exception:
@@ -497,18 +3082,408 @@ def handle_admin_order_action(call, order_id, action):
         bot.send_message(call.message.chat.id, "تم الرفض وإشعار المستخدم.")
         return
     if action == "askmore":
-        order["status"] = "needs_more"
-        order["handled_at"] = datetime.now().isoformat()
-        save_json(ORDERS_FILE, ORDERS)
+        update_order(order, status="needs_more", handled_at=datetime.now().isoformat())
         # ask admin to send follow-up question text
         bot.send_message(call.message.chat.id, "✏️ أرسل نص السؤال أو الطلب الإضافي الذي سيصل للمستخدم:")
         # create session for admin to input follow-up text and map to order_id
         admin_sessions[call.from_user.id] = {"action": "askmore_input", "order_id": order_id}
         return
 
+# ----------------------------
+#  --- محرك البث الجماعي (rate limit + استئناف) -----
+# ----------------------------
+class TokenBucket:
+    """محدد معدل: rate توكن في الثانية بسعة capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, n=1):
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return False
+            self._refill(now)
+            if self.tokens >= n:
+                self.tokens -= n
+                return True
+            return False
+
+    def acquire(self, n=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = max(self.blocked_until - now, (n - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def hold(self, seconds):
+        # Telegram answered 429: nobody sends until retry_after has passed
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+TELEGRAM_BUCKET = TokenBucket(BROADCAST_RATE)
+BROADCAST_POOL = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="broadcast")
+BROADCASTS = open_shared_state("broadcasts", None if SHARED_STATE else load_json(BROADCASTS_FILE, {}))   # job_id -> job dict
+broadcasts_lock = Lock()
+
+def save_broadcasts():
+    if SHARED_STATE:
+        return   # already persisted by SqliteState
+    with broadcasts_lock:
+        snapshot = json_snapshot(BROADCASTS)
+    with file_lock(BROADCASTS_FILE):
+        atomic_write_json(BROADCASTS_FILE, snapshot)
+
+def update_broadcast(job, **fields):
+    # merge only the given fields: the runner writes progress while an admin
+    # (possibly in another process) writes status
+    job.update(BROADCASTS.merge(job["id"], fields))
+    save_broadcasts()
+
+def refresh_broadcast(job):
+    job.update(BROADCASTS.get(job["id"]) or {})
+
+def prune_broadcasts():
+    # every checkpoint rewrites broadcasts.json: keep only the newest finished jobs
+    with broadcasts_lock:
+        finished = sorted((j for j in BROADCASTS.values() if j.get("status") in ("done", "cancelled")),
+                          key=lambda j: j.get("finished_at") or j.get("created_at") or "")
+        stale = finished[:max(0, len(finished) - BROADCAST_KEEP_FINISHED)]
+        for job in stale:
+            BROADCASTS.pop(job["id"], None)
+    return len(stale)
+
+def iter_audience(audience, after=None):
+    # a lazy stream of chat ids in id order; the spec and the last id sent are kept on
+    # the job, so a resumed broadcast continues after that id whoever joined meanwhile
+    if audience == "all":
+        return STORAGE.iter_user_ids(after)
+    ORDERS_READY.wait()
+    return USER_INDEX.stream(audience, after)
+
+def audience_picker():
+    refresh_user_index()
+    kb = InlineKeyboardMarkup()
+    specs = ["all", "active:7", "active:30"]
+    with USER_INDEX.lock:
+        specs += [f"service:{bid}" for bid, lst in USER_INDEX.by_service.items() if lst]
+        specs += [f"lang:{lang}" for lang, lst in USER_INDEX.by_lang.items() if lst and lang != "unknown"]
+    for spec in specs:
+        data = f"BSEG|{spec}"
+        if len(data.encode("utf-8")) <= 64:
+            kb.add(InlineKeyboardButton(f"{audience_label(spec)} ({audience_count(spec)})", callback_data=data))
+    kb.add(InlineKeyboardButton("❌ إلغاء", callback_data="BSEG|cancel"))
+    return kb
+
+def send_broadcast_message(chat_id, text):
+    """يرسل رسالة واحدة مع إعادة المحاولة، ويعيد sent أو blocked أو failed"""
+    attempt, rate_waited = 0, 0.0
+    while attempt < BROADCAST_MAX_RETRIES:
+        TELEGRAM_BUCKET.acquire()
+        try:
+            bot.send_message(int(chat_id), text)
+            return "sent"
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                # being rate limited is not a failure: wait and retry without using up an attempt
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                TELEGRAM_BUCKET.hold(retry_after)
+                rate_waited += retry_after
+                if rate_waited > BROADCAST_MAX_RATE_WAIT:
+                    return "failed"
+                continue
+            if e.error_code == 403:
+                return "blocked"   # user blocked the bot or deleted the account
+            if e.error_code < 500:
+                return "failed"
+        except Exception:
+            pass   # network errors: back off and retry like a 5xx
+        time.sleep(min(2 ** attempt, 30))
+        attempt += 1
+    return "failed"
+
+def broadcast_progress_text(job):
+    state = {"running": "⏳ جارٍ الإرسال", "paused": "⏸ متوقف مؤقتاً", "cancelled": "⛔️ ملغى", "done": "✅ اكتمل"}.get(job["status"], job["status"])
+    return (f"📢 بث {job['id']} — {state}\n🎯 {audience_label(job.get('audience', 'all'))}\n\n"
+            f"📨 تمت المعالجة: {job['offset']}/{job['total']}\n"
+            f"✅ أُرسل: {job['sent']}\n❌ فشل: {job['failed']}\n🚫 محظور: {job['blocked']}")
+
+def broadcast_controls(job):
+    kb = InlineKeyboardMarkup()
+    if job["status"] == "running":
+        kb.add(InlineKeyboardButton("⏸ إيقاف مؤقت", callback_data=f"BCAST|{job['id']}|pause"))
+    elif job["status"] == "paused":
+        kb.add(InlineKeyboardButton("▶️ استئناف", callback_data=f"BCAST|{job['id']}|resume"))
+    if job["status"] in ("running", "paused"):
+        kb.add(InlineKeyboardButton("⛔️ إلغاء", callback_data=f"BCAST|{job['id']}|cancel"))
+        kb.add(InlineKeyboardButton("🔄 تحديث", callback_data=f"BCAST|{job['id']}|refresh"))
+    return kb
+
+def report_broadcast_progress(job):
+    if not job.get("progress_message_id"):
+        return
+    try:
+        bot.edit_message_text(broadcast_progress_text(job), chat_id=job["admin_id"], message_id=job["progress_message_id"], reply_markup=broadcast_controls(job))
+    except Exception:
+        pass   # "message is not modified" and similar are harmless here
+
+def run_broadcast(job):
+    if job.get("last_uid") is None and job["offset"]:
+        # checkpointed before last_uid existed
+        ids = itertools.islice(iter_audience(job.get("audience", "all")), job["offset"], None)
+    else:
+        ids = iter_audience(job.get("audience", "all"), job.get("last_uid"))
+    last_report = time.monotonic()
+    while True:
+        refresh_broadcast(job)
+        while job["status"] == "paused":
+            time.sleep(1)
+            refresh_broadcast(job)
+        if job["status"] != "running":
+            break
+        chunk = list(itertools.islice(ids, BROADCAST_CHUNK))
+        if not chunk:
+            update_broadcast(job, status="done")
+            break
+        counts = {"sent": 0, "failed": 0, "blocked": 0}
+        for result in BROADCAST_POOL.map(lambda cid: send_broadcast_message(cid, job["text"]), chunk):
+            counts[result] += 1
+        # checkpoint after every chunk: a restart re-sends at most one chunk
+        update_broadcast(job, offset=job["offset"] + len(chunk), last_uid=chunk[-1], sent=job["sent"] + counts["sent"],
+                         failed=job["failed"] + counts["failed"], blocked=job["blocked"] + counts["blocked"])
+        if time.monotonic() - last_report >= 3:
+            report_broadcast_progress(job)
+            last_report = time.monotonic()
+    update_broadcast(job, finished_at=datetime.now().isoformat() if job["status"] in ("done", "cancelled") else None)
+    if prune_broadcasts():
+        save_broadcasts()
+    report_broadcast_progress(job)
+
+def start_broadcast(text, admin_id, audience="all"):
+    if audience != "all":
+        refresh_user_index()   # users may have been updated by other processes
+    job = {
+        "id": uuid.uuid4().hex[:8],
+        "text": text,
+        "admin_id": admin_id,
+        "audience": audience,
+        "status": "running",
+        "total": audience_count(audience),
+        "offset": 0,
+        "last_uid": None,
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "created_at": datetime.now().isoformat(),
+        "progress_message_id": None,
+    }
+    if admin_id:
+        try:
+            msg = bot.send_message(admin_id, broadcast_progress_text(job), reply_markup=broadcast_controls(job))
+            job["progress_message_id"] = msg.message_id
+        except Exception as e:
+            logger.exception("Failed to send broadcast progress message: %s", e)
+    with broadcasts_lock:
+        BROADCASTS[job["id"]] = job
+    save_broadcasts()
+    threading.Thread(target=run_broadcast, args=(job,), name=f"broadcast-{job['id']}", daemon=True).start()
+    return job
+
+def resume_broadcasts():
+    # jobs interrupted by a restart continue from their last checkpoint; paused ones wait for the admin
+    if prune_broadcasts():
+        save_broadcasts()
+    for job in list(BROADCASTS.values()):
+        if job.get("status") in ("running", "paused"):
+            threading.Thread(target=run_broadcast, args=(job,), name=f"broadcast-{job['id']}", daemon=True).start()
+
+def handle_broadcast_control(call, job_id, action):
+    job = BROADCASTS.get(job_id)
+    if not job:
+        bot.answer_callback_query(call.id, "لم أجد هذا البث.")
+        return
+    if action == "pause" and job["status"] == "running":
+        update_broadcast(job, status="paused")
+    elif action == "resume" and job["status"] == "paused":
+        update_broadcast(job, status="running")
+    elif action == "cancel" and job["status"] in ("running", "paused"):
+        update_broadcast(job, status="cancelled")
+    try:
+        bot.edit_message_text(broadcast_progress_text(job), chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=broadcast_controls(job))
+    except Exception:
+        pass
+    bot.answer_callback_query(call.id)
+
+# ----------------------------
+#  --- الحماية من الإغراق (حد لكل محادثة) -----
+# ----------------------------
+# Every free-text message costs two sends and every button press may touch storage,
+# so each chat gets its own TokenBucket. Over the limit the update is dropped; the
+# first drop in FLOOD_NOTICE_COOLDOWN seconds gets a short "slow down" answer.
+# The buckets live in this process only (with gunicorn -w N each worker counts alone).
+FLOOD_NOTICE = "⏳ تمهّل قليلاً، أرسل طلبك بعد لحظات."
+
+class FloodGuard:
+    """TokenBucket لكل محادثة؛ يحتفظ بآخر max_chats محادثة نشطة فقط"""
+
+    def __init__(self, rate, burst, notice_cooldown, max_chats):
+        self.rate = rate
+        self.burst = burst
+        self.notice_cooldown = notice_cooldown
+        self.max_chats = max_chats
+        self.chats = OrderedDict()   # chat_id -> [TokenBucket, last notice time]
+        self.lock = Lock()
+
+    def check(self, chat_id):
+        """يعيد "ok" أو "notify" (أول تجاوز خلال المهلة) أو "drop" """
+        with self.lock:
+            entry = self.chats.get(chat_id)
+            if entry is None:
+                entry = self.chats[chat_id] = [TokenBucket(self.rate, self.burst), 0.0]
+                if len(self.chats) > self.max_chats:
+                    self.chats.popitem(last=False)
+            else:
+                self.chats.move_to_end(chat_id)
+        if entry[0].try_acquire():
+            return "ok"
+        now = time.monotonic()
+        with self.lock:
+            if now - entry[1] < self.notice_cooldown:
+                return "drop"
+            entry[1] = now
+        return "notify"
+
+FLOOD = FloodGuard(FLOOD_RATE, FLOOD_BURST, FLOOD_NOTICE_COOLDOWN, FLOOD_MAX_CHATS)
+
+def flood_limited(chat_id, kind, notify):
+    """True إذا تجاوزت المحادثة الحد (المشرفون مستثنون)؛ notify(text) ترسل تنبيه التهدئة"""
+    if FLOOD_RATE <= 0 or is_admin(chat_id):
+        return False
+    verdict = FLOOD.check(chat_id)
+    if verdict == "ok":
+        return False
+    FLOOD_DROPPED.inc((kind,))
+    if verdict == "notify":
+        try:
+            notify(FLOOD_NOTICE)
+        except Exception as e:
+            logger.debug("Flood notice to %s failed: %s", chat_id, e)
+    return True
+
+# ----------------------------
+#  --- متصفح الطلبات للأدمن (صفحات + فلاتر) -----
+# ----------------------------
+# Callback format: OL|<status>|<button_id>|<user_id>|<cursor>, "*" meaning no filter.
+# The cursor is "" for the first page, "b<seq>" for older than seq and "a<seq>" for newer.
+ORDERS_PAGE_SIZE = int(CONFIG.get("ORDERS_PAGE_SIZE", 10))
+
+def order_list_callback(status, button_id, user_id, cursor=""):
+    data = f"OL|{status or '*'}|{button_id or '*'}|{user_id or '*'}|{cursor}"
+    return data if len(data.encode("utf-8")) <= 64 else None   # Telegram limit for callback_data
+
+def callback_buttons(*pairs):
+    # (label, data) -> buttons, leaving out the ones whose data was too long (None)
+    return [InlineKeyboardButton(label, callback_data=data) for label, data in pairs if data]
+
+def order_browser_page(status=None, button_id=None, user_id=None, cursor=""):
+    before = int(cursor[1:]) if cursor.startswith("b") else None
+    after = int(cursor[1:]) if cursor.startswith("a") else None
+    ORDERS_READY.wait()
+    rows, has_older, has_newer = STORAGE.order_page(status, button_id, user_id, before, after, ORDERS_PAGE_SIZE)
+    service = MENU.find(button_id).get("text") if button_id and MENU.find(button_id) else button_id
+    text = (f"📦 الطلبات (الأحدث أولاً)\n"
+            f"الحالة: {ORDER_STATUS_LABELS.get(status, 'الكل')} | الخدمة: {service or 'الكل'} | المستخدم: {user_id or 'الكل'}")
+    if not rows:
+        text += "\n\nلا توجد طلبات مطابقة."
+    kb = InlineKeyboardMarkup()
+    for _, o in rows:
+        label = f"{ORDER_STATUS_LABELS.get(o.get('status'), o.get('status'))[:1]} {o.get('button_text')} - {o.get('user_name')}"
+        kb.add(InlineKeyboardButton(label, callback_data=f"ORDER|{o.get('order_id')}|view"))
+    # a long button_id can push callback_data past 64 bytes: those buttons are left out
+    nav = callback_buttons(
+        ("⬅️ أحدث", rows and has_newer and order_list_callback(status, button_id, user_id, f"a{rows[0][0]}")),
+        ("أقدم ➡️", rows and has_older and order_list_callback(status, button_id, user_id, f"b{rows[-1][0]}")))
+    if nav:
+        kb.row(*nav)
+    statuses = callback_buttons(*[(("• " if s == status else "") + ORDER_STATUS_LABELS[s][:1], order_list_callback(s, button_id, user_id))
+                                  for s in ORDER_STATUS_LABELS])
+    if statuses:
+        kb.row(*statuses)
+    user_filter = f"OLU|{status or '*'}|{button_id or '*'}"
+    kb.row(*callback_buttons(("الكل", order_list_callback(None, None, None)),
+                             ("🔎 الخدمة", f"OLS|{status or '*'}|{user_id or '*'}"),
+                             ("👤 المستخدم", user_filter if len(user_filter.encode("utf-8")) <= 64 else None)))
+    return text, kb
+
+def service_picker(status, user_id):
+    kb = InlineKeyboardMarkup()
+    for key, btn in MENU.nodes.items():
+        if btn.get("type") == "request_info" and key == btn.get("id"):
+            data = order_list_callback(status, key, user_id)
+            if data:
+                kb.add(InlineKeyboardButton(btn.get("text"), callback_data=data))
+    kb.add(*callback_buttons(("🔙 رجوع", order_list_callback(status, None, user_id))))
+    return kb
+
+def handle_order_browser(call, data):
+    parts = data.split("|")
+    parse = lambda v: None if v in ("*", "") else v
+    if parts[0] == "OL":
+        status, button_id, user_id, cursor = (parts + ["", "", "", ""])[1:5]
+        user_id = parse(user_id)
+        text, kb = order_browser_page(parse(status), parse(button_id), int(user_id) if user_id else None, cursor)
+        try:
+            bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb)
+        except Exception:
+            bot.send_message(call.message.chat.id, text, reply_markup=kb)
+    elif parts[0] == "OLS":
+        status, user_id = (parts + ["", ""])[1:3]
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=service_picker(parse(status), parse(user_id)))
+    elif parts[0] == "OLU":
+        status, button_id = (parts + ["", ""])[1:3]
+        bot.send_message(call.message.chat.id, "👤 أرسل ID المستخدم لعرض طلباته:")
+        admin_sessions[call.from_user.id] = {"action": "order_filter_user", "temp": {"status": parse(status), "button_id": parse(button_id)}}
+    bot.answer_callback_query(call.id)
+
 # ----------------------------
 #  --- التعامل مع جلسات الأدمن (multi-step flows) ---
 # ----------------------------
+def edit_button_finish(aid, session):
+    temp = session.get("temp", {})
+    btn = MENU.find(temp.get("id") or temp.get("text"))
+    admin_sessions.pop(aid, None)
+    if not btn:
+        bot.send_message(aid, "لم أجد الزر (ربما حُذف). تم إلغاء التعديل.")
+        return
+    if "new_text" in temp:
+        btn["text"] = temp["new_text"]
+    for field in ("content", "info_request"):
+        if field in temp:
+            btn[field] = temp[field]
+    if "image" in temp:
+        # a new source invalidates the cached file_id of the old one
+        btn["image"] = temp["image"]
+        btn.pop("image_file_id", None)
+        if temp.get("image_file_id"):
+            btn["image_file_id"] = temp["image_file_id"]
+    save_buttons()
+    bot.send_message(aid, f"✅ تم تعديل الزر {btn.get('text')}.")
+
+@timed_handler(lambda message, session: session.get("action"))
 def handle_admin_session_input(message, session):
     aid = message.from_user.id
     act = session.get("action")
@@ -516,7 +3491,7 @@ def handle_admin_session_input(message, session):
         if act == "askmore_input":
             order_id = session.get("order_id")
             # find order
-            order = next((o for o in ORDERS if o["order_id"] == order_id), None)
+            order = get_order(order_id)
             if not order:
                 bot.send_message(aid, "لم أجد الطلب.")
                 admin_sessions.pop(aid, None)
@@ -530,6 +3505,43 @@ def handle_admin_session_input(message, session):
             admin_sessions.pop(aid, None)
             return
 
+        if act == "order_filter_user":
+            try:
+                user_id = int(message.text.strip())
+            except (ValueError, AttributeError):
+                bot.send_message(aid, "الـ ID يجب أن يكون رقم.")
+                admin_sessions.pop(aid, None)
+                return
+            temp = session.get("temp", {})
+            text, kb = order_browser_page(temp.get("status"), temp.get("button_id"), user_id)
+            bot.send_message(aid, text, reply_markup=kb)
+            admin_sessions.pop(aid, None)
+            return
+
+        if act == "export_filters":
+            admin_sessions.pop(aid, None)
+            try:
+                filters = parse_export_filters((message.text or "").split())
+            except ValueError as e:
+                bot.send_message(aid, f"❌ لم أفهم: {e}. استخدم التاريخ بصيغة YYYY-MM-DD.")
+                return
+            start_export(aid, filters)
+            bot.send_message(aid, f"⏳ جاري تجهيز الملف: {export_filters_label(filters)}")
+            return
+
+        if act == "archive_search":
+            query = (message.text or "").strip()
+            admin_sessions.pop(aid, None)
+            found = search_archive(user_id=query) if query.isdigit() else search_archive(order_id=query)
+            if not found:
+                bot.send_message(aid, "لا توجد نتائج في الأرشيف.")
+                return
+            lines = [f"🗄 نتائج الأرشيف ({len(found)}):"]
+            for o in found:
+                lines.append(f"\n📦 {o.get('order_id')}\n👤 {o.get('user_name')} ({o.get('user_id')})\n📌 {o.get('button_text')} — {o.get('status')}\n🕒 {(o.get('created_at') or '')[:16]}")
+            bot.send_message(aid, "\n".join(lines))
+            return
+
         if act == "add_button_step1":
             # expecting JSON-like input steps: we use sequential prompts
             # session.temp accumulates
@@ -563,7 +3575,7 @@ def handle_admin_session_input(message, session):
                 temp = session["temp"]
                 new_btn = {"id": temp["id"], "text": temp["text"], "type": "contact_admin"}
                 BUTTONS.setdefault("main_menu", []).append(new_btn)
-                save_json(BUTTONS_FILE, BUTTONS)
+                save_buttons()
                 bot.send_message(aid, "تم إضافة زر 'تواصل مع الأدمن' بنجاح.")
                 admin_sessions.pop(aid, None)
             else:
@@ -576,7 +3588,7 @@ def handle_admin_session_input(message, session):
                 temp = session.get("temp", {})
                 new_btn = {"id": temp["id"], "text": temp["text"], "type": "submenu", "submenu": temp.get("submenu", [])}
                 BUTTONS.setdefault("main_menu", []).append(new_btn)
-                save_json(BUTTONS_FILE, BUTTONS)
+                save_buttons()
                 bot.send_message(aid, "✅ تم إضافة الزر الفرعي بنجاح.")
                 admin_sessions.pop(aid, None)
                 return
@@ -619,7 +3631,7 @@ def handle_admin_session_input(message, session):
             temp = session.get("temp", {})
             new_btn = {"id": temp["id"], "text": temp["text"], "type": "request_info", "info_request": prompt_text}
             BUTTONS.setdefault("main_menu", []).append(new_btn)
-            save_json(BUTTONS_FILE, BUTTONS)
+            save_buttons()
             bot.send_message(aid, "✅ تم إضافة زر (request_info) بنجاح.")
             admin_sessions.pop(aid, None)
             return
@@ -629,17 +3641,17 @@ def handle_admin_session_input(message, session):
             temp = session.get("temp", {})
             temp["content"] = message.text
             session["action"] = "add_button_finish_content_image"
-            bot.send_message(aid, "أضف رابط صورة (أو اكتب 'no' لتخطي):")
+            bot.send_message(aid, "أرسل صورة أو رابط صورة (أو اكتب 'no' لتخطي):")
             return
         if act == "add_button_finish_content_image":
             temp = session.get("temp", {})
-            img = message.text.strip()
-            if img.lower() == "no":
-                img = ""
+            file_id, img = read_image_input(message)
             temp["image"] = img
             new_btn = {"id": temp["id"], "text": temp["text"], "type": "content", "content": temp.get("content", ""), "image": temp.get("image", "")}
+            if file_id:
+                new_btn["image_file_id"] = file_id
             BUTTONS.setdefault("main_menu", []).append(new_btn)
-            save_json(BUTTONS_FILE, BUTTONS)
+            save_buttons()
             bot.send_message(aid, "✅ تم إضافة زر المحتوى مع الصورة (إن وُجدت).")
             admin_sessions.pop(aid, None)
             return
@@ -654,13 +3666,62 @@ def handle_admin_session_input(message, session):
                     removed = True
                     break
             if removed:
-                save_json(BUTTONS_FILE, BUTTONS)
+                save_buttons()
                 bot.send_message(aid, f"✅ تم حذف الزر {btn_id}.")
             else:
                 bot.send_message(aid, "لم أجد هذا المعرف. تأكد وحاول مرة أخرى.")
             admin_sessions.pop(aid, None)
             return
 
+        if act == "edit_button_step1":
+            btn = MENU.find((message.text or "").strip())
+            if not btn:
+                bot.send_message(aid, "لم أجد هذا المعرف. تأكد وحاول مرة أخرى.")
+                admin_sessions.pop(aid, None)
+                return
+            session["temp"] = {"id": btn.get("id"), "text": btn.get("text")}
+            session["action"] = "edit_button_text"
+            bot.send_message(aid, f"✏️ الزر: {btn.get('text')} ({btn.get('type')})\nأرسل النص الجديد للزر (أو '-' للإبقاء عليه):")
+            return
+        if act == "edit_button_text":
+            btn = MENU.find(session["temp"]["id"] or session["temp"]["text"])
+            if not btn:
+                bot.send_message(aid, "لم أجد الزر (ربما حُذف). تم إلغاء التعديل.")
+                admin_sessions.pop(aid, None)
+                return
+            txt = (message.text or "").strip()
+            if txt and txt != "-":
+                session["temp"]["new_text"] = txt
+            if btn.get("type") == "content":
+                session["action"] = "edit_button_content"
+                bot.send_message(aid, "أرسل نص المحتوى الجديد (أو '-' للإبقاء عليه):")
+            elif btn.get("type") == "request_info":
+                session["action"] = "edit_button_prompt"
+                bot.send_message(aid, "أرسل نص الطلب الجديد الذي سيراه المستخدم (أو '-' للإبقاء عليه):")
+            else:
+                edit_button_finish(aid, session)
+            return
+        if act == "edit_button_prompt":
+            txt = message.text or ""
+            if txt.strip() != "-":
+                session["temp"]["info_request"] = txt
+            edit_button_finish(aid, session)
+            return
+        if act == "edit_button_content":
+            txt = message.text or ""
+            if txt.strip() != "-":
+                session["temp"]["content"] = txt
+            session["action"] = "edit_button_image"
+            bot.send_message(aid, "أرسل صورة جديدة أو رابط صورة ('-' للإبقاء على الحالية، 'no' لحذفها):")
+            return
+        if act == "edit_button_image":
+            if (message.text or "").strip() != "-":
+                file_id, img = read_image_input(message)
+                session["temp"]["image"] = img
+                session["temp"]["image_file_id"] = file_id
+            edit_button_finish(aid, session)
+            return
+
         if act == "broadcast_step1":
             # message contains the broadcast text or 'photo' etc depending on session.temp
             # simple broadcast text-only flow
@@ -669,22 +3730,15 @@ def handle_admin_session_input(message, session):
             session_temp = session.get("temp", {})
             session_temp["text"] = text
             bot.send_message(aid, "🔁 معاينة البث:\n\n" + text)
-            bot.send_message(aid, "هل تريد الإرسال الآن إلى كل المستخدمين؟ اكتب 'yes' للإرسال أو 'no' للإلغاء.")
+            bot.send_message(aid, "🎯 اختر الشريحة التي سيصلها البث (أو اكتب 'yes' للإرسال للجميع و 'no' للإلغاء):", reply_markup=audience_picker())
             session["action"] = "broadcast_confirm"
             return
 
         if act == "broadcast_confirm":
             if message.text.strip().lower() == "yes":
                 text = session.get("temp", {}).get("text", "")
-                # send to all users
-                sent = 0
-                for uid, u in USERS.items():
-                    try:
-                        bot.send_message(int(uid), text)
-                        sent += 1
-                    except Exception:
-                        pass
-                bot.send_message(aid, f"✅ تم الإرسال إلى {sent} مستخدم.")
+                # runs in the background; progress is edited into the message it sends
+                start_broadcast(text, aid)
             else:
                 bot.send_message(aid, "تم إلغاء البث.")
             admin_sessions.pop(aid, None)
@@ -700,7 +3754,7 @@ def handle_admin_session_input(message, session):
                 return
             name = message.from_user.full_name
             ADMINS.setdefault("admins", []).append({"id": new_id, "name": name, "perms": ["all"]})
-            save_json(ADMINS_FILE, ADMINS)
+            save_admins()
             bot.send_message(aid, f"✅ تم إضافة الأدمن {new_id}")
             admin_sessions.pop(aid, None)
             return
@@ -715,7 +3769,7 @@ def handle_admin_session_input(message, session):
                 return
             before = len(ADMINS.get("admins", []))
             ADMINS["admins"] = [a for a in ADMINS.get("admins", []) if a.get("id") != del_id]
-            save_json(ADMINS_FILE, ADMINS)
+            save_admins()
             after = len(ADMINS.get("admins", []))
             if after < before:
                 bot.send_message(aid, f"✅ تم حذف الأدمن {del_id}")
@@ -728,33 +3782,34 @@ def handle_admin_session_input(message, session):
             # expecting text for scheduled message
             session_temp = session.setdefault("temp", {})
             session_temp["text"] = message.text
-            bot.send_message(aid, "أدخل التاريخ والوقت للإرسال بصيغة YYYY-MM-DD HH:MM (مثال: 2025-08-10 15:30):")
+            bot.send_message(aid, "أدخل التاريخ والوقت للإرسال بصيغة YYYY-MM-DD HH:MM (مثال: 2025-08-10 15:30)\n"
+                                  "أو تعبير cron للتكرار: دقيقة ساعة يوم شهر يوم_الأسبوع (مثال: 0 9 * * * كل يوم الساعة 9):")
             session["action"] = "schedule_step2"
             return
         if act == "schedule_step2":
             txt = message.text.strip()
             try:
-                send_time = datetime.strptime(txt, "%Y-%m-%d %H:%M")
-            except Exception:
+                send_time, cron = parse_schedule_input(txt)
+            except ValueError:
                 bot.send_message(aid, "صيغة التاريخ غير صحيحة. ألغيت العملية.")
                 admin_sessions.pop(aid, None)
                 return
-            # persist schedule
-            sched_id = str(uuid.uuid4())
-            entry = {"id": sched_id, "text": session.get("temp", {}).get("text", ""), "time": send_time.isoformat()}
-            SCHEDULES.append(entry)
-            save_json(SCHEDULES_FILE, SCHEDULES)
-            # schedule job
-            def job_send(entry):
-                txt = entry["text"]
-                for uid in list(USERS.keys()):
-                    try:
-                        bot.send_message(int(uid), txt)
-                    except Exception:
-                        pass
-            scheduler.add_job(job_send, 'date', run_date=send_time, args=[entry], id=sched_id)
-            bot.send_message(aid, "✅ تم جدولة الرسالة.")
-            admin_sessions.pop(aid, None)
+            session.setdefault("temp", {}).update({"time": send_time.isoformat(), "cron": cron})
+            bot.send_message(aid, "🎯 اختر الشريحة التي ستصلها الرسالة (أو اكتب 'yes' للإرسال للجميع و 'no' للإلغاء):", reply_markup=audience_picker())
+            session["action"] = "schedule_audience"
+            return
+        if act == "schedule_audience":
+            # typed instead of picked: same yes/no as broadcast_confirm, anything else asks again
+            answer = (message.text or "").strip().lower()
+            if answer == "yes":
+                entry = create_schedule(aid, session.get("temp", {}), "all")
+                bot.send_message(aid, "✅ تم جدولة الرسالة.\n\n" + schedule_label(entry))
+                admin_sessions.pop(aid, None)
+            elif answer == "no":
+                bot.send_message(aid, "تم إلغاء العملية.")
+                admin_sessions.pop(aid, None)
+            else:
+                bot.send_message(aid, "🎯 اختر الشريحة من الأزرار، أو اكتب 'yes' للإرسال للجميع و 'no' للإلغاء:", reply_markup=audience_picker())
             return
 
     except Exception as e:
@@ -766,7 +3821,58 @@ def handle_admin_session_input(message, session):
 # ----------------------------
 #  --- لوحة الأدمن: أوامر /admin و أزرار داخلية -----
 # ----------------------------
+FIND_QUERIES = open_shared_state("find_queries")   # admin id -> last /find query (for the page buttons)
+FIND_PAGE_SIZE = 8
+
+def find_results_page(query, page=0):
+    if not SEARCH_READY.is_set():
+        return "⏳ جاري بناء فهرس البحث بعد التشغيل، حاول بعد لحظات.", None
+    refresh_search_index()
+    started = time.perf_counter()
+    keys, total = SEARCH.search(query, page * FIND_PAGE_SIZE, FIND_PAGE_SIZE)
+    elapsed = (time.perf_counter() - started) * 1000
+    lines = [f"🔎 «{query}»: {total} نتيجة ({elapsed:.0f} ms)"]
+    kb = InlineKeyboardMarkup()
+    for kind, key in keys:
+        if kind == "o":
+            o = get_order(key)
+            if not o:
+                continue   # archived or removed by another worker since it was indexed
+            lines.append(f"\n📦 {o.get('button_text')} — {ORDER_STATUS_LABELS.get(o.get('status'), o.get('status'))}\n"
+                         f"👤 {o.get('user_name')} ({o.get('user_id')}) | 🕒 {(o.get('created_at') or '')[:16]}\n"
+                         f"📝 {str(o.get('info') or '')[:80]}")
+            kb.add(InlineKeyboardButton(f"📦 {o.get('button_text')} | {key[:8]}", callback_data=f"ORDER|{key}|view"))
+        else:
+            user = USERS.get(key) or {}
+            lines.append(f"\n👤 {user.get('name')} ({key}) | الطلبات: {user.get('order_count', 0)}")
+            kb.add(InlineKeyboardButton(f"👤 طلبات {user.get('name') or key}", callback_data=f"OL|*|*|{key}|"))
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"FIND|{page - 1}"))
+    if (page + 1) * FIND_PAGE_SIZE < total:
+        nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"FIND|{page + 1}"))
+    if nav:
+        kb.row(*nav)
+    if not keys:
+        lines.append("\nلا توجد نتائج.")
+    return "\n".join(lines), kb
+
+@bot.message_handler(commands=["find"])
+@timed_handler()
+def cmd_find(message):
+    if not is_admin(message.chat.id):
+        bot.reply_to(message, "🚫 ليس لديك صلاحية الوصول لهذه اللوحة.")
+        return
+    query = (message.text or "").partition(" ")[2].strip()
+    if not query:
+        bot.send_message(message.chat.id, "🔎 الاستخدام: /find ثم رقم الطلب أو ID اللعبة أو اسم المستخدم أو جزء من نص الطلب")
+        return
+    FIND_QUERIES[str(message.chat.id)] = query
+    text, kb = find_results_page(query)
+    bot.send_message(message.chat.id, text, reply_markup=kb)
+
 @bot.message_handler(commands=["admin"])
+@timed_handler()
 def cmd_admin(message):
     if not is_admin(message.chat.id):
         bot.reply_to(message, "🚫 ليس لديك صلاحية الوصول لهذه اللوحة.")
@@ -775,12 +3881,18 @@ def cmd_admin(message):
     kb.add(InlineKeyboardButton("🧭 إدارة الأزرار", callback_data="ADMIN|manage_buttons"))
     kb.add(InlineKeyboardButton("📦 الطلبات", callback_data="ADMIN|manage_orders"))
     kb.add(InlineKeyboardButton("📢 بث / إرسال", callback_data="ADMIN|broadcast"))
+    kb.add(InlineKeyboardButton("📡 البث الجاري", callback_data="ADMIN|broadcasts"))
     kb.add(InlineKeyboardButton("👥 إدارة المشرفين", callback_data="ADMIN|manage_admins"))
     kb.add(InlineKeyboardButton("📊 إحصائيات", callback_data="ADMIN|stats"))
     kb.add(InlineKeyboardButton("⏯ تشغيل/إيقاف البوت", callback_data="ADMIN|toggle_bot"))
     kb.add(InlineKeyboardButton("⏱ جدولة رسالة", callback_data="ADMIN|schedule"))
+    kb.add(InlineKeyboardButton("🗓 الرسائل المجدولة", callback_data="ADMIN|schedules"))
+    kb.add(InlineKeyboardButton("🗄 أرشيف الطلبات", callback_data="ADMIN|archive"))
+    kb.add(InlineKeyboardButton("📤 تصدير الطلبات", callback_data="ADMIN|export"))
+    kb.add(InlineKeyboardButton("🔬 تشخيص الأداء", callback_data="ADMIN|profile"))
     bot.send_message(message.chat.id, "لوحة تحكم الأدمن — اختر خيارًا:", reply_markup=kb)
 
+@timed_handler(lambda call, action: action)
 def handle_admin_action_inline(call, action):
     aid = call.from_user.id
     if action == "manage_buttons":
@@ -794,20 +3906,21 @@ def handle_admin_action_inline(call, action):
         bot.send_message(aid, "إدارة الأزرار:", reply_markup=kb)
         return
     if action == "manage_orders":
-        # list pending orders
-        if not ORDERS:
-            bot.send_message(aid, "لا توجد طلبات حتى الآن.")
-            return
-        kb = InlineKeyboardMarkup()
-        # show last 20 orders
-        for o in ORDERS[-20:][::-1]:
-            kb.add(InlineKeyboardButton(f"{o.get('button_text')} - {o.get('user_name')}", callback_data=f"ORDER|{o.get('order_id')}|view"))
-        bot.send_message(aid, "قائمة الطلبات (الأحدث أولاً):", reply_markup=kb)
+        text, kb = order_browser_page()
+        bot.send_message(aid, text, reply_markup=kb)
         return
     if action == "broadcast":
         bot.send_message(aid, "✏️ أرسل نص البث (يمكنك كتابة HTML):")
         admin_sessions[aid] = {"action": "broadcast_step1", "temp": {}}
         return
+    if action == "broadcasts":
+        active = [j for j in BROADCASTS.values() if j.get("status") in ("running", "paused")]
+        if not active:
+            bot.send_message(aid, "لا يوجد بث جارٍ حالياً.")
+            return
+        for job in active:
+            bot.send_message(aid, broadcast_progress_text(job), reply_markup=broadcast_controls(job))
+        return
     if action == "manage_admins":
         kb = InlineKeyboardMarkup()
         kb.add(InlineKeyboardButton("➕ إضافة أدمن", callback_data="ADMIN|add_admin"))
@@ -816,32 +3929,92 @@ def handle_admin_action_inline(call, action):
         bot.send_message(aid, "إدارة المشرفين:", reply_markup=kb)
         return
     if action == "stats":
-        users_count = len(USERS)
-        orders_count = len(ORDERS)
-        # most used button
-        counts = {}
-        for o in ORDERS:
-            key = o.get("button_text", "unknown")
-            counts[key] = counts.get(key, 0) + 1
-        most_used = max(counts.items(), key=lambda x: x[1])[0] if counts else "لا يوجد"
-        bot.send_message(aid, f"📊 إحصائيات:\n\n👥 عدد المستخدمين: {users_count}\n📦 عدد الطلبات: {orders_count}\n⭐ أكثر خدمة استخدامًا: {most_used}")
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("♻️ إعادة حساب الإحصائيات", callback_data="ADMIN|rebuild_stats"))
+        bot.send_message(aid, stats_text(), reply_markup=kb)
+        return
+    if action == "rebuild_stats":
+        rebuild_stats()
+        bot.send_message(aid, "✅ تمت إعادة حساب الإحصائيات من التخزين.\n\n" + stats_text())
         return
     if action == "toggle_bot":
         # flip BOT_STATUS
         CONFIG["BOT_STATUS"] = "off" if CONFIG.get("BOT_STATUS", "on") == "on" else "on"
         save_json(CONFIG_FILE, CONFIG)
+        publish_change("config")
         bot.send_message(aid, f"🔁 تم تغيير حالة البوت إلى: {CONFIG['BOT_STATUS']}")
         return
     if action == "schedule":
         bot.send_message(aid, "✏️ أرسل نص الرسالة التي تريد جدولتها:")
         admin_sessions[aid] = {"action": "schedule_step1", "temp": {}}
         return
+    if action in ("profile", "profile_start", "profile_stop"):
+        if action == "profile_start":
+            PROFILER.start(PROFILE_SAMPLE_RATE, PROFILE_WINDOW, aid)
+        elif action == "profile_stop":
+            if PROFILER.finish(aid):
+                return   # the report itself is the answer
+        kb = InlineKeyboardMarkup()
+        if PROFILER.active:
+            kb.add(InlineKeyboardButton("⏹ إيقاف وإرسال التقرير", callback_data="ADMIN|profile_stop"))
+        else:
+            kb.add(InlineKeyboardButton(f"▶️ بدء ({PROFILE_SAMPLE_RATE * 100:.0f}% لمدة {PROFILE_WINDOW:.0f} ث)", callback_data="ADMIN|profile_start"))
+        bot.send_message(aid, PROFILER.status_text(), reply_markup=kb)
+        return
+    if action in ("archive", "archive_now"):
+        if action == "archive_now":
+            moved = archive_old_orders()
+            bot.send_message(aid, f"🗄 تمت أرشفة {moved} طلب.")
+        segments = archive_segments()
+        lines = [f"🗄 أرشيف الطلبات (المنتهية منذ أكثر من {ARCHIVE_AFTER_DAYS:g} يوم):"]
+        lines += [f"• {month}: {size / 1024:.1f} KB" for month, _, size in segments[-24:]]
+        if not segments:
+            lines.append("لا يوجد أرشيف بعد.")
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("🔍 بحث في الأرشيف", callback_data="ADMIN|archive_search"))
+        kb.add(InlineKeyboardButton("🗄 أرشفة الآن", callback_data="ADMIN|archive_now"))
+        bot.send_message(aid, "\n".join(lines), reply_markup=kb)
+        return
+    if action == "export":
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("CSV (كل الطلبات)", callback_data="ADMIN|export_csv"),
+               InlineKeyboardButton("JSONL (كل الطلبات)", callback_data="ADMIN|export_jsonl"))
+        bot.send_message(aid, "📤 اختر تصديراً كاملاً، أو أرسل الفلاتر بهذا الشكل:\n"
+                              "csv 2026-01-01 2026-03-31 status=approved service=pubg\n"
+                              "(الصيغة csv أو jsonl، التاريخ الأول من والثاني إلى، وكلها اختيارية)", reply_markup=kb)
+        admin_sessions[aid] = {"action": "export_filters"}
+        return
+    if action in ("export_csv", "export_jsonl"):
+        admin_sessions.pop(aid, None)
+        filters = parse_export_filters([action.split("_", 1)[1]])
+        start_export(aid, filters)
+        bot.send_message(aid, "⏳ جاري تجهيز الملف، سيصلك خلال لحظات.")
+        return
+    if action == "archive_search":
+        bot.send_message(aid, "🔍 أرسل رقم الطلب (OrderID) أو ID المستخدم:")
+        admin_sessions[aid] = {"action": "archive_search"}
+        return
+    if action == "schedules":
+        with schedules_lock:
+            entries = sorted(SCHEDULES, key=lambda e: e.get("time", ""))
+        if not entries:
+            bot.send_message(aid, "لا توجد رسائل مجدولة.")
+            return
+        for entry in entries:
+            kb = InlineKeyboardMarkup()
+            kb.add(InlineKeyboardButton("🗑 إلغاء", callback_data=f"SCHED|{entry['id']}|cancel"))
+            bot.send_message(aid, schedule_label(entry), reply_markup=kb)
+        return
 
     # other admin actions
     if action == "add_button":
         bot.send_message(aid, "🔰 إدخال اسم الزر (النص الظاهر للمستخدم):")
         admin_sessions[aid] = {"action": "add_button_step1", "temp": {}}
         return
+    if action == "edit_button":
+        bot.send_message(aid, "✏️ أرسل معرف الزر (id) أو نصه لتعديله:")
+        admin_sessions[aid] = {"action": "edit_button_step1"}
+        return
     if action == "del_button":
         bot.send_message(aid, "🗑 أرسل معرف الزر (id) أو نصه لحذفه من القائمة الرئيسية:")
         admin_sessions[aid] = {"action": "del_button_step1"}
@@ -874,27 +4047,545 @@ def handle_admin_action_inline(call, action):
 # ----------------------------
 #  --- جدولة المواعيد عند بدء التشغيل (إعادة تحميل الجداول المحفوظة) -----
 # ----------------------------
+schedules_lock = Lock()
+
+def schedule_trigger(entry):
+    if entry.get("cron"):
+        return CronTrigger.from_crontab(entry["cron"])
+    return DateTrigger(run_date=datetime.fromisoformat(entry["time"]))
+
+def next_cron_time(cron, after):
+    trigger = CronTrigger.from_crontab(cron)
+    nxt = trigger.get_next_fire_time(None, after.astimezone(trigger.timezone) + timedelta(seconds=1))
+    return nxt.replace(tzinfo=None)
+
+def parse_schedule_input(txt):
+    """يقبل 'YYYY-MM-DD HH:MM' لمرة واحدة أو تعبير cron من 5 حقول للتكرار، ويعيد (الموعد القادم, cron)"""
+    try:
+        return datetime.strptime(txt, "%Y-%m-%d %H:%M"), None
+    except ValueError:
+        pass
+    return next_cron_time(txt, datetime.now()), txt   # ValueError if it is not a valid crontab either
+
+def find_schedule(sched_id):
+    with schedules_lock:
+        return next((e for e in SCHEDULES if e.get("id") == sched_id), None)
+
+def add_schedule(entry):
+    with schedules_lock:
+        SCHEDULES.append(entry)
+    save_schedules()
+    sync_schedule_jobs()
+
+def remove_schedule(sched_id, sync=True):
+    with schedules_lock:
+        before = len(SCHEDULES)
+        SCHEDULES[:] = [e for e in SCHEDULES if e.get("id") != sched_id]
+        removed = len(SCHEDULES) < before
+    if removed:
+        save_schedules()
+        if sync:
+            sync_schedule_jobs()
+    return removed
+
+def run_scheduled(sched_id, sync=True):
+    """ينفذ رسالة مجدولة عبر محرك البث (محدود المعدل ويُستأنف بعد إعادة التشغيل) بدل حلقة على خيط الجدولة"""
+    started = time.perf_counter()
+    try:
+        _run_scheduled(sched_id, sync)
+    finally:
+        SCHEDULER_JOB_SECONDS.observe(("run_scheduled",), time.perf_counter() - started)
+
+def _run_scheduled(sched_id, sync):
+    entry = find_schedule(sched_id)
+    if not entry:
+        return
+    job = start_broadcast(entry["text"], entry.get("admin_id"), entry.get("audience", "all"))
+    if entry.get("cron"):
+        now = datetime.now()
+        with schedules_lock:
+            entry["last_run"] = now.isoformat()
+            entry["broadcast_id"] = job["id"]
+            entry["time"] = next_cron_time(entry["cron"], now).isoformat()
+        save_schedules()
+    else:
+        # one-shot entries are finished once handed to the broadcast engine
+        remove_schedule(sched_id, sync)
+
+def missed_run(entry, now):
+    """الموعد الذي فات أثناء توقف البوت، أو None"""
+    if entry.get("cron"):
+        last = entry.get("last_run") or entry.get("created_at")
+        if not last:
+            return None
+        nxt = next_cron_time(entry["cron"], datetime.fromisoformat(last))
+    else:
+        nxt = datetime.fromisoformat(entry["time"])
+    return nxt if nxt <= now else None
+
+def sync_schedule_jobs():
+    """يطابق مهام APScheduler مع SCHEDULES (بعد الاستعادة أو تعديل من عملية أخرى)"""
+    if not is_leader():
+        return
+    with schedules_lock:
+        entries = list(SCHEDULES)
+    ids = set()
+    for entry in entries:
+        try:
+            scheduler.add_job(run_scheduled, schedule_trigger(entry), args=[entry["id"]], id=entry["id"],
+                              replace_existing=True, coalesce=True,
+                              misfire_grace_time=int(SCHEDULE_MISFIRE_GRACE) if SCHEDULE_MISFIRE == "send" else 1)
+            ids.add(entry["id"])
+        except Exception as e:
+            logger.exception("Failed to schedule %s: %s", entry.get("id"), e)
+    for job in scheduler.get_jobs():
+        if job.func is run_scheduled and job.id not in ids:
+            job.remove()
+
 def restore_schedules():
-    global SCHEDULES
-    for entry in SCHEDULES:
+    now = datetime.now()
+    for entry in list(SCHEDULES):
         try:
-            run_at = datetime.fromisoformat(entry["time"])
-            if run_at <= datetime.now():
-                # if time has passed, skip or send immediately depending policy; we skip
+            missed = missed_run(entry, now)
+            if not missed:
                 continue
-            def job_send(e=entry):
-                # send message to all users
-                for uid in list(USERS.keys()):
-                    try:
-                        bot.send_message(int(uid), e["text"])
-                    except Exception:
-                        pass
-            scheduler.add_job(job_send, 'date', run_date=run_at, args=[entry], id=entry["id"])
+            late = (now - missed).total_seconds()
+            if SCHEDULE_MISFIRE == "send" and late <= SCHEDULE_MISFIRE_GRACE:
+                logger.info("Sending schedule %s missed during downtime (%.0fs late)", entry["id"], late)
+                run_scheduled(entry["id"], sync=False)
+            elif entry.get("cron"):
+                logger.warning("Skipping missed run of schedule %s (%.0fs late, policy %s)", entry["id"], late, SCHEDULE_MISFIRE)
+                with schedules_lock:
+                    entry["last_run"] = now.isoformat()
+                    entry["time"] = next_cron_time(entry["cron"], now).isoformat()
+                save_schedules()
+            else:
+                logger.warning("Dropping missed schedule %s (%.0fs late, policy %s)", entry["id"], late, SCHEDULE_MISFIRE)
+                remove_schedule(entry["id"], sync=False)
         except Exception as e:
             logger.exception("restore_schedules error: %s", e)
+    sync_schedule_jobs()
+
+def reload_schedules():
+    reload_in_place(SCHEDULES, STORAGE.load_schedules())
+    sync_schedule_jobs()
+
+RELOADERS["schedules"] = reload_schedules
+
+def schedule_label(entry):
+    when = f"🔁 {entry['cron']} (التالي: {entry['time'][:16]})" if entry.get("cron") else f"🕐 {entry['time'][:16].replace('T', ' ')}"
+    text = entry.get("text", "")
+    return f"{when}\n🎯 {audience_label(entry.get('audience', 'all'))}\n{text[:80]}{'…' if len(text) > 80 else ''}"
+
+def create_schedule(aid, temp, audience):
+    # persist schedule; the leader process registers the job
+    entry = {
+        "id": str(uuid.uuid4()),
+        "text": temp.get("text", ""),
+        "time": temp["time"],
+        "cron": temp.get("cron"),
+        "admin_id": aid,
+        "audience": audience,
+        "created_at": datetime.now().isoformat(),
+        "last_run": None,
+    }
+    add_schedule(entry)
+    return entry
+
+def handle_audience_choice(call, audience):
+    """اختيار الشريحة من audience_picker لبث فوري أو لرسالة مجدولة"""
+    aid = call.from_user.id
+    session = admin_sessions.get(aid)
+    if not session or session.get("action") not in ("broadcast_confirm", "schedule_audience"):
+        bot.answer_callback_query(call.id, "انتهت هذه العملية.")
+        return
+    if audience != "cancel" and not valid_audience(audience):
+        bot.answer_callback_query(call.id, "شريحة غير معروفة.")
+        return
+    admin_sessions.pop(aid, None)
+    bot.answer_callback_query(call.id)
+    if audience == "cancel":
+        bot.send_message(aid, "تم إلغاء العملية.")
+        return
+    temp = session.get("temp", {})
+    if session["action"] == "broadcast_confirm":
+        start_broadcast(temp.get("text", ""), aid, audience)
+    else:
+        entry = create_schedule(aid, temp, audience)
+        bot.send_message(aid, "✅ تم جدولة الرسالة.\n\n" + schedule_label(entry))
+
+def handle_schedule_control(call, sched_id, action):
+    if action == "cancel":
+        if remove_schedule(sched_id):
+            bot.answer_callback_query(call.id, "تم إلغاء الرسالة المجدولة.")
+            bot.edit_message_text("🗑 تم إلغاء هذه الرسالة المجدولة.", call.message.chat.id, call.message.message_id)
+        else:
+            bot.answer_callback_query(call.id, "لم أجد هذه الرسالة المجدولة.")
+
+def start_leader_duties():
+    restore_schedules()
+    resume_broadcasts()
+    if ARCHIVE_AFTER_DAYS > 0:
+        scheduler.add_job(archive_job, "interval", hours=ARCHIVE_INTERVAL_HOURS, id="archive-orders", replace_existing=True,
+                          next_run_time=datetime.now() + timedelta(minutes=1))
+    if SHARED_STATE:
+        # pick up schedules added in other processes even when this one gets no updates
+        scheduler.add_job(refresh_shared_state, "interval", seconds=30, id="shared-refresh", replace_existing=True)
+
+def wait_for_leadership():
+    # the leader process died: the first worker to grab the lock takes over
+    while not try_become_leader():
+        time.sleep(30)
+    logger.info("This process is now the leader")
+    start_leader_duties()
+
+def load_history():
+    """يحمّل سجل الطلبات ويبني الإحصائيات وفهرس المستخدمين في الخلفية، بعد أن يصبح webhook جاهزاً"""
+    started = time.monotonic()
+    try:
+        STORAGE.load_orders()
+        # another worker may already have built the shared counters
+        if not (SHARED_STATE and STATS.refresh()):
+            # one pass over the archive feeds both the counters and the user backfill
+            tally = {}, {}
+            rebuild_stats(tally_user_orders(iter_all_orders(), *tally))
+            rebuild_user_index(tally)
+        else:
+            rebuild_user_index()
+    except Exception as e:
+        logger.exception("Failed to load order history: %s", e)
+    finally:
+        # handlers waiting on orders must not hang forever if loading failed
+        ORDERS_READY.set()
+    logger.info("Order history ready in %.2fs (%.2fs after start)", time.monotonic() - started, time.monotonic() - STARTED_AT)
+    # only /find needs it, so it must not hold up the handlers waiting on ORDERS_READY
+    threading.Thread(target=build_search_index, name="search-index", daemon=True).start()
+    # restore at startup (with SHARED_STATE only in the process holding the leader lock)
+    if try_become_leader():
+        start_leader_duties()
+    else:
+        wait_for_leadership()
 
-# restore at startup
-restore_schedules()
+# ----------------------------
+#  --- تشخيص الأداء (cProfile على عينة من التحديثات) -----
+# ----------------------------
+class UpdateProfiler:
+    """يشغّل cProfile على نسبة من التحديثات خلال نافذة زمنية ثم يكتب تقرير أهم النقاط الساخنة"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.busy = Lock()     # one profiled update at a time (a profiler per thread is not allowed on 3.12+)
+        self.active = False
+        self.stats = None
+        self.samples = 0
+        self.seen = 0
+        self.rate = 0.0
+        self.admin_id = None
+        self.started_at = None
+        self.timer = None
+
+    def start(self, rate, window, admin_id=None):
+        with self.lock:
+            if self.active:
+                return False
+            self.active, self.rate, self.admin_id = True, rate, admin_id
+            self.stats, self.samples, self.seen = None, 0, 0
+            self.started_at = datetime.now()
+            self.timer = threading.Timer(window, self.finish)
+            self.timer.daemon = True
+            self.timer.start()
+        logger.info("Profiling %.0f%% of updates for %.0fs", rate * 100, window)
+        return True
+
+    def run(self, fn, *args):
+        if not self.active:
+            return fn(*args)
+        with self.lock:   # run() is called from every update worker
+            self.seen += 1
+        if random.random() >= self.rate or not self.busy.acquire(blocking=False):
+            return fn(*args)
+        try:
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(fn, *args)
+            finally:
+                with self.lock:
+                    if self.active:
+                        if self.stats is None:
+                            self.stats = pstats.Stats(prof)
+                        else:
+                            self.stats.add(prof)
+                        self.samples += 1
+        finally:
+            self.busy.release()
+
+    def status_text(self):
+        if not self.active:
+            return "🔬 التشخيص متوقف."
+        return (f"🔬 التشخيص يعمل منذ {self.started_at:%H:%M:%S}\n"
+                f"النسبة: {self.rate * 100:.0f}% — عينات: {self.samples} من {self.seen} تحديث")
+
+    def finish(self, admin_id=None):
+        """ينهي النافذة، يكتب التقرير في ملف ويرسله للأدمن (من أوقفه أو من بدأه)؛ يعيد مسار الملف"""
+        with self.lock:
+            if not self.active:
+                return None
+            self.active = False
+            if self.timer:
+                self.timer.cancel()
+            stats, samples, seen, started_at = self.stats, self.samples, self.seen, self.started_at
+            admin_id = admin_id or self.admin_id
+            self.stats = None
+        path = f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"profile {started_at.isoformat(timespec='seconds')} -> {datetime.now().isoformat(timespec='seconds')}\n")
+            f.write(f"sampled {samples} of {seen} updates\n\n")
+            if stats:
+                stats.stream = f
+                stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+                stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+        logger.info("Profile report written to %s", path)
+        if admin_id:
+            try:
+                bot.send_message(admin_id, profile_summary(stats, samples, seen))
+                with open(path, "rb") as f:
+                    bot.send_document(admin_id, f, caption="🔬 تقرير التشخيص الكامل")
+            except Exception as e:
+                logger.exception("Failed to send profile report: %s", e)
+        return path
+
+def profile_summary(stats, samples, seen, top=10):
+    lines = [f"🔬 نتيجة التشخيص: {samples} عينة من {seen} تحديث"]
+    if not stats:
+        return "\n".join(lines + ["لم تُجمع أي عينة."])
+    lines.append("أكثر الدوال استهلاكاً للوقت (ذاتي / تراكمي):")
+    rows = sorted(stats.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:top]
+    for (filename, line, name), (cc, nc, tottime, cumtime, callers) in rows:
+        lines.append(f"• {tottime * 1000:.0f}ms / {cumtime * 1000:.0f}ms  {name} ({os.path.basename(filename)}:{line}) ×{nc}")
+    return "\n".join(lines)
+
+PROFILER = UpdateProfiler()
+if os.environ.get("BOT_PROFILE"):
+    # BOT_PROFILE=0.05 profiles 5% of updates from startup; the report goes to a file
+    PROFILER.start(PROFILE_SAMPLE_RATE, PROFILE_WINDOW)
+
+# ----------------------------
+#  --- طابور التحديثات (معالجة بالخلفية مع الحفاظ على ترتيب كل محادثة) -----
+# ----------------------------
+# The webhook only parses the update and puts it on a queue. Each worker owns one
+# queue and an update always goes to the queue chosen by its chat id, so updates from
+# the same chat are handled strictly in order (admin_sessions / awaiting flows), while
+# different chats are processed in parallel.
+# With SHARED_STATE (gunicorn -w N) two updates of one chat can reach different
+# processes. The webhook then also takes a per-chat ticket from the chat_turns table,
+# and a worker waits until the chat's previous ticket is done before processing.
+UPDATE_QUEUES = [queue.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(max(1, UPDATE_WORKERS))]
+UPDATE_STATS = {"received": 0, "processed": 0, "rejected": 0, "errors": 0, "duplicates": 0,
+                "last_lag": 0.0, "max_lag": 0.0, "last_seconds": 0.0}
+update_stats_lock = Lock()   # written by the webhook threads and every update worker
+
+def count_update(key):
+    with update_stats_lock:
+        UPDATE_STATS[key] += 1
+
+class SeenUpdates:
+    """مجموعة محدودة الحجم والمدة من update_id لتجاهل التحديثات المكررة من تيليجرام"""
+
+    def __init__(self, window, max_ids, path=None):
+        self.window = window
+        self.max_ids = max_ids
+        self.ids = OrderedDict()   # update_id -> wall-clock time first seen (oldest first)
+        self.lock = Lock()
+        self.writer = None
+        if path:
+            self.path = path
+            for uid, ts in load_json(path, []):
+                self.ids[uid] = ts
+            self.writer = WriteBehind("seen_updates", self._flush, 5.0, 1000)
+            WRITERS.append(self.writer)
+
+    def _expire(self, now):
+        while self.ids:
+            uid, ts = next(iter(self.ids.items()))
+            if len(self.ids) <= self.max_ids and now - ts <= self.window:
+                break
+            self.ids.popitem(last=False)
+
+    def add(self, update_id):
+        """يعيد False إذا كان المعرف قد شوهد من قبل"""
+        now = time.time()
+        with self.lock:
+            if update_id in self.ids and now - self.ids[update_id] <= self.window:
+                return False
+            self.ids[update_id] = now
+            self.ids.move_to_end(update_id)
+            self._expire(now)
+        if self.writer:
+            self.writer.mark(update_id)
+        return True
+
+    def discard(self, update_id):
+        with self.lock:
+            self.ids.pop(update_id, None)
+
+    def _flush(self, dirty):
+        with self.lock:
+            snapshot = list(self.ids.items())
+        with file_lock(self.path):
+            atomic_write_json(self.path, snapshot)
+
+class SharedSeenUpdates:
+    """نفس SeenUpdates لكن في جدول seen_updates ليشترك فيه كل العمال"""
+
+    def __init__(self, window):
+        self.window = window
+        self.adds = 0
+
+    def add(self, update_id):
+        now = time.time()
+        conn = shared_conn()
+        self.adds += 1
+        if self.adds % 1000 == 0:
+            conn.execute("DELETE FROM seen_updates WHERE ts < ?", (now - self.window,))
+        row = conn.execute("SELECT ts FROM seen_updates WHERE update_id = ?", (update_id,)).fetchone()
+        if row and now - row[0] <= self.window:
+            return False
+        # INSERT OR IGNORE decides the race between two workers receiving the same update
+        if row:
+            conn.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+        return conn.execute("INSERT OR IGNORE INTO seen_updates (update_id, ts) VALUES (?, ?)", (update_id, now)).rowcount == 1
+
+    def discard(self, update_id):
+        shared_conn().execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+
+class ChatTurns:
+    """ترتيب تحديثات المحادثة الواحدة بين العمليات: تذكرة عند الاستلام وانتظار انتهاء التذكرة السابقة"""
+
+    POLL = 0.02
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def take(self, chat_id):
+        conn = shared_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT issued FROM chat_turns WHERE chat_id = ?", (chat_id,)).fetchone()
+            ticket = (row[0] if row else 0) + 1
+            if row:
+                conn.execute("UPDATE chat_turns SET issued = ? WHERE chat_id = ?", (ticket, chat_id))
+            else:
+                conn.execute("INSERT INTO chat_turns (chat_id, issued, done) VALUES (?, ?, 0)", (chat_id, ticket))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return ticket
+
+    def wait(self, chat_id, ticket):
+        """ينتظر حتى تنتهي التذكرة السابقة؛ بعد timeout يكمل (عملية توقفت أو تذكرة لم تدخل الطابور)"""
+        deadline = time.monotonic() + self.timeout
+        conn = shared_conn()
+        while True:
+            row = conn.execute("SELECT done FROM chat_turns WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None or row[0] >= ticket - 1:
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning("Chat %s: update %d did not finish in %.0fs, going on without it", chat_id, ticket - 1, self.timeout)
+                return False
+            time.sleep(self.POLL)
+
+    def done(self, chat_id, ticket):
+        shared_conn().execute("UPDATE chat_turns SET done = MAX(done, ?) WHERE chat_id = ?", (ticket, chat_id))
+
+if SHARED_STATE:
+    SEEN_UPDATES = SharedSeenUpdates(DEDUP_WINDOW_SECONDS)
+else:
+    SEEN_UPDATES = SeenUpdates(DEDUP_WINDOW_SECONDS, DEDUP_MAX_IDS, SEEN_UPDATES_FILE if DEDUP_PERSIST else None)
+
+def update_chat_key(data):
+    for kind in ("message", "edited_message", "channel_post", "callback_query", "my_chat_member", "chat_member"):
+        part = data.get(kind)
+        if not part:
+            continue
+        if kind == "callback_query":
+            return (part.get("from") or {}).get("id") or 0
+        return (part.get("chat") or {}).get("id") or (part.get("from") or {}).get("id") or 0
+    for part in data.values():
+        if isinstance(part, dict) and isinstance(part.get("from"), dict):
+            return part["from"].get("id") or 0
+    return 0
+
+CHAT_TURNS = ChatTurns(CHAT_TURN_TIMEOUT) if SHARED_STATE else None
+
+def enqueue_update(data):
+    chat_id = update_chat_key(data)
+    q = UPDATE_QUEUES[hash(chat_id) % len(UPDATE_QUEUES)]
+    if q.full():
+        count_update("rejected")
+        return False
+    # the ticket is taken in arrival order, before the update can be picked up
+    ticket = CHAT_TURNS.take(chat_id) if CHAT_TURNS and chat_id else None
+    try:
+        q.put_nowait((time.monotonic(), data, chat_id, ticket))
+    except queue.Full:
+        # filled up since the check; the chat's next update waits CHAT_TURN_TIMEOUT for this ticket
+        count_update("rejected")
+        return False
+    count_update("received")
+    return True
+
+def process_update(data):
+    started = time.perf_counter()
+    refresh_shared_state()
+    update = telebot.types.Update.de_json(data)
+    sender = update.message or update.callback_query
+    if sender and sender.from_user:
+        touch_user(sender.from_user.id)
+    try:
+        bot.process_new_updates([update])
+    finally:
+        kind = "message" if update.message else "callback_query" if update.callback_query else "other"
+        UPDATE_SECONDS.observe((kind,), time.perf_counter() - started)
+
+def update_worker(q):
+    while True:
+        enqueued_at, data, chat_id, ticket = q.get()
+        started = time.monotonic()
+        lag = started - enqueued_at
+        with update_stats_lock:
+            UPDATE_STATS["last_lag"] = lag
+            UPDATE_STATS["max_lag"] = max(UPDATE_STATS["max_lag"], lag)
+        try:
+            if ticket is not None:
+                CHAT_TURNS.wait(chat_id, ticket)
+            PROFILER.run(process_update, data)
+        except Exception as e:
+            count_update("errors")
+            logger.exception("Failed to process update %s: %s", data.get("update_id"), e)
+        finally:
+            if ticket is not None:
+                try:
+                    CHAT_TURNS.done(chat_id, ticket)
+                except Exception as e:
+                    logger.exception("Failed to release chat %s turn %d: %s", chat_id, ticket, e)
+            with update_stats_lock:
+                UPDATE_STATS["processed"] += 1
+                UPDATE_STATS["last_seconds"] = time.monotonic() - started
+            q.task_done()
+
+def queue_depth():
+    return sum(q.qsize() for q in UPDATE_QUEUES)
+
+def drain_update_queues(timeout=10):
+    # on shutdown give already-acknowledged updates a chance to finish
+    deadline = time.monotonic() + timeout
+    while queue_depth() and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+for i, q in enumerate(UPDATE_QUEUES):
+    threading.Thread(target=update_worker, args=(q,), name=f"update-worker-{i}", daemon=True).start()
+atexit.register(drain_update_queues)
 
 # ----------------------------
 #  --- Webhook endpoints (Flask) ---
@@ -902,14 +4593,108 @@ restore_schedules()
 @app.route(f"/webhook/{BOT_TOKEN}", methods=["POST"])
 def telegram_webhook():
     try:
-        json_string = request.get_data().decode("utf-8")
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        data = json.loads(request.get_data().decode("utf-8"))
     except Exception as e:
-        logger.exception("Failed to process webhook: %s", e)
-        return "Error", 500
+        logger.exception("Failed to decode webhook: %s", e)
+        return "Bad Request", 400
+    update_id = data.get("update_id")
+    if update_id is not None and not SEEN_UPDATES.add(update_id):
+        # redelivery of an update we already accepted
+        count_update("duplicates")
+        return "OK", 200
+    if not enqueue_update(data):
+        # queue full: let Telegram retry later instead of piling up more work
+        if update_id is not None:
+            SEEN_UPDATES.discard(update_id)
+        logger.warning("Update queue full, rejecting update %s", update_id)
+        return "Busy", 503
     return "OK", 200
 
+@app.route("/health", methods=["GET"])
+def health():
+    with update_stats_lock:
+        stats = dict(UPDATE_STATS)
+    stats["queue_depth"] = queue_depth()
+    stats["workers"] = len(UPDATE_QUEUES)
+    stats["orders_ready"] = ORDERS_READY.is_set()
+    stats["flood_dropped"] = sum(FLOOD_DROPPED.series.values())
+    # total seconds spent waiting per lock (file:<name>, journal, orders, archive, ...)
+    stats["lock_wait_seconds"] = {labels[0]: round(row[-1], 3) for labels, row in list(LOCK_WAIT_SECONDS.series.items())}
+    return jsonify(stats)
+
+def metrics_samples():
+    """الإحصائيات الموجودة أصلاً (health، البث، الكتابة المؤجلة...) كـ (name, type, help, labels, value)"""
+    yield "bot_update_queue_depth", "gauge", "Updates waiting in the worker queues", {}, queue_depth()
+    with update_stats_lock:
+        stats = dict(UPDATE_STATS)
+    for key in ("received", "processed", "rejected", "errors", "duplicates"):
+        yield "bot_updates_total", "counter", "Webhook updates by outcome", {"outcome": key}, stats.get(key, 0)
+    yield "bot_update_lag_seconds", "gauge", "Queue wait of the last processed update", {}, stats.get("last_lag", 0)
+    yield "bot_update_max_lag_seconds", "gauge", "Longest queue wait seen", {}, stats.get("max_lag", 0)
+    for key in ("sent", "failed", "timeouts"):
+        with admin_fanout_lock:
+            value = ADMIN_FANOUT_STATS.get(key, 0)
+        yield "bot_admin_fanout_total", "counter", "Admin notifications by outcome", {"outcome": key}, value
+    for w in WRITERS:
+        for key in ("flushes", "records", "errors"):
+            yield "bot_writer_total", "counter", "Write-behind flushes/records/errors", {"writer": w.name, "kind": key}, w.stats.get(key, 0)
+        yield "bot_writer_flush_max_seconds", "gauge", "Slowest write-behind flush", {"writer": w.name}, w.stats.get("max_seconds", 0)
+    by_status = {}
+    for job in list(BROADCASTS.values()):
+        by_status[job.get("status")] = by_status.get(job.get("status"), 0) + 1
+    for status, count in by_status.items():
+        yield "bot_broadcast_jobs", "gauge", "Broadcast jobs by status", {"status": status}, count
+    yield "bot_users", "gauge", "Registered users", {}, len(USERS)
+    for status, count in list(STATS.by_status.items()):
+        yield "bot_orders", "gauge", "Orders by status", {"status": status}, count
+    yield "bot_scheduled_messages", "gauge", "Pending scheduled messages", {}, len(SCHEDULES)
+
+def bearer_token_ok(expected):
+    # header only: a ?token= query string ends up in proxy/access logs and browser history
+    token = request.headers.get("Authorization", "").partition("Bearer ")[2]
+    # compare bytes: compare_digest raises TypeError on non-ASCII str
+    return hmac.compare_digest(token.encode("utf-8"), str(expected).encode("utf-8"))
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Authorization: Bearer METRICS_TOKEN (scrape_configs: authorization: credentials: ...)
+    if not METRICS_TOKEN:
+        abort(404)
+    if not bearer_token_ok(METRICS_TOKEN):
+        abort(403)
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    families = {}   # samples of one metric must be contiguous
+    for name, kind, help_text, labels, value in metrics_samples():
+        family = families.setdefault(name, [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+        family.append(f"{name}{format_labels(tuple(labels), tuple(labels.values()))} {value}")
+    for family in families.values():
+        lines += family
+    return app.response_class("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route("/export/orders", methods=["GET"])
+def export_orders():
+    # Authorization: Bearer EXPORT_TOKEN; ?format=csv|jsonl&since=YYYY-MM-DD&until=YYYY-MM-DD&status=...&service=...
+    if not EXPORT_TOKEN:
+        abort(404)
+    if not bearer_token_ok(EXPORT_TOKEN):
+        abort(403)
+    fmt = request.args.get("format", "csv")
+    since, until = request.args.get("since"), request.args.get("until")
+    try:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(fmt)
+        for day in (since, until):
+            if day:
+                datetime.strptime(day, "%Y-%m-%d")
+    except ValueError as e:
+        return f"Bad filter: {e}", 400
+    orders = iter_export_orders(request.args.get("status"), request.args.get("service"), since, until)
+    return app.response_class(export_chunks(fmt, orders),
+                              mimetype="text/csv" if fmt == "csv" else "application/x-ndjson",
+                              headers={"Content-Disposition": f'attachment; filename="orders.{fmt}"'})
+
 @app.route("/setwebhook")
 def set_webhook_endpoint():
     # useful helper to set webhook via code (calls Telegram setWebhook)
@@ -928,9 +4713,12 @@ def index():
 # ----------------------------
 #  --- تشغيل الخادم (Flask) ---
 # ----------------------------
+threading.Thread(target=load_history, name="load-history", daemon=True).start()
+logger.info("Startup took %.2fs; order history is loading in the background", time.monotonic() - STARTED_AT)
+
 if __name__ == "__main__":
-    # لحفظ أولي للconfigs
-    save_all()
+    # SIGTERM => exit normally so atexit flushes pending writes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     port = int(os.environ.get("PORT", 5000))
     # start flask app
     logger.info("Starting Flask app... Listening on port %s", port)
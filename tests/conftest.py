@@ -0,0 +1,28 @@
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    # main.py keeps its files in the working directory and starts up on import
+    workdir = tmp_path_factory.mktemp("bot")
+    os.chdir(workdir)
+    with open("config.json", "w", encoding="utf-8") as f:
+        json.dump({"BOT_TOKEN": "123:TEST", "WEBHOOK_URL": "http://localhost", "ADMIN_IDS": [999],
+                   "JOURNAL_FSYNC": False, "ARCHIVE_AFTER_DAYS": 0}, f)
+    sys.path.insert(0, ROOT)
+    import main
+    assert main.ORDERS_READY.wait(10)
+    yield main
+    # compactions started by archival write orders.json relative to the working
+    # directory, which pytest may have changed back by the time they finish
+    for thread in threading.enumerate():
+        if thread.name == "orders-compact":
+            thread.join(10)
+
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+import telebot
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.fixture
+def sent(main, monkeypatch):
+    """bot.send_message stub; the list of chat ids it was called with."""
+    calls = []
+    monkeypatch.setattr(main.bot, "send_message", lambda chat_id, text, *a, **kw: calls.append(chat_id))
+    monkeypatch.setattr(main, "TELEGRAM_BUCKET", main.TokenBucket(10000))
+    return calls
+
+
+def rate_limited(retry_after):
+    return telebot.apihelper.ApiTelegramException(
+        "sendMessage", None, {"error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": retry_after}})
+
+
+def test_bucket_refills_at_rate(main):
+    bucket = main.TokenBucket(100, capacity=5)
+    assert all(bucket.try_acquire() for _ in range(5))
+    assert not bucket.try_acquire()
+    time.sleep(0.05)   # ~5 tokens back, never more than capacity
+    assert bucket.try_acquire(4)
+    time.sleep(0.2)
+    assert bucket.tokens <= 5 and bucket.try_acquire(5)
+
+
+def test_hold_blocks_until_retry_after(main):
+    bucket = main.TokenBucket(1000, capacity=10)
+    bucket.hold(0.1)
+    assert not bucket.try_acquire()
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.09
+
+
+def test_rate_limits_do_not_use_up_retries(main, sent, monkeypatch):
+    answers = [rate_limited(0.001)] * (main.BROADCAST_MAX_RETRIES + 2)
+
+    def send_message(chat_id, text, *args, **kwargs):
+        if answers:
+            raise answers.pop()
+        sent.append(chat_id)
+
+    monkeypatch.setattr(main.bot, "send_message", send_message)
+    assert main.send_broadcast_message("7", "hi") == "sent"
+    assert sent == [7]
+
+
+def new_job(main, job_id):
+    job = {"id": job_id, "text": "hi", "admin_id": None, "audience": "all", "status": "running", "total": 0,
+           "offset": 0, "last_uid": None, "sent": 0, "failed": 0, "blocked": 0, "progress_message_id": None}
+    main.BROADCASTS[job_id] = job
+    return job
+
+
+def test_resume_from_checkpoint_sends_each_user_once(main, sent, monkeypatch):
+    monkeypatch.setattr(main.STORAGE, "users", {str(uid): {"id": uid} for uid in range(100, 135)})
+    monkeypatch.setattr(main, "BROADCAST_CHUNK", 10)
+    checkpoint = main.update_broadcast
+
+    def crash_after_two_chunks(job, **fields):
+        checkpoint(job, **fields)
+        if fields.get("offset") == 20:
+            raise Crash()
+
+    monkeypatch.setattr(main, "update_broadcast", crash_after_two_chunks)
+    with pytest.raises(Crash):
+        main.run_broadcast(new_job(main, "t-resume"))
+    assert sent == list(range(100, 120))
+
+    # after the "restart": a user who joined meanwhile sorts before the checkpoint
+    # and must not shift the resume point
+    main.STORAGE.users["099"] = {"id": 99}
+    monkeypatch.setattr(main, "update_broadcast", checkpoint)
+    job = dict(main.BROADCASTS["t-resume"])
+    assert job["last_uid"] == "119"
+    main.run_broadcast(job)
+    assert sent == list(range(100, 135))
+    assert (job["status"], job["sent"], job["offset"]) == ("done", 35, 35)
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def journal(main, tmp_path, monkeypatch):
+    """orders.json and its journal in tmp_path, with a private ORDERS list."""
+    monkeypatch.setattr(main, "ORDERS_FILE", str(tmp_path / "orders.json"))
+    monkeypatch.setattr(main, "ORDERS_JOURNAL_FILE", str(tmp_path / "orders.journal.jsonl"))
+    monkeypatch.setattr(main, "ORDERS", [])
+    # no background compaction: it would outlive the monkeypatching
+    monkeypatch.setattr(main, "ORDERS_COMPACT_EVERY", 10 ** 9)
+    return tmp_path
+
+
+def write_lines(path, events, tail=""):
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(e) + "\n" for e in events)
+        f.write(tail)
+
+
+def order(order_id, status="pending"):
+    return {"order_id": order_id, "user_id": 1, "status": status, "created_at": "2026-01-01T00:00:00"}
+
+
+def states(orders):
+    return [(o["order_id"], o["status"]) for o in orders]
+
+
+def test_replay_after_crash_mid_compaction(main, journal):
+    # the crash hit while .1 was being folded into orders.json: the snapshot already
+    # has o2 from .1, and a torn line was left at the end of the new journal
+    with open(main.ORDERS_FILE, "w", encoding="utf-8") as f:
+        json.dump([order("o1"), order("o2")], f)
+    write_lines(main.ORDERS_JOURNAL_FILE + ".1", [
+        {"op": "create", "order": order("o2")},
+        {"op": "update", "order_id": "o1", "fields": {"status": "approved"}},
+    ])
+    write_lines(main.ORDERS_JOURNAL_FILE, [
+        {"op": "update", "order_id": "o2", "fields": {"status": "rejected"}},
+        {"op": "create", "order": order("o3")},
+    ], tail='{"op": "update", "order_id": "o3", "fie')
+
+    orders = main.load_orders_with_journal()
+    assert states(orders) == [("o1", "approved"), ("o2", "rejected"), ("o3", "pending")]
+    # the torn line is cut off, so later appends start on a line of their own
+    with open(main.ORDERS_JOURNAL_FILE, encoding="utf-8") as f:
+        assert [json.loads(line)["op"] for line in f] == ["update", "create"]
+
+    # compacting with the leftover .1 still there folds everything into orders.json
+    main.ORDERS[:] = orders
+    main.compact_orders_journal()
+    assert not (journal / "orders.journal.jsonl.1").exists()
+    assert states(main.load_orders_with_journal()) == states(orders)
+
+
+def test_compaction_racing_appends(main, journal):
+    done = threading.Event()
+
+    def writer():
+        try:
+            for i in range(300):
+                o = order(f"r{i}")
+                main.ORDERS.append(o)
+                main.append_order_event({"op": "create", "order": o})
+                if i % 3 == 0:
+                    o["status"] = "approved"
+                    main.append_order_event({"op": "update", "order_id": o["order_id"], "fields": {"status": "approved"}})
+                time.sleep(0.001)   # let compactions land between appends
+        finally:
+            done.set()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    compactions = 0
+    while not done.is_set():
+        main.compact_orders_journal()
+        compactions += 1
+    thread.join()
+    assert compactions > 1
+
+    # whatever the interleaving, snapshot + journal replay to what is in memory
+    assert states(main.load_orders_with_journal()) == states(main.ORDERS)
+    main.compact_orders_journal()
+    assert states(main.load_orders_with_journal()) == states(main.ORDERS)
+
+
+def test_archive_event_replayed_on_snapshot(main, journal):
+    with open(main.ORDERS_FILE, "w", encoding="utf-8") as f:
+        json.dump([order("a1", "approved"), order("a2"), order("a3", "rejected")], f)
+    write_lines(main.ORDERS_JOURNAL_FILE, [
+        {"op": "archive", "order_ids": ["a1", "a3"]},
+        # a late update for an archived order must not bring it back
+        {"op": "update", "order_id": "a1", "fields": {"status": "rejected"}},
+        {"op": "update", "order_id": "a2", "fields": {"status": "approved"}},
+        {"op": "create", "order": order("a4")},
+    ])
+    assert states(main.load_orders_with_journal()) == [("a2", "approved"), ("a4", "pending")]
+    # replaying again on top of an already compacted snapshot changes nothing
+    with open(main.ORDERS_FILE, "w", encoding="utf-8") as f:
+        json.dump([order("a2", "approved"), order("a4")], f)
+    assert states(main.load_orders_with_journal()) == [("a2", "approved"), ("a4", "pending")]
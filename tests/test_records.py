@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+ORDER = {
+    "order_id": "3f1c2a9e-0000-4000-8000-000000000001",
+    "user_id": 42,
+    "user_name": "سارة",
+    "button_id": "pubg",
+    "button_text": "شحن شدات PUBG",
+    "info": "id 123\n600 UC",
+    "status": "approved",
+    "created_at": "2026-03-01T12:30:45.123456",
+    "handled_at": "2026-03-01T13:00:00",
+    "notes": "تم",
+    # fields the record has no slot for
+    "coupon": {"code": "X1", "uses": [1, 2]},
+    "priority": None,
+}
+
+USER = {
+    "id": 42,
+    "name": "سارة",
+    "first_seen": "2026-01-01T00:00:00",
+    "last_seen": "2026-03-01T12:30:45.000001",
+    "awaiting": {"button_id": "pubg"},
+    "lang": "ar",
+    "order_count": 3,
+    "services": ["pubg", "ff"],
+    "referrer": 7,
+}
+
+# values the codecs cannot reproduce exactly, so they must stay in extra as given
+RAW_ORDER_VALUES = [
+    ("created_at", "2026-03-01 12:30:45"),          # isoformat() would add a "T"
+    ("created_at", "2026-03-01T12:30:45+03:00"),    # timezone-aware
+    ("created_at", "yesterday"),
+    ("handled_at", 1767225600),
+    ("status", "cancelled"),
+]
+
+
+def test_order_round_trip(main):
+    record = main.OrderRecord(ORDER)
+    assert record.extra == {"coupon": ORDER["coupon"], "priority": None}
+    assert main.json_snapshot(record) == ORDER
+    assert json.loads(json.dumps(record, default=dict)) == ORDER
+
+
+def test_user_round_trip(main):
+    record = main.UserRecord(USER)
+    assert record.extra == {"referrer": 7}
+    assert main.json_snapshot(record) == USER
+
+
+@pytest.mark.parametrize("field,value", RAW_ORDER_VALUES)
+def test_raw_values_survive(main, field, value):
+    data = dict(ORDER, **{field: value})
+    record = main.OrderRecord(data)
+    assert record.extra[field] == value
+    assert record[field] == value
+    assert main.json_snapshot(record) == data
+
+
+@pytest.mark.parametrize("field,value", RAW_ORDER_VALUES)
+def test_setitem_switches_between_slot_and_extra(main, field, value):
+    record = main.OrderRecord(ORDER)
+    record[field] = value    # encoded slot -> extra
+    assert field in record.extra and record.get(field) == value
+    assert main.json_snapshot(record) == dict(ORDER, **{field: value})
+    record[field] = ORDER[field]   # and back: the stale extra copy must go
+    assert field not in record.extra
+    assert main.json_snapshot(record) == ORDER
+
+
+def test_update_and_delete(main):
+    record = main.OrderRecord(ORDER)
+    record.update(status="rejected", handled_at=None, extra_note="x")
+    del record["notes"]
+    expected = dict(ORDER, status="rejected", handled_at=None, extra_note="x")
+    del expected["notes"]
+    assert main.json_snapshot(record) == expected
+    with pytest.raises(KeyError):
+        del record["notes"]
+
+
+def test_snapshot_is_a_copy(main):
+    record = main.UserRecord(USER)
+    snapshot = main.json_snapshot(record)
+    snapshot["services"].append("itunes")
+    snapshot["awaiting"]["button_id"] = "ff"
+    assert record["services"] == ["pubg", "ff"]
+    assert record["awaiting"] == {"button_id": "pubg"}
@@ -0,0 +1,91 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+ADMIN = 999
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("2030-01-02 03:04", datetime(2030, 1, 2, 3, 4)),
+    ("2025-08-10 15:30", datetime(2025, 8, 10, 15, 30)),   # in the past: still parsed, missed_run decides
+])
+def test_one_shot_times(main, text, expected):
+    assert main.parse_schedule_input(text) == (expected, None)
+
+
+@pytest.mark.parametrize("cron,minute,hour,weekdays", [
+    ("0 9 * * *", 0, 9, range(7)),
+    ("30 18 * * mon-fri", 30, 18, range(5)),
+    ("*/15 * * * *", None, None, range(7)),
+])
+def test_cron_expressions(main, cron, minute, hour, weekdays):
+    now = datetime.now()
+    when, kept = main.parse_schedule_input(cron)
+    assert kept == cron
+    assert when > now and when.second == 0
+    assert minute is None or when.minute == minute
+    assert hour is None or when.hour == hour
+    assert when.weekday() in weekdays
+    if minute is None:
+        assert when.minute % 15 == 0
+
+
+@pytest.mark.parametrize("text", [
+    "", "tomorrow", "2030-01-01", "2030-13-01 10:00", "2030-01-01 25:00", "10:00",
+    "0 9 * *", "* * * * * *", "61 * * * *", "0 25 * * *", "a b c d e",
+])
+def test_invalid_input(main, text):
+    with pytest.raises(ValueError):
+        main.parse_schedule_input(text)
+
+
+@pytest.fixture
+def replies(main, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main.bot, "send_message", lambda chat_id, text, *a, **kw: calls.append(text))
+    yield calls
+    main.admin_sessions.pop(ADMIN, None)
+
+
+def type_answer(main, text):
+    session = main.admin_sessions[ADMIN]
+    main.handle_admin_session_input(SimpleNamespace(from_user=SimpleNamespace(id=ADMIN), text=text), session)
+
+
+def start_audience_step(main):
+    main.admin_sessions[ADMIN] = {"action": "schedule_audience",
+                                  "temp": {"text": "hello", "time": "2030-01-02T03:04:00", "cron": None}}
+
+
+@pytest.mark.parametrize("answer", ["yes", " YES "])
+def test_typed_yes_schedules_for_everyone(main, replies, answer):
+    start_audience_step(main)
+    type_answer(main, answer)
+    assert ADMIN not in main.admin_sessions
+    entry = next(e for e in main.SCHEDULES if e["text"] == "hello")
+    try:
+        assert (entry["audience"], entry["time"], entry["cron"]) == ("all", "2030-01-02T03:04:00", None)
+        assert replies[-1].startswith("✅")
+    finally:
+        main.remove_schedule(entry["id"])
+
+
+@pytest.mark.parametrize("answer", ["no", "No"])
+def test_typed_no_cancels(main, replies, answer):
+    before = len(main.SCHEDULES)
+    start_audience_step(main)
+    type_answer(main, answer)
+    assert ADMIN not in main.admin_sessions
+    assert len(main.SCHEDULES) == before
+    assert replies == ["تم إلغاء العملية."]
+
+
+@pytest.mark.parametrize("answer", ["maybe", "", "active:7"])
+def test_other_answers_ask_again(main, replies, answer):
+    before = len(main.SCHEDULES)
+    start_audience_step(main)
+    type_answer(main, answer)
+    assert main.admin_sessions[ADMIN]["action"] == "schedule_audience"
+    assert len(main.SCHEDULES) == before
+    assert len(replies) == 1 and replies[0].startswith("🎯")
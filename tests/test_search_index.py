@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.mark.parametrize("text,tokens", [
+    ("PUBG 600 UC", ["pubg", "600", "uc"]),
+    ("Straße", ["strasse"]),
+    ("a b 7", ["7"]),                          # single letters are noise, single digits are not
+    ("أحمد إبراهيم آمنة", ["احمد", "ابراهيم", "امنه"]),
+    ("مُحَمَّد", ["محمد"]),                      # diacritics
+    ("مـــرحبا", ["مرحبا"]),                    # tatweel
+    ("مصطفى", ["مصطفي"]),
+    ("", []),
+    (None, []),
+    (12345, ["12345"]),
+])
+def test_tokens(main, text, tokens):
+    assert main.search_tokens(text) == tokens
+
+
+def order(order_id, info="", user_name="", button_text=""):
+    return {"order_id": order_id, "info": info, "user_name": user_name, "button_text": button_text}
+
+
+@pytest.fixture
+def index(main):
+    index = main.SearchIndex()
+    index.add_order(order("o1", "pubg id 5551234", "سارة", "شحن شدات PUBG"))
+    index.add_order(order("o2", "freefire 100 diamonds", "أحمد", "FreeFire"))
+    index.add_order(order("o3", "pubg 600 uc", "احمد علي", "شحن شدات PUBG"))
+    index.add_order(order("o4", "[PHOTO] AgACAgQAAxkBAAI", "سارة", "Google Play"))
+    index.update_user("42", {"name": "أحمد علي"})
+    return index
+
+
+def keys(result):
+    return result[0]
+
+
+def test_exact_prefix_and_all_terms(index):
+    assert keys(index.search("pubg")) == [("o", "o3"), ("o", "o1")]
+    assert keys(index.search("diam")) == [("o", "o2")]                       # prefix
+    assert keys(index.search("pubg 600")) == [("o", "o3")]                   # every term must match
+    assert index.search("pubg nothing") == ([], 0)
+    assert index.search("") == ([], 0)
+
+
+def test_arabic_variants_match(index):
+    # "أحمد" and "احمد" are the same token; users match by name and id
+    assert set(keys(index.search("أحمد"))) == {("o", "o2"), ("o", "o3"), ("u", "42")}
+    assert keys(index.search("42")) == [("u", "42")]
+
+
+def test_field_weight_then_newest_first(index):
+    # same field, same score: the newer document first
+    assert keys(index.search("سارة")) == [("o", "o4"), ("o", "o1")]
+    # order_id weighs more than info
+    index.add_order(order("o5", "see o1"))
+    assert keys(index.search("o1"))[0] == ("o", "o1")
+
+
+def test_photo_file_ids_are_not_indexed(index):
+    assert index.search("AgACAgQAAxkBAAI") == ([], 0)
+
+
+def test_paging(index):
+    hits, total = index.search("شحن", offset=1, limit=1)
+    assert total == 2 and hits == [("o", "o1")]
+
+
+def test_user_rename_reindexes(index):
+    docs = len(index.docs)
+    index.update_user("42", {"name": "أحمد علي"})    # unchanged name: nothing to do
+    assert len(index.docs) == docs
+    index.update_user("42", {"name": "Omar"})
+    assert ("u", "42") not in keys(index.search("علي"))
+    assert keys(index.search("omar")) == [("u", "42")]
+
+
+def test_order_change_reindexes(index):
+    index.update_order(order("o2", "freefire 310 diamonds", "أحمد", "FreeFire"))
+    assert index.search("100") == ([], 0)
+    assert keys(index.search("310")) == [("o", "o2")]
+    assert keys(index.search("diamonds")) == [("o", "o2")]
+
+
+def test_removal_and_compaction_keep_results(main):
+    index = main.SearchIndex()
+    for i in range(1500):
+        index.add_order(order(f"c{i}", f"batch{i % 3} item", "", ""))
+    index.remove_orders([{"order_id": f"c{i}"} for i in range(1200)])
+    # more than 1000 tombstones and a quarter of the docs: compacted away
+    assert index.removed == 0 and len(index.docs) == 300
+    hits, total = index.search("batch1", limit=3)
+    assert total == 100 and hits == [("o", "c1498"), ("o", "c1495"), ("o", "c1492")]
+    assert index.search("c5") == ([], 0)
+
+
+def test_store_keeps_the_index_current(main):
+    old = (datetime.now() - timedelta(days=400)).isoformat()
+    o = {"order_id": "s-1", "user_id": 5, "user_name": "Search Test", "button_id": "pubg", "button_text": "PUBG",
+         "info": "zebra 1", "status": "pending", "created_at": old}
+    main.add_order(o)
+    o = main.get_order("s-1")
+    assert keys(main.SEARCH.search("zebra")) == [("o", "s-1")]
+    main.update_order(o, info="okapi 2")
+    assert main.SEARCH.search("zebra") == ([], 0)
+    assert keys(main.SEARCH.search("okapi")) == [("o", "s-1")]
+    main.update_order(o, status="approved", handled_at=old)
+    assert main.archive_old_orders(days=30) >= 1
+    assert main.SEARCH.search("okapi") == ([], 0)
+    assert main.find_archived_order("s-1")["info"] == "okapi 2"